@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Compare how long creating the certificates of a new cluster takes in-process
+and with the cfssl binary the operator used to shell out to.
+
+Usage: certificate_generation.py [options]
+
+Options:
+  -n N              Create the certificates of N clusters [default: 20].
+  --key-pool        Also time in-process generation with keys taken from a
+                    pre-filled key pool.
+  --cfssl PATH      Also time the cfssl binary at PATH.
+  --ca-config PATH  cfssl signing config
+                    [default: ../images/init/src/files/ca-config.json].
+  -h --help         Show this screen.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+from tempfile import NamedTemporaryFile
+from time import monotonic
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mongodb_operator.certificates import (  # noqa: E402
+    KEY_POOL, get_certificate_authority, get_client_certificate)
+
+
+def in_process(name, namespace):
+    ca_pem, ca_key_pem = get_certificate_authority(name, namespace)
+    get_client_certificate(
+        name, namespace, ca_pem.encode('utf-8'), ca_key_pem.encode('utf-8'))
+
+
+def write_csr(csr_file, common_name, hosts=None):
+    csr = {'CN': common_name,
+           'key': {'algo': 'rsa', 'size': 2048},
+           'names': [{'O': common_name}]}
+    if hosts is not None:
+        csr['hosts'] = hosts
+    csr_file.write(json.dumps(csr).encode('utf-8') + b'\n')
+    csr_file.flush()
+
+
+def with_cfssl(cfssl, ca_config, name, namespace):
+    # What the operator did before: write CSRs and the CA to temporary files
+    # and run cfssl twice
+    with NamedTemporaryFile() as ca_csr_file:
+        write_csr(ca_csr_file, '{}.{}.svc.cluster.local'.format(
+            name, namespace))
+        ca = json.loads(subprocess.check_output(
+            [cfssl, 'genkey', '-initca', ca_csr_file.name]).decode('utf-8'))
+
+    with NamedTemporaryFile() as ca_file, \
+            NamedTemporaryFile() as ca_key_file, \
+            NamedTemporaryFile() as client_csr_file:
+        ca_file.write(ca['cert'].encode('utf-8'))
+        ca_file.flush()
+        ca_key_file.write(ca['key'].encode('utf-8'))
+        ca_key_file.flush()
+        write_csr(client_csr_file, '{}-client'.format(name), hosts=[])
+        subprocess.check_output([
+            cfssl, 'gencert',
+            '-ca={}'.format(ca_file.name),
+            '-ca-key={}'.format(ca_key_file.name),
+            '-config={}'.format(ca_config),
+            '-profile=client',
+            client_csr_file.name], stderr=subprocess.DEVNULL)
+
+
+def benchmark(label, func, count):
+    latencies = []
+    for i in range(count):
+        start = monotonic()
+        func('benchmark{}'.format(i), 'default')
+        latencies.append(monotonic() - start)
+
+    latencies.sort()
+    print('{:<12} mean {:7.1f}ms  p50 {:7.1f}ms  max {:7.1f}ms'.format(
+        label,
+        sum(latencies) / count * 1000,
+        latencies[count // 2] * 1000,
+        latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    count = int(args['-n'])
+
+    benchmark('in-process', in_process, count)
+    if args['--key-pool']:
+        # Two keys per cluster, filled up front like the background thread
+        # would have done while the operator was idle
+        KEY_POOL.size = count * 2
+        while KEY_POOL.fill():
+            pass
+        benchmark('key-pool', in_process, count)
+    if args['--cfssl']:
+        benchmark('cfssl', lambda name, namespace: with_cfssl(
+            args['--cfssl'], args['--ca-config'], name, namespace), count)
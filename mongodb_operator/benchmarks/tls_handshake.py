@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+Compare TLS handshakes with the key algorithms spec.tls.key_algorithm
+supports. Like a driver connecting to mongod, the client presents the
+cluster's client certificate and both sides verify each other against the
+cluster CA.
+
+Usage: tls_handshake.py [options]
+
+Options:
+  -n N              Do N handshakes per key algorithm [default: 200].
+  -h --help         Show this screen.
+
+"""
+
+import os
+import socket
+import ssl
+import sys
+import threading
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mongodb_operator.certificates import (  # noqa: E402
+    KEY_ALGORITHMS, get_certificate_authority, get_client_certificate,
+    get_member_certificate)
+
+
+def write_file(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def serve(server_socket, context, count):
+    for i in range(count):
+        connection, _ = server_socket.accept()
+        try:
+            with context.wrap_socket(connection, server_side=True):
+                pass
+        except (ssl.SSLError, OSError):
+            pass
+
+
+def benchmark(key_algorithm, count, directory):
+    ca_pem, ca_key_pem = get_certificate_authority(
+        'benchmark', 'default', key_algorithm=key_algorithm)
+    ca_file = write_file(directory, 'ca.pem', ca_pem)
+    server_file = write_file(directory, 'server.pem', get_member_certificate(
+        'benchmark', 'default', 'benchmark-0', ca_pem.encode('utf-8'),
+        ca_key_pem.encode('utf-8'), key_algorithm=key_algorithm))
+    client_file = write_file(directory, 'client.pem', get_client_certificate(
+        'benchmark', 'default', ca_pem.encode('utf-8'),
+        ca_key_pem.encode('utf-8'), key_algorithm=key_algorithm))
+
+    server_context = ssl.create_default_context(
+        ssl.Purpose.CLIENT_AUTH, cafile=ca_file)
+    server_context.load_cert_chain(server_file)
+    server_context.verify_mode = ssl.CERT_REQUIRED
+    client_context = ssl.create_default_context(cafile=ca_file)
+    client_context.load_cert_chain(client_file)
+
+    server_socket = socket.socket()
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(16)
+    server = threading.Thread(
+        target=serve, args=(server_socket, server_context, count))
+    server.start()
+
+    latencies = []
+    for i in range(count):
+        start = monotonic()
+        with socket.create_connection(server_socket.getsockname()) as sock:
+            with client_context.wrap_socket(
+                    sock, server_hostname='localhost'):
+                latencies.append(monotonic() - start)
+
+    server.join()
+    server_socket.close()
+
+    latencies.sort()
+    print('{:<12} mean {:6.2f}ms  p50 {:6.2f}ms  p99 {:6.2f}ms'.format(
+        key_algorithm,
+        sum(latencies) / count * 1000,
+        latencies[count // 2] * 1000,
+        latencies[int(count * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    count = int(args['-n'])
+
+    with TemporaryDirectory() as directory:
+        for key_algorithm in sorted(KEY_ALGORITHMS):
+            benchmark(key_algorithm, count, directory)
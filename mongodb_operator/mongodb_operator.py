@@ -7,10 +7,41 @@ Usage: mongodb_operator.py [options] [--help]
 
 Periodic Check Options:
   --periodic-check-interval N   Check every N seconds [default: 25].
+  --garbage-collection-interval N
+                                Scan for orphaned resources every N seconds,
+                                0 disables the scan [default: 3600].
 
 Event Listener Options:
   --event-listener-timeout N    Timeout after N seconds [default: 25].
 
+Reconciliation Options:
+  --workers N                   Reconcile N clusters at once [default: 4].
+
+API Client Options:
+  --api-pool-size N             Keep up to N connections to the apiserver
+                                open, defaults to one per worker plus one for
+                                the periodic check.
+  --api-qps N                   Limit calls to the apiserver to N per second
+                                on average, 0 disables the limit [default: 20].
+  --api-burst N                 Allow bursts of up to N calls [default: 30].
+
+Certificate Options:
+  --key-pool-size N             Keep N private keys per key algorithm in use
+                                generated ahead of time for new clusters, 0
+                                disables the pool [default: 10].
+  --certificate-renew-days N    Renew certificates N days before they expire
+                                [default: 30].
+  --max-certificate-rotations N
+                                Restart the members of at most N clusters at
+                                once to rotate their certificates
+                                [default: 1].
+
+State Cache Options:
+  --state-cache-size N          Remember up to N resource versions
+                                [default: 10000].
+  --state-cache-file PATH       Snapshot the state cache to a local file.
+  --state-cache-configmap NS/CM  Snapshot the state cache to a ConfigMap.
+
 General Options:
   --loglevel LOGLEVEL           Desired loglevel [default: INFO].
   --version                     Show version.
@@ -20,6 +51,7 @@ General Options:
 
 import logging
 import threading
+from datetime import timedelta
 from time import sleep
 from sys import exit
 
@@ -27,8 +59,16 @@ from docopt import docopt
 from kubernetes import config
 from kubernetes.client import Configuration
 
+from mongodb_operator.certificate_rotation import (CERTIFICATE_EXPIRY,
+                                                   CERTIFICATE_ROTATIONS)
+from mongodb_operator.certificates import KEY_POOL
 from mongodb_operator.periodical import periodical_check
 from mongodb_operator.events import event_listener
+from mongodb_operator.informers import CHILD_INFORMERS, SECRET_INFORMER
+from mongodb_operator.kubernetes_clients import configure_api_clients
+from mongodb_operator.rate_limiter import RATE_LIMITER
+from mongodb_operator.reconcile import reconcile_worker
+from mongodb_operator.state_cache import VERSION_CACHE
 
 
 class MongoDBOperator(object):
@@ -42,12 +82,48 @@ class MongoDBOperator(object):
         c.assert_hostname = False
         Configuration.set_default(c)
 
+        # All threads share one pooled api client, the informer watches,
+        # including the event listener's, hold a connection each
+        pool_size = args['--api-pool-size'] or int(args['--workers']) + 1
+        configure_api_clients(
+            pool_size=int(pool_size),
+            watch_pool_size=len(CHILD_INFORMERS) + 1)
+        RATE_LIMITER.configure(
+            float(args['--api-qps']), int(args['--api-burst']))
+
+        # Start with the resource versions a previous run already reconciled
+        VERSION_CACHE.max_entries = int(args['--state-cache-size'])
+        VERSION_CACHE.snapshot_file = args['--state-cache-file']
+        if args['--state-cache-configmap']:
+            VERSION_CACHE.snapshot_configmap = \
+                args['--state-cache-configmap'].split('/', 1)
+        try:
+            VERSION_CACHE.restore()
+        except Exception as e:
+            logging.warning('unable to restore state cache: {}'.format(e))
+
+        # Generates private keys in the background, so new clusters get their
+        # certificates without waiting for key generation
+        KEY_POOL.size = int(args['--key-pool-size'])
+        self.key_pool_thread = threading.Thread(
+            name='KeyPool',
+            target=KEY_POOL.run,
+            args=(self.shutting_down,))
+
+        # The expiry index follows the secrets, rotation restarts members of
+        # a bounded number of clusters at a time
+        SECRET_INFORMER.add_handler(CERTIFICATE_EXPIRY.handle_event)
+        CERTIFICATE_ROTATIONS.renew_before = timedelta(
+            days=int(args['--certificate-renew-days']))
+        CERTIFICATE_ROTATIONS.limit = int(args['--max-certificate-rotations'])
+
         self.periodic_check_thread = threading.Thread(
             name='PeriodicCheck',
             target=periodical_check,
             args=(
                 self.shutting_down,
-                args['--periodic-check-interval']))
+                args['--periodic-check-interval'],
+                args['--garbage-collection-interval']))
 
         self.event_listener_thread = threading.Thread(
             name='EventListener',
@@ -56,21 +132,57 @@ class MongoDBOperator(object):
                 self.shutting_down,
                 args['--event-listener-timeout']))
 
+        # Each worker reconciles one cluster at a time, the work queue makes
+        # sure two workers never get the same cluster
+        self.reconcile_threads = []
+        for i in range(int(args['--workers'])):
+            self.reconcile_threads.append(threading.Thread(
+                name='Reconciler-{}'.format(i),
+                target=reconcile_worker,
+                args=(self.shutting_down,)))
+
+        # Informers keep the cache of services, statefulsets and secrets the
+        # periodic check and garbage collection read from
+        self.informer_threads = []
+        for informer in CHILD_INFORMERS:
+            self.informer_threads.append(threading.Thread(
+                name='{}Informer'.format(informer.kind.capitalize()),
+                target=informer.run,
+                args=(
+                    self.shutting_down,
+                    args['--event-listener-timeout'])))
+
     def run(self):
         try:
             while True:
+                for informer_thread in self.informer_threads:
+                    if not informer_thread.ident:
+                        informer_thread.start()
+
+                if not self.key_pool_thread.ident:
+                    self.key_pool_thread.start()
+
                 if not self.periodic_check_thread.ident:
                     self.periodic_check_thread.start()
 
                 if not self.event_listener_thread.ident:
                     self.event_listener_thread.start()
 
+                for reconcile_thread in self.reconcile_threads:
+                    if not reconcile_thread.ident:
+                        reconcile_thread.start()
+
                 sleep(5)
         except KeyboardInterrupt:
             logging.info('Stopping threads')
             self.shutting_down.set()
+            self.key_pool_thread.join()
             self.periodic_check_thread.join()
             self.event_listener_thread.join()
+            for reconcile_thread in self.reconcile_threads:
+                reconcile_thread.join()
+            for informer_thread in self.informer_threads:
+                informer_thread.join()
 
 
 if __name__ == '__main__':
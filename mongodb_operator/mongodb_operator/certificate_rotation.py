@@ -0,0 +1,352 @@
+import bisect
+import logging
+import threading
+from base64 import b64decode
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import monotonic
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from pymongo.errors import AutoReconnect, PyMongoError
+
+from .certificates import get_not_valid_after
+from .informers import SECRET_INFORMER
+from .kubernetes_helpers import (delete_pod, renew_client_certificate_secret,
+                                 update_member_certificates_secret)
+from .mongodb_clients import get_mongo_client
+from .mongodb_helpers import (get_host, get_replicas, get_replicaset_status,
+                              get_statefulset_replicas)
+from .replicaset_status import REPLICASET_STATUS
+
+
+CA = 'ca'
+CLIENT = 'client'
+MEMBER = 'member'
+
+
+# One certificate in a cluster secret. Sorts by expiry first.
+IndexedCertificate = namedtuple('IndexedCertificate', [
+    'not_valid_after', 'namespace', 'cluster', 'kind', 'secret', 'key'])
+
+
+def get_secret_certificate_keys(secret):
+    # Returns (kind, key) of the certificates in one of the cluster secrets
+    labels = secret.metadata.labels or {}
+    cluster = labels.get('cluster')
+    if cluster is None or not secret.data:
+        return []
+
+    name = secret.metadata.name
+    if name == '{}-ca'.format(cluster):
+        return [(CA, 'ca.pem')]
+    if name == '{}-client-certificate'.format(cluster):
+        return [(CLIENT, 'mongod.pem')]
+    if name == '{}-member-certificates'.format(cluster):
+        # The secret also holds a copy of the CA certificate
+        return [(MEMBER, key) for key in sorted(secret.data)
+                if key.endswith('.pem') and key != 'ca.pem']
+    return []
+
+
+def get_pem_not_valid_after(pem):
+    # The first PEM block is the certificate, a key may follow
+    return get_not_valid_after(
+        x509.load_pem_x509_certificate(pem, default_backend()))
+
+
+# Keeps the certificates of all clusters sorted by when they expire. It is
+# fed by the secret informer, a secret is only parsed again when its resource
+# version changed.
+class CertificateExpiryIndex(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._entries = {}
+        self._sorted = []
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sorted)
+
+    def handle_event(self, event):
+        secret = event['object']
+        if event['type'] == 'DELETED':
+            self.remove(secret.metadata.namespace, secret.metadata.name)
+        elif event['type'] in ('ADDED', 'MODIFIED'):
+            self.update(secret)
+
+    def update(self, secret):
+        namespace = secret.metadata.namespace
+        name = secret.metadata.name
+        with self._lock:
+            if self._versions.get((namespace, name)) == \
+                    secret.metadata.resource_version:
+                return False
+
+        cluster = (secret.metadata.labels or {}).get('cluster')
+        entries = []
+        for kind, key in get_secret_certificate_keys(secret):
+            try:
+                not_valid_after = get_pem_not_valid_after(
+                    b64decode(secret.data[key]))
+            except ValueError as e:
+                logging.warning('unable to parse {} of secret/{} in ns/{}: {}'
+                                .format(key, name, namespace, e))
+                continue
+            entries.append(IndexedCertificate(
+                not_valid_after, namespace, cluster, kind, name, key))
+
+        with self._lock:
+            self._remove(namespace, name)
+            self._versions[(namespace, name)] = \
+                secret.metadata.resource_version
+            self._entries[(namespace, name)] = entries
+            for entry in entries:
+                bisect.insort(self._sorted, entry)
+        return True
+
+    def remove(self, namespace, name):
+        with self._lock:
+            self._remove(namespace, name)
+
+    def _remove(self, namespace, name):
+        self._versions.pop((namespace, name), None)
+        for entry in self._entries.pop((namespace, name), []):
+            self._sorted.remove(entry)
+
+    def expiring(self, before, namespace=None, cluster=None):
+        # Returns the certificates that expire before the given time, soonest
+        # first, optionally only the ones of one cluster
+        with self._lock:
+            index = bisect.bisect_left(self._sorted, (before,))
+            entries = self._sorted[:index]
+        if cluster is None:
+            return entries
+        return [entry for entry in entries
+                if entry.namespace == namespace and entry.cluster == cluster]
+
+
+# Bounds how many clusters restart members for certificate rotation at the
+# same time across all workers. A cluster holds its slot until all of its
+# member certificates were rotated.
+class CertificateRotations(object):
+
+    def __init__(self, limit=1, renew_before=timedelta(days=30),
+                 settle_seconds=60):
+        self.limit = limit
+        self.renew_before = renew_before
+        # Time a restarted member gets to rejoin before the next restart
+        self.settle_seconds = settle_seconds
+
+        self._lock = threading.Lock()
+        # Per cluster the member waiting for its restart and the time of the
+        # last restart
+        self._active = {}
+        self._warned = set()
+
+    def acquire(self, namespace, name):
+        with self._lock:
+            if (namespace, name) in self._active:
+                return True
+            if len(self._active) >= self.limit:
+                return False
+            self._active[(namespace, name)] = (None, None)
+            return True
+
+    def release(self, namespace, name):
+        with self._lock:
+            self._active.pop((namespace, name), None)
+
+    def renewed(self, namespace, name, member):
+        with self._lock:
+            _, restarted = self._active[(namespace, name)]
+            self._active[(namespace, name)] = (member, restarted)
+
+    def restarted(self, namespace, name):
+        with self._lock:
+            self._active[(namespace, name)] = (None, monotonic())
+
+    def pending_restart(self, namespace, name):
+        # The member whose certificate was renewed but whose pod wasn't
+        # restarted yet
+        with self._lock:
+            member, _ = self._active.get((namespace, name), (None, None))
+        return member
+
+    def has_restarted(self, namespace, name):
+        # Whether the cluster restarted a member or is about to
+        with self._lock:
+            member, restarted = self._active.get(
+                (namespace, name), (None, None))
+        return member is not None or restarted is not None
+
+    def is_settling(self, namespace, name):
+        with self._lock:
+            _, restarted = self._active.get((namespace, name), (None, None))
+        return restarted is not None and \
+            monotonic() - restarted < self.settle_seconds
+
+    def warn_once(self, certificate):
+        with self._lock:
+            if certificate in self._warned:
+                return False
+            self._warned.add(certificate)
+        return True
+
+    def active(self):
+        with self._lock:
+            return set(self._active)
+
+
+CERTIFICATE_EXPIRY = CertificateExpiryIndex()
+CERTIFICATE_ROTATIONS = CertificateRotations()
+
+
+def get_member_name(certificate):
+    return certificate.key[:-len('.pem')]
+
+
+def get_pod_name(member_name):
+    # Members are named <pod>.<service>...:<port> in the replica set status
+    return get_host(member_name).split('.', 1)[0]
+
+
+def rotate_certificates(cluster_object, now=None):
+    # Renews certificates of the cluster that expire soon and returns whether
+    # anything was rotated
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    rotations = CERTIFICATE_ROTATIONS
+
+    deadline = (now or datetime.utcnow()) + rotations.renew_before
+    expiring = CERTIFICATE_EXPIRY.expiring(deadline, namespace, name)
+
+    for certificate in expiring:
+        # A new CA has to be trusted by every member and client before it
+        # can sign anything, that is beyond what we can do unattended
+        if certificate.kind == CA and rotations.warn_once(certificate):
+            logging.warning(
+                'certificate authority of {} in ns/{} expires {}, it has to '
+                'be replaced manually'.format(
+                    name, namespace, certificate.not_valid_after))
+
+    ca_expiry = min((certificate.not_valid_after for certificate in expiring
+                     if certificate.kind == CA), default=None)
+    if ca_expiry is not None:
+        # Renewed certificates can't outlive the CA, renewing the ones that
+        # expire with it already would restart members for nothing
+        expiring = [certificate for certificate in expiring
+                    if certificate.kind == CA or
+                    certificate.not_valid_after < ca_expiry]
+
+    rotated = False
+    if any(certificate.kind == CLIENT for certificate in expiring):
+        # Clients pick the new certificate up with the secret, no restarts
+        rotated = bool(renew_client_certificate_secret(cluster_object))
+
+    members = [get_member_name(certificate) for certificate in expiring
+               if certificate.kind == MEMBER]
+    if not members and rotations.pending_restart(namespace, name) is None:
+        rotations.release(namespace, name)
+        return rotated
+
+    return rotate_member_certificate(cluster_object, members) or rotated
+
+
+def rotate_member_certificate(cluster_object, members):
+    # Rotates the certificate of one member per call. mongod only reads its
+    # certificate at startup, so the member is restarted. Secondaries go
+    # first, the primary steps down before its turn, and nothing happens
+    # unless all members are healthy.
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    rotations = CERTIFICATE_ROTATIONS
+
+    if not rotations.acquire(namespace, name):
+        logging.info('waiting to rotate certificates of {} in ns/{}, {} '
+                     'rotations in progress'.format(
+                         name, namespace, len(rotations.active())))
+        return False
+
+    if rotations.is_settling(namespace, name):
+        return False
+
+    status = get_replicaset_status(cluster_object)
+    if status is None or not status.is_healthy(get_replicas(cluster_object)):
+        logging.info('waiting for replicaset {} in ns/{} to be healthy to '
+                     'rotate certificates'.format(name, namespace))
+        if not rotations.has_restarted(namespace, name):
+            # Nothing of ours to wait for, other clusters can use the slot
+            rotations.release(namespace, name)
+        return False
+    REPLICASET_STATUS.set(namespace, name, status)
+
+    # Certificates of members that were scaled away need no restart
+    running = set(get_pod_name(m.name) for m in status.members)
+    idle = [member for member in members if member not in running]
+    if idle:
+        secret = SECRET_INFORMER.get(
+            namespace, '{}-member-certificates'.format(name))
+        if secret is not None:
+            update_member_certificates_secret(
+                cluster_object, secret,
+                get_statefulset_replicas(cluster_object), renew=idle)
+        members = [member for member in members if member in running]
+
+    member = rotations.pending_restart(namespace, name)
+    if member is None and not members:
+        rotations.release(namespace, name)
+        return bool(idle)
+    if member is None:
+        member = renew_member_certificate(cluster_object, status, members)
+        if member is None:
+            return False
+        rotations.renewed(namespace, name, member)
+
+    # The restarted pod mounts the secret with the new certificate
+    if not delete_pod(member, namespace):
+        return False
+
+    rotations.restarted(namespace, name)
+    REPLICASET_STATUS.invalidate(namespace, name)
+    return True
+
+
+def renew_member_certificate(cluster_object, status, members):
+    # Renews the certificate of a secondary and returns its name, steps the
+    # primary down if only its certificate is left
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    primary = get_pod_name(status.primary.name)
+    secondaries = sorted(member for member in members if member != primary)
+    if not secondaries:
+        mongo_client = get_mongo_client(
+            cluster_object, get_host(status.primary.name))
+        if mongo_client is None:
+            return None
+        logging.info('stepping down {} in ns/{} to rotate its certificate'
+                     .format(primary, namespace))
+        try:
+            mongo_client.admin.command('replSetStepDown', 60)
+        except AutoReconnect:
+            # The primary closes all connections when it steps down
+            pass
+        except PyMongoError as e:
+            logging.error('error stepping down {} in ns/{}: {}'.format(
+                primary, namespace, e))
+        return None
+
+    member = secondaries[0]
+    secret = SECRET_INFORMER.get(
+        namespace, '{}-member-certificates'.format(name))
+    if secret is None or not update_member_certificates_secret(
+            cluster_object, secret, get_statefulset_replicas(cluster_object),
+            renew=[member]):
+        return None
+
+    logging.info('renewed certificate of {} in ns/{}'.format(
+        member, namespace))
+    return member
@@ -0,0 +1,300 @@
+import ipaddress
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+
+# Same lifetime cfssl used to issue the certificates with
+CERTIFICATE_VALIDITY = timedelta(hours=43800)
+# The CA can't be rotated unattended, it outlives many renewals of the
+# certificates it signs
+CA_CERTIFICATE_VALIDITY = timedelta(days=7300)
+
+
+# Algorithms spec.tls.key_algorithm can choose from
+KEY_ALGORITHMS = {
+    'rsa-2048': ('rsa', 2048),
+    'rsa-4096': ('rsa', 4096),
+    'ecdsa-p256': ('ecdsa', 256),
+    'ecdsa-p384': ('ecdsa', 384)}
+DEFAULT_KEY_ALGORITHM = 'rsa-2048'
+
+EC_CURVES = {256: ec.SECP256R1, 384: ec.SECP384R1}
+
+
+def get_key_algorithm(cluster_object):
+    # Raises ValueError for algorithms the operator can't issue keys for
+    tls = cluster_object.get('spec', {}).get('tls') or {}
+    algorithm = tls.get('key_algorithm', DEFAULT_KEY_ALGORITHM)
+    if algorithm not in KEY_ALGORITHMS:
+        raise ValueError('tls.key_algorithm must be one of {}'.format(
+            ', '.join(sorted(KEY_ALGORITHMS))))
+    return algorithm
+
+
+def generate_private_key(algorithm=DEFAULT_KEY_ALGORITHM):
+    algo, size = KEY_ALGORITHMS[algorithm]
+    if algo == 'ecdsa':
+        return ec.generate_private_key(EC_CURVES[size](), default_backend())
+    return rsa.generate_private_key(
+        public_exponent=65537, key_size=size, backend=default_backend())
+
+
+def get_signature_hash(private_key):
+    # P-384 keys sign with the hash matching their strength
+    if isinstance(private_key, ec.EllipticCurvePrivateKey) and \
+            private_key.curve.key_size > 256:
+        return hashes.SHA384()
+    return hashes.SHA256()
+
+
+# Keeps up to size private keys per algorithm generated ahead of time, so
+# creating the secrets of a new cluster doesn't have to wait for key
+# generation. An empty pool falls back to generating the key right away. Keys
+# of the default algorithm are always pooled, other algorithms once a cluster
+# asked for them.
+class KeyPool(object):
+
+    def __init__(self, size=0):
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._keys = {DEFAULT_KEY_ALGORITHM: deque()}
+        self._taken = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(keys) for keys in self._keys.values())
+
+    def get(self, algorithm=DEFAULT_KEY_ALGORITHM):
+        with self._lock:
+            keys = self._keys.setdefault(algorithm, deque())
+            if keys:
+                self.hits += 1
+                key = keys.popleft()
+            else:
+                self.misses += 1
+                key = None
+        self._taken.set()
+
+        return key or generate_private_key(algorithm)
+
+    def fill(self):
+        # Generates one key for the emptiest pool that isn't full and returns
+        # if it did
+        with self._lock:
+            algorithms = [algorithm for algorithm, keys in self._keys.items()
+                          if len(keys) < self.size]
+            if not algorithms:
+                return False
+            algorithm = min(algorithms, key=lambda algorithm: (
+                len(self._keys[algorithm]),
+                algorithm != DEFAULT_KEY_ALGORITHM))
+
+        key = generate_private_key(algorithm)
+        with self._lock:
+            self._keys[algorithm].append(key)
+        return True
+
+    def run(self, shutting_down):
+        logging.info('thread started')
+        while not shutting_down.isSet():
+            try:
+                if not self.fill():
+                    # Full, wait until keys are taken
+                    self._taken.wait(1)
+                    self._taken.clear()
+            except Exception as e:
+                # Last resort: catch all exceptions to keep the thread alive
+                logging.exception(e)
+                shutting_down.wait(1)
+        else:
+            logging.info('thread stopped')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': sum(len(keys) for keys in self._keys.values()),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+KEY_POOL = KeyPool()
+
+
+def get_name(common_name):
+    return x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, common_name)])
+
+
+def get_private_key_pem(private_key):
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+
+def get_certificate_pem(certificate):
+    return certificate.public_bytes(
+        serialization.Encoding.PEM).decode('utf-8')
+
+
+def get_not_valid_after(certificate):
+    # As naive UTC datetime, cryptography 42 deprecated not_valid_after
+    try:
+        return certificate.not_valid_after_utc.replace(tzinfo=None)
+    except AttributeError:
+        return certificate.not_valid_after
+
+
+def get_certificate_builder(subject, issuer, public_key,
+                            validity=CERTIFICATE_VALIDITY,
+                            ca_certificate=None):
+    now = datetime.utcnow()
+    not_valid_after = now + validity
+    if ca_certificate is not None:
+        # Nothing validates beyond the CA that signed it
+        not_valid_after = min(
+            not_valid_after, get_not_valid_after(ca_certificate))
+    return x509.CertificateBuilder().subject_name(
+        subject
+    ).issuer_name(
+        issuer
+    ).public_key(
+        public_key
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now - timedelta(minutes=5)
+    ).not_valid_after(
+        not_valid_after
+    ).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(public_key),
+        critical=False)
+
+
+def get_certificate_authority(name, namespace, suffix='svc.cluster.local',
+                              key_algorithm=DEFAULT_KEY_ALGORITHM):
+    # Returns the PEM encoded certificate and key of a self-signed CA
+    common_name = '{}.{}.{}'.format(name, namespace, suffix)
+    private_key = KEY_POOL.get(key_algorithm)
+    subject = get_name(common_name)
+
+    certificate = get_certificate_builder(
+        subject, subject, private_key.public_key(),
+        validity=CA_CERTIFICATE_VALIDITY
+    ).add_extension(
+        x509.BasicConstraints(ca=True, path_length=2), critical=True
+    ).add_extension(
+        x509.KeyUsage(
+            digital_signature=False, content_commitment=False,
+            key_encipherment=False, data_encipherment=False,
+            key_agreement=False, key_cert_sign=True, crl_sign=True,
+            encipher_only=False, decipher_only=False),
+        critical=True
+    ).sign(private_key, get_signature_hash(private_key), default_backend())
+
+    return get_certificate_pem(certificate), get_private_key_pem(private_key)
+
+
+def get_client_certificate(name, namespace, ca_pem, ca_key_pem,
+                           key_algorithm=DEFAULT_KEY_ALGORITHM):
+    # Returns certificate and key of the client the operator and the metrics
+    # exporter authenticate with, concatenated like mongod expects them
+    common_name = '{}-client'.format(name)
+    ca_certificate = x509.load_pem_x509_certificate(
+        ca_pem, default_backend())
+    ca_key = serialization.load_pem_private_key(
+        ca_key_pem, password=None, backend=default_backend())
+    private_key = KEY_POOL.get(key_algorithm)
+
+    certificate = get_certificate_builder(
+        get_name(common_name),
+        ca_certificate.subject,
+        private_key.public_key(),
+        ca_certificate=ca_certificate
+    ).add_extension(
+        x509.BasicConstraints(ca=False, path_length=None), critical=True
+    ).add_extension(
+        x509.KeyUsage(
+            digital_signature=True, content_commitment=False,
+            # Only RSA keys encrypt the TLS key exchange
+            key_encipherment=isinstance(private_key, rsa.RSAPrivateKey),
+            data_encipherment=False,
+            key_agreement=False, key_cert_sign=False, crl_sign=False,
+            encipher_only=False, decipher_only=False),
+        critical=True
+    ).add_extension(
+        x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]),
+        critical=False
+    ).add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            ca_key.public_key()),
+        critical=False
+    ).sign(ca_key, get_signature_hash(ca_key), default_backend())
+
+    return get_certificate_pem(certificate) + get_private_key_pem(private_key)
+
+
+def get_member_hosts(name, namespace, member):
+    # The names mongod is reached by, locally and through the service
+    return [
+        'localhost',
+        member,
+        '{}.{}.{}.svc.cluster.local'.format(member, name, namespace)]
+
+
+def get_member_certificate(name, namespace, member, ca_pem, ca_key_pem,
+                           key_algorithm=DEFAULT_KEY_ALGORITHM):
+    # Returns certificate and key of a replica set member, concatenated like
+    # mongod expects them. Members authenticate each other with it, so it is
+    # valid for server and client authentication.
+    ca_certificate = x509.load_pem_x509_certificate(
+        ca_pem, default_backend())
+    ca_key = serialization.load_pem_private_key(
+        ca_key_pem, password=None, backend=default_backend())
+    private_key = KEY_POOL.get(key_algorithm)
+    alternative_names = [
+        x509.IPAddress(ipaddress.ip_address('127.0.0.1'))] + [
+        x509.DNSName(host)
+        for host in get_member_hosts(name, namespace, member)]
+
+    certificate = get_certificate_builder(
+        get_name('mongod'),
+        ca_certificate.subject,
+        private_key.public_key(),
+        ca_certificate=ca_certificate
+    ).add_extension(
+        x509.BasicConstraints(ca=False, path_length=None), critical=True
+    ).add_extension(
+        x509.KeyUsage(
+            digital_signature=True, content_commitment=False,
+            key_encipherment=isinstance(private_key, rsa.RSAPrivateKey),
+            data_encipherment=False,
+            key_agreement=False, key_cert_sign=False, crl_sign=False,
+            encipher_only=False, decipher_only=False),
+        critical=True
+    ).add_extension(
+        x509.ExtendedKeyUsage([
+            ExtendedKeyUsageOID.SERVER_AUTH,
+            ExtendedKeyUsageOID.CLIENT_AUTH]),
+        critical=False
+    ).add_extension(
+        x509.SubjectAlternativeName(alternative_names), critical=False
+    ).add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            ca_key.public_key()),
+        critical=False
+    ).sign(ca_key, get_signature_hash(ca_key), default_backend())
+
+    return get_certificate_pem(certificate) + get_private_key_pem(private_key)
@@ -1,33 +1,23 @@
 import logging
-from time import sleep
 
-from kubernetes import watch
-
-from .kubernetes_helpers import (list_cluster_mongodb_object,
-                                 create_admin_secret, create_monitoring_secret,
-                                 create_certificate_authority_secret,
-                                 create_client_certificate_secret,
-                                 delete_secret, create_service, delete_service,
+from .certificate_rotation import CERTIFICATE_ROTATIONS
+from .informers import (MONGODB_INFORMER, SERVICE_INFORMER,
+                        STATEFULSET_INFORMER, SECRET_INFORMER)
+from .kubernetes_resources import is_owned_by_mongodb
+from .mongodb_clients import close_mongo_client
+from .mongodb_helpers import get_replicas
+from .replicaset_status import REPLICASET_STATUS, REPLICASET_PROBES
+from .workqueue import WORK_QUEUE
+from .kubernetes_helpers import (provision_secrets, delete_secret,
+                                 create_service, delete_service,
                                  create_statefulset, delete_statefulset)
 
 
 def event_listener(shutting_down, timeout_seconds):
-    logging.info('thread started')
-    event_watch = watch.Watch()
-    while not shutting_down.isSet():
-        try:
-            for event in event_watch.stream(
-                    list_cluster_mongodb_object,
-                    _request_timeout=timeout_seconds):
-
-                event_switch(event)
-        except Exception as e:
-            # Last resort: catch all exceptions to keep the thread alive
-            logging.exception(e)
-            sleep(int(timeout_seconds))
-    else:
-        event_watch.stop()
-        logging.info('thread stopped')
+    # The MongoDB informer owns the watch and keeps the shared cache of
+    # cluster objects up to date, we only get notified about changes
+    MONGODB_INFORMER.add_handler(event_switch)
+    MONGODB_INFORMER.run(shutting_down, timeout_seconds)
 
 
 def event_switch(event):
@@ -39,43 +29,62 @@ def event_switch(event):
     event_type = event['type']
     cluster_object = event['object']
 
-    if event_type == 'ADDED':
-        add(cluster_object)
-    elif event_type == 'MODIFIED':
-        modify(cluster_object)
-    elif event_type == 'DELETED':
-        delete(cluster_object)
+    if event_type in ('ADDED', 'MODIFIED', 'DELETED'):
+        # Reconciliation happens on the worker threads, pending events for
+        # the same cluster collapse into one work item
+        name = cluster_object['metadata']['name']
+        namespace = cluster_object['metadata']['namespace']
+        WORK_QUEUE.add((namespace, name))
 
 
 def add(cluster_object):
-    # Cluster credentials
-    create_certificate_authority_secret(cluster_object)
-    create_client_certificate_secret(cluster_object)
-    create_admin_secret(cluster_object)
-    create_monitoring_secret(cluster_object)
+    # Returns whether all children were created, the work queue retries the
+    # cluster with backoff otherwise
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    # Cluster credentials, the informer knows which exist already
+    if not provision_secrets(
+            cluster_object, get_replicas(cluster_object),
+            SECRET_INFORMER.by_cluster(namespace, name)):
+        # Pods can't start without their certificates
+        return False
 
     # Create service
-    create_service(cluster_object)
+    created_service = create_service(cluster_object)
 
     # Create statefulset
-    create_statefulset(cluster_object)
+    created_statefulset = create_statefulset(cluster_object)
 
-
-def modify(cluster_object):
-    logging.warning('UPDATE NOT IMPLEMENTED YET')
+    return bool(created_service) and bool(created_statefulset)
 
 
 def delete(cluster_object):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
+
+    # Close the connection pool to the cluster's replica set and forget its
+    # last known status
+    close_mongo_client(namespace, name)
+    REPLICASET_STATUS.invalidate(namespace, name)
+    REPLICASET_PROBES.forget(namespace, name)
+    CERTIFICATE_ROTATIONS.release(namespace, name)
+
+    # Children with an owner reference to the cluster are removed by the
+    # kubernetes garbage collector, we only delete the ones created before
+    # the operator set owner references
+
     # Delete service
-    delete_service(name, namespace)
+    for service in SERVICE_INFORMER.by_cluster(namespace, name):
+        if not is_owned_by_mongodb(service):
+            delete_service(service.metadata.name, namespace)
 
     # Gracefully delete statefulset and pods
-    delete_statefulset(name, namespace)
+    for statefulset in STATEFULSET_INFORMER.by_cluster(namespace, name):
+        if not is_owned_by_mongodb(statefulset):
+            delete_statefulset(statefulset.metadata.name, namespace)
 
     # Delete cluster credentials
-    delete_secret('{}-ca'.format(name), namespace)
-    delete_secret('{}-client-certificate'.format(name), namespace)
-    delete_secret('{}-admin-credentials'.format(name), namespace)
-    delete_secret('{}-monitoring-credentials'.format(name), namespace)
+    for secret in SECRET_INFORMER.by_cluster(namespace, name):
+        if not is_owned_by_mongodb(secret):
+            delete_secret(secret.metadata.name, namespace)
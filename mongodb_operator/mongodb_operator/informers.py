@@ -0,0 +1,278 @@
+import logging
+import threading
+from functools import partial
+from time import sleep
+
+from kubernetes import client, watch
+from urllib3.exceptions import ReadTimeoutError, ProtocolError
+
+from .kubernetes_clients import (core_api, apps_api, get_api_client,
+                                 get_watch_api_client)
+from .kubernetes_resources import get_default_label_selector
+from .kubernetes_helpers import list_cluster_mongodb_object, list_all_pages
+
+
+def get_metadata(resource):
+    # Custom objects are returned as plain dicts, built-in kinds as models
+    if isinstance(resource, dict):
+        metadata = resource['metadata']
+        return (metadata.get('namespace'),
+                metadata.get('name'),
+                metadata.get('labels') or {})
+
+    metadata = resource.metadata
+    return (metadata.namespace, metadata.name, metadata.labels or {})
+
+
+def get_resource_version(resource):
+    if isinstance(resource, dict):
+        return resource.get('metadata', {}).get('resourceVersion')
+
+    return resource.metadata.resource_version
+
+
+def get_list_metadata(resource_list):
+    if isinstance(resource_list, dict):
+        return (resource_list['items'],
+                resource_list['metadata'].get('resourceVersion'))
+
+    return (resource_list.items, resource_list.metadata.resource_version)
+
+
+# An informer lists all resources of one kind once and then keeps its local
+# store up to date by watching for changes. Resources are indexed by
+# namespace/name and by their cluster label. Registered handlers receive every
+# change as a watch style event dict.
+class Informer(object):
+
+    def __init__(self, kind, list_func_factory, page_size=None,
+                 **list_kwargs):
+        self.kind = kind
+        # The api clients can only be created once the kubernetes config has
+        # been loaded, so we defer building the list function until needed.
+        # The factory is called with the api client to use.
+        self._list_func_factory = list_func_factory
+        self._list_kwargs = list_kwargs
+        # Custom objects can't be listed in pages with our client version
+        self.page_size = page_size
+
+        self._lock = threading.RLock()
+        self._store = {}
+        self._cluster_index = {}
+        self._handlers = []
+        self._resource_version = None
+        self._synced = threading.Event()
+
+    def add_handler(self, handler):
+        if handler not in self._handlers:
+            self._handlers.append(handler)
+
+    def has_synced(self):
+        return self._synced.is_set()
+
+    def wait_for_sync(self, timeout=None):
+        return self._synced.wait(timeout)
+
+    def get(self, namespace, name):
+        with self._lock:
+            return self._store.get((namespace, name))
+
+    def keys(self):
+        with self._lock:
+            return set(self._store.keys())
+
+    def list(self):
+        with self._lock:
+            return list(self._store.values())
+
+    def cluster_keys(self):
+        with self._lock:
+            return set(self._cluster_index.keys())
+
+    def by_cluster(self, namespace, cluster):
+        with self._lock:
+            keys = self._cluster_index.get((namespace, cluster), set())
+            return [self._store[key] for key in keys]
+
+    def _add_to_store(self, resource):
+        namespace, name, labels = get_metadata(resource)
+        key = (namespace, name)
+        self._remove_from_store(key)
+        self._store[key] = resource
+        if 'cluster' in labels:
+            index_key = (namespace, labels['cluster'])
+            self._cluster_index.setdefault(index_key, set()).add(key)
+
+    def _remove_from_store(self, key):
+        resource = self._store.pop(key, None)
+        if resource is None:
+            return None
+
+        namespace, name, labels = get_metadata(resource)
+        if 'cluster' in labels:
+            index_key = (namespace, labels['cluster'])
+            index = self._cluster_index.get(index_key, set())
+            index.discard(key)
+            if not index:
+                self._cluster_index.pop(index_key, None)
+        return resource
+
+    def _dispatch(self, event):
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                # A failing handler must not break the informer
+                logging.exception(e)
+
+    def relist(self):
+        list_func = self._list_func_factory(get_api_client())
+        if self.page_size:
+            items, resource_version = list_all_pages(
+                list_func, page_size=self.page_size, **self._list_kwargs)
+        else:
+            resource_list = list_func(**self._list_kwargs)
+            items, resource_version = get_list_metadata(resource_list)
+
+        # Only notify about what changed compared to our store, so that a
+        # relist does not replay every resource to the handlers
+        events = []
+        with self._lock:
+            previous_keys = set(self._store.keys())
+            for resource in items:
+                namespace, name, labels = get_metadata(resource)
+                key = (namespace, name)
+                previous = self._store.get(key)
+                previous_keys.discard(key)
+                self._add_to_store(resource)
+                if previous is None:
+                    events.append({'type': 'ADDED', 'object': resource})
+                elif (get_resource_version(previous) !=
+                        get_resource_version(resource)):
+                    events.append({'type': 'MODIFIED', 'object': resource})
+
+            for key in previous_keys:
+                resource = self._remove_from_store(key)
+                events.append({'type': 'DELETED', 'object': resource})
+
+            self._resource_version = resource_version
+            self._synced.set()
+
+        logging.debug('listed {} {}'.format(len(items), self.kind))
+        for event in events:
+            self._dispatch(event)
+
+    def handle_event(self, event):
+        if 'type' not in event or 'object' not in event:
+            logging.warning('malformed {} event: {}'.format(self.kind, event))
+            return
+
+        event_type = event['type']
+        resource = event['object']
+
+        if event_type == 'ERROR':
+            status = event.get('raw_object', resource)
+            if isinstance(status, dict) and status.get('code') == 410:
+                # Our resource version is too old to resume from, forget it
+                # so that the next iteration relists
+                logging.info('{} watch expired, relisting'.format(self.kind))
+                self._resource_version = None
+            else:
+                logging.warning('{} watch error: {}'.format(
+                    self.kind, status))
+            return
+
+        if event_type == 'BOOKMARK':
+            # Bookmarks only move the resource version we resume from
+            self._resource_version = get_resource_version(
+                event.get('raw_object', resource))
+            return
+
+        namespace, name, labels = get_metadata(resource)
+        with self._lock:
+            if event_type in ('ADDED', 'MODIFIED'):
+                self._add_to_store(resource)
+            elif event_type == 'DELETED':
+                self._remove_from_store((namespace, name))
+            else:
+                return
+            self._resource_version = get_resource_version(resource)
+
+        self._dispatch(event)
+
+    def watch(self, shutting_down, timeout_seconds):
+        # Watch streams use their own, uncompressed connection pool
+        list_func = self._list_func_factory(get_watch_api_client())
+        watch_kwargs = dict(self._list_kwargs)
+        if self._resource_version:
+            watch_kwargs['resource_version'] = self._resource_version
+
+        resource_watch = watch.Watch()
+        try:
+            for event in resource_watch.stream(
+                    list_func,
+                    _request_timeout=timeout_seconds,
+                    **watch_kwargs):
+
+                self.handle_event(event)
+                if shutting_down.isSet() or self._resource_version is None:
+                    resource_watch.stop()
+        except (ReadTimeoutError, ProtocolError) as e:
+            # The apiserver closing an idle watch is expected
+            logging.debug('{} watch ended: {}'.format(self.kind, e))
+
+    def run(self, shutting_down, timeout_seconds):
+        logging.info('thread started')
+        while not shutting_down.isSet():
+            try:
+                if self._resource_version is None:
+                    # Initial list or our resource version expired
+                    self.relist()
+                # Resume watching from the last resource version we saw
+                self.watch(shutting_down, timeout_seconds)
+            except client.rest.ApiException as e:
+                if e.status == 410:
+                    logging.info('{} watch expired, relisting'.format(
+                        self.kind))
+                    self._resource_version = None
+                else:
+                    logging.exception(e)
+                    sleep(int(timeout_seconds))
+            except Exception as e:
+                # Last resort: catch all exceptions to keep the thread alive
+                logging.exception(e)
+                sleep(int(timeout_seconds))
+        else:
+            logging.info('thread stopped')
+
+
+MONGODB_INFORMER = Informer(
+    'mongodbs',
+    lambda api_client: partial(
+        list_cluster_mongodb_object, api_client=api_client))
+
+SERVICE_INFORMER = Informer(
+    'services',
+    lambda api_client: core_api(api_client).list_service_for_all_namespaces,
+    page_size=500,
+    label_selector=get_default_label_selector())
+
+STATEFULSET_INFORMER = Informer(
+    'statefulsets',
+    lambda api_client: apps_api(
+        api_client).list_stateful_set_for_all_namespaces,
+    page_size=500,
+    label_selector=get_default_label_selector())
+
+SECRET_INFORMER = Informer(
+    'secrets',
+    lambda api_client: core_api(api_client).list_secret_for_all_namespaces,
+    page_size=500,
+    label_selector=get_default_label_selector())
+
+CHILD_INFORMERS = [SERVICE_INFORMER, STATEFULSET_INFORMER, SECRET_INFORMER]
+
+
+def informers_synced():
+    return all(informer.has_synced()
+               for informer in [MONGODB_INFORMER] + CHILD_INFORMERS)
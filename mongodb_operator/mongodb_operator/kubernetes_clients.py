@@ -0,0 +1,78 @@
+import socket
+import threading
+
+from kubernetes import client
+from kubernetes.client import Configuration
+from urllib3.connection import HTTPConnection
+
+from .rate_limiter import RateLimitedApiClient
+
+
+DEFAULT_POOL_SIZE = 8
+
+_api_client = None
+_watch_api_client = None
+_exec_clients = threading.local()
+
+
+def enable_tcp_keepalive():
+    # Keep idle pooled connections to the apiserver alive instead of having
+    # them silently dropped and paying for a new TCP and TLS handshake
+    keepalive = (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if keepalive not in HTTPConnection.default_socket_options:
+        HTTPConnection.default_socket_options = \
+            HTTPConnection.default_socket_options + [keepalive]
+
+
+def new_api_client(pool_size=DEFAULT_POOL_SIZE):
+    # Configuration() returns a copy of the default set by the operator
+    configuration = Configuration()
+    configuration.connection_pool_maxsize = pool_size
+    return RateLimitedApiClient(configuration)
+
+
+def configure_api_clients(pool_size=DEFAULT_POOL_SIZE, watch_pool_size=4):
+    global _api_client
+    global _watch_api_client
+
+    enable_tcp_keepalive()
+
+    _api_client = new_api_client(pool_size)
+    # Regular responses are decoded by urllib3, so we can let the apiserver
+    # compress them. Watch streams are read raw and must not be compressed.
+    _api_client.set_default_header('Accept-Encoding', 'gzip')
+
+    _watch_api_client = new_api_client(watch_pool_size)
+
+
+def get_api_client():
+    if _api_client is None:
+        configure_api_clients()
+    return _api_client
+
+
+def get_watch_api_client():
+    if _watch_api_client is None:
+        configure_api_clients()
+    return _watch_api_client
+
+
+def core_api(api_client=None):
+    return client.CoreV1Api(api_client or get_api_client())
+
+
+def apps_api(api_client=None):
+    return client.AppsV1beta1Api(api_client or get_api_client())
+
+
+def custom_objects_api(api_client=None):
+    return client.CustomObjectsApi(api_client or get_api_client())
+
+
+def exec_api():
+    # kubernetes.stream.stream temporarily replaces the request method of the
+    # api client it is called with, so exec calls can't use the shared client
+    # while other threads make requests through it. Each thread gets its own.
+    if not hasattr(_exec_clients, 'core_api'):
+        _exec_clients.core_api = client.CoreV1Api(new_api_client(1))
+    return _exec_clients.core_api
@@ -1,19 +1,23 @@
 import logging
-import json
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from base64 import b64decode
+from functools import lru_cache
 
-import delegator
 from kubernetes import client
 from xkcdpass.xkcd_password import generate_wordlist, generate_xkcdpassword
 
+from .certificates import (get_certificate_authority, get_client_certificate,
+                           get_member_certificate, get_key_algorithm)
+from .kubernetes_clients import (core_api, apps_api, custom_objects_api,
+                                 get_api_client)
 from .kubernetes_resources import (get_default_label_selector,
                                    get_service_object, get_statefulset_object,
-                                   get_secret_object)
+                                   get_secret_object, FINALIZER)
 
 
-def list_cluster_mongodb_object(**kwargs):
-    custom_object_api = client.CustomObjectsApi()
+def list_cluster_mongodb_object(api_client=None, **kwargs):
+    custom_object_api = custom_objects_api(api_client)
     cluster_list = custom_object_api.list_cluster_custom_object(
         'kubestack.com',
         'v1',
@@ -22,224 +26,333 @@ def list_cluster_mongodb_object(**kwargs):
     return cluster_list
 
 
-def get_namespaced_mongodb_object(name, namespace):
-    custom_object_api = client.CustomObjectsApi()
-    cluster = custom_object_api.get_namespaced_custom_object(
+def list_all_pages(list_func, page_size=500, **kwargs):
+    # Fetch a large list in chunks using limit/continue, so that neither the
+    # apiserver nor we have to hold one huge response in memory
+    items = []
+    kwargs['limit'] = page_size
+    while True:
+        resource_list = list_func(**kwargs)
+        items.extend(resource_list.items)
+        if not resource_list.metadata._continue:
+            return items, resource_list.metadata.resource_version
+        kwargs['_continue'] = resource_list.metadata._continue
+
+
+def replace_namespaced_mongodb_object(name, namespace, body):
+    custom_object_api = custom_objects_api()
+    cluster = custom_object_api.replace_namespaced_custom_object(
         'kubestack.com',
         'v1',
         namespace,
         'mongodbs',
-        name)
+        name,
+        body)
     return cluster
 
 
-def get_random_password():
-    wordlist = generate_wordlist()
-    pw = generate_xkcdpassword(wordlist, delimiter='-')
-    return pw
-
-
-def create_admin_secret(cluster_object):
+def patch_namespaced_mongodb_object(name, namespace, body, subresource=''):
+    # The custom objects api of the client can neither patch nor reach the
+    # status subresource, so we call the endpoint directly
+    path = '/apis/kubestack.com/v1/namespaces/{namespace}/mongodbs/{name}'
+    return get_api_client().call_api(
+        path + subresource,
+        'PATCH',
+        path_params={'namespace': namespace, 'name': name},
+        header_params={
+            'Accept': 'application/json',
+            'Content-Type': 'application/merge-patch+json'},
+        body=body,
+        response_type='object',
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True)
+
+
+def set_mongodb_status(cluster_object, status):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-
-    # Check if secret already exists
-    if read_secret('{}-admin-credentials'.format(name), namespace):
-        return False
-
-    v1 = client.CoreV1Api()
-    body = get_secret_object(
-        cluster_object,
-        '-admin-credentials',
-        {'username': 'root', 'password': get_random_password()})
+    body = {'status': status}
     try:
-        secret = v1.create_namespaced_secret(namespace, body)
+        try:
+            cluster = patch_namespaced_mongodb_object(
+                name, namespace, body, subresource='/status')
+        except client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            # Without the status subresource the status is part of the object
+            cluster = patch_namespaced_mongodb_object(name, namespace, body)
     except client.rest.ApiException as e:
-        if e.status == 409:
-            # Secret already exists
+        if e.status == 404:
             logging.debug(
-                'secret/{}-admin-credentials in ns/{} already exists'.format(
+                'mongodb/{} in ns/{} gone, not updating status'.format(
                     name, namespace))
         else:
             logging.exception(e)
         return False
     else:
-        logging.info('created secret/{}-admin-credentials in ns/{}'.format(
-            name, namespace))
-        return secret
+        logging.info('mongodb/{} in ns/{} status {}'.format(
+            name, namespace, status))
+        return cluster
 
 
-def create_monitoring_secret(cluster_object):
+def set_mongodb_finalizers(cluster_object, finalizers):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-
-    # Check if secret already exists
-    if read_secret('{}-monitoring-credentials'.format(name), namespace):
-        return False
-
-    v1 = client.CoreV1Api()
-    body = get_secret_object(
-        cluster_object,
-        '-monitoring-credentials',
-        {'username': 'monitoring', 'password': get_random_password()})
+    # The resource version in the body makes the apiserver reject the update
+    # if someone else changed the object in the meantime
+    body = deepcopy(cluster_object)
+    body['metadata']['finalizers'] = finalizers
     try:
-        secret = v1.create_namespaced_secret(namespace, body)
+        cluster = replace_namespaced_mongodb_object(name, namespace, body)
     except client.rest.ApiException as e:
-        if e.status == 409:
-            # Secret already exists
-            msg = 'secret/{}-monitoring-credentials in ns/{} already exists'
-            logging.debug(msg.format(name, namespace))
+        if e.status in (404, 409):
+            logging.debug(
+                'mongodb/{} in ns/{} changed, not updating finalizers'.format(
+                    name, namespace))
         else:
             logging.exception(e)
         return False
     else:
-        msg = 'created secret/{}-monitoring-credentials in ns/{}'
-        logging.info(msg.format(name, namespace))
-        return secret
+        return cluster
 
 
-def get_certificate_authority(name, namespace, suffix='svc.cluster.local'):
-    common_name = '{}.{}.{}'.format(name, namespace, suffix)
-    ca_csr = {
-        'CN': common_name,
-        'key': {
-            'algo': 'rsa',
-            'size': 2048
-        },
-        'names': [{
-            'O': common_name
-        }]}
+def add_finalizer(cluster_object):
+    finalizers = cluster_object['metadata'].get('finalizers') or []
+    if FINALIZER in finalizers:
+        return cluster_object
 
-    with NamedTemporaryFile() as ca_csr_file:
-        ca_csr_json = json.dumps(ca_csr).encode('utf-8')
-        ca_csr_file.write(ca_csr_json + b'\n')
-        ca_csr_file.flush()
-        cmd = './cfssl genkey -initca {}'.format(ca_csr_file.name)
-        c = delegator.run(cmd)
+    cluster = set_mongodb_finalizers(cluster_object, finalizers + [FINALIZER])
+    if cluster:
+        logging.info('added finalizer to mongodb/{} in ns/{}'.format(
+            cluster_object['metadata']['name'],
+            cluster_object['metadata']['namespace']))
+    return cluster
 
-    if not c.out:
-        logging.error('cfssl {}'.format(c.err))
 
-    r = json.loads(c.out)
-    return r['cert'], r['key'], r['csr']
+def remove_finalizer(cluster_object):
+    finalizers = cluster_object['metadata'].get('finalizers') or []
+    if FINALIZER not in finalizers:
+        return cluster_object
 
+    cluster = set_mongodb_finalizers(
+        cluster_object, [f for f in finalizers if f != FINALIZER])
+    if cluster:
+        logging.info('removed finalizer from mongodb/{} in ns/{}'.format(
+            cluster_object['metadata']['name'],
+            cluster_object['metadata']['namespace']))
+    return cluster
+
+
+# Builds and creates the secrets of new clusters in parallel, generating
+# keys releases the GIL
+_secret_executor = ThreadPoolExecutor(4)
+
+
+@lru_cache(maxsize=1)
+def get_wordlist():
+    # Reading the wordlist from disk once is enough for all passwords
+    return generate_wordlist()
+
+
+def get_random_password():
+    pw = generate_xkcdpassword(get_wordlist(), delimiter='-')
+    return pw
+
+
+def get_member_certificates(cluster_object, ca_pem, ca_key_pem, members):
+    # Returns the secret data of the members' certificates, keyed by pod name
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    key_algorithm = get_key_algorithm(cluster_object)
 
-def create_certificate_authority_secret(cluster_object):
+    return dict(
+        ('{}.pem'.format(member), get_member_certificate(
+            name, namespace, member, ca_pem, ca_key_pem,
+            key_algorithm=key_algorithm))
+        for member in members)
+
+
+def get_member_names(name, replicas):
+    return ['{}-{}'.format(name, member_id) for member_id in range(replicas)]
+
+
+def get_member_certificates_secret_data(cluster_object, ca_pem, ca_key_pem,
+                                        replicas):
+    # The certificates of all members and the CA that signed them
+    name = cluster_object['metadata']['name']
+    string_data = get_member_certificates(
+        cluster_object, ca_pem, ca_key_pem, get_member_names(name, replicas))
+    string_data['ca.pem'] = ca_pem.decode('utf-8')
+    return string_data
+
+
+def create_member_certificates_secret(cluster_object, replicas):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
 
-    # Check if secret already exists
-    if read_secret('{}-ca'.format(name), namespace):
+    ca_secret = read_secret('{}-ca'.format(name), namespace)
+    if not ca_secret:
         return False
+    string_data = get_member_certificates_secret_data(
+        cluster_object,
+        b64decode(ca_secret.data['ca.pem']),
+        b64decode(ca_secret.data['ca-key.pem']),
+        replicas)
+    return create_secret(cluster_object, '-member-certificates', string_data)
+
+
+def update_member_certificates_secret(cluster_object, secret, replicas,
+                                      renew=()):
+    # Adds the certificates of members the secret has none for yet, e.g.
+    # when the cluster is scaled up, and reissues the ones of the members
+    # in renew
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    missing = [member for member in get_member_names(name, replicas)
+               if '{}.pem'.format(member) not in (secret.data or {})]
+    missing += [member for member in renew if member not in missing]
+    if not missing:
+        return secret
 
-    v1 = client.CoreV1Api()
-    cert_pem, key_pem, csr_pem = get_certificate_authority(name, namespace)
-    body = get_secret_object(
+    v1 = core_api()
+    ca_secret = read_secret('{}-ca'.format(name), namespace)
+    body = {'stringData': get_member_certificates(
         cluster_object,
-        '-ca',
-        {'ca.pem': cert_pem, 'ca-key.pem': key_pem})
+        b64decode(ca_secret.data['ca.pem']),
+        b64decode(ca_secret.data['ca-key.pem']),
+        missing)}
     try:
-        secret = v1.create_namespaced_secret(namespace, body)
+        secret = v1.patch_namespaced_secret(
+            '{}-member-certificates'.format(name), namespace, body)
     except client.rest.ApiException as e:
-        if e.status == 409:
-            # Secret already exists
-            logging.debug('secret/{}-ca in ns/{} already exists'.format(
-                name, namespace))
-        else:
-            logging.exception(e)
+        logging.exception(e)
         return False
     else:
-        logging.info('created secret/{}-ca in ns/{}'.format(name, namespace))
+        logging.info(
+            'updated secret/{}-member-certificates in ns/{}'.format(
+                name, namespace))
         return secret
 
 
-def get_client_certificate(name, namespace, ca_pem, ca_key_pem):
-    common_name = '{}-client'.format(name)
-    client_csr = {
-        'CN': common_name,
-        'hosts': [],
-        'key': {
-            'algo': 'rsa',
-            'size': 2048
-        },
-        'names': [{
-            'O': common_name
-        }]
-    }
-
-    ca_file = NamedTemporaryFile(delete=False)
-    ca_key_file = NamedTemporaryFile(delete=False)
-    client_csr_file = NamedTemporaryFile(delete=False)
-
-    ca_file.write(ca_pem)
-    ca_file.flush()
-    ca_key_file.write(ca_key_pem)
-    ca_key_file.flush()
-    client_csr_json = json.dumps(client_csr).encode('utf-8')
-    client_csr_file.write(client_csr_json + b'\n')
-    client_csr_file.flush()
-
-    cmd = '''./cfssl gencert \
-             -ca={} \
-             -ca-key={} \
-             -config=ca-config.json \
-             -profile=client {}'''.format(
-                ca_file.name,
-                ca_key_file.name,
-                client_csr_file.name)
-
-    c = delegator.run(cmd)
-
-    ca_file.close()
-    ca_key_file.close()
-    client_csr_file.close()
-
-    if not c.out:
-        logging.error('cfssl {}'.format(c.err))
-
-    r = json.loads(c.out)
-
-    mongod_pem = r['cert'] + r['key']
-    return mongod_pem, r['csr']
-
-
-def create_client_certificate_secret(cluster_object):
+def renew_client_certificate_secret(cluster_object):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
 
-    # Check if secret already exists
-    if read_secret('{}-client-certificate'.format(name), namespace):
+    v1 = core_api()
+    ca_secret = read_secret('{}-ca'.format(name), namespace)
+    mongod_pem = get_client_certificate(
+        name, namespace,
+        b64decode(ca_secret.data['ca.pem']),
+        b64decode(ca_secret.data['ca-key.pem']),
+        key_algorithm=get_key_algorithm(cluster_object))
+    body = {'stringData': {'mongod.pem': mongod_pem}}
+    try:
+        secret = v1.patch_namespaced_secret(
+            '{}-client-certificate'.format(name), namespace, body)
+    except client.rest.ApiException as e:
+        logging.exception(e)
         return False
+    else:
+        logging.info('renewed secret/{}-client-certificate in ns/{}'.format(
+            name, namespace))
+        return secret
 
-    v1 = client.CoreV1Api()
-    ca_secret = read_secret('{}-ca'.format(name), namespace)
-    ca_pem = b64decode(ca_secret.data['ca.pem'])
-    ca_key_pem = b64decode(ca_secret.data['ca-key.pem'])
-    mongod_pem, csr_pem = get_client_certificate(
-        name, namespace, ca_pem, ca_key_pem)
-    body = get_secret_object(
-        cluster_object,
-        '-client-certificate',
-        {'mongod.pem': mongod_pem, 'ca.pem': ca_pem.decode('utf-8')})
+
+def create_secret(cluster_object, name_suffix, string_data):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    v1 = core_api()
+    body = get_secret_object(cluster_object, name_suffix, string_data)
     try:
         secret = v1.create_namespaced_secret(namespace, body)
     except client.rest.ApiException as e:
         if e.status == 409:
             # Secret already exists
-            logging.debug(
-                'secret/{}-client-certificate in ns/{} already exists'.format(
-                    name, namespace))
+            logging.debug('secret/{}{} in ns/{} already exists'.format(
+                name, name_suffix, namespace))
         else:
             logging.exception(e)
         return False
     else:
-        logging.info('created secret/{}-client-certificate in ns/{}'.format(
-            name, namespace))
+        logging.info('created secret/{}{} in ns/{}'.format(
+            name, name_suffix, namespace))
         return secret
 
 
+def list_cluster_secrets(name, namespace):
+    # One labelled list instead of a read per secret
+    v1 = core_api()
+    return v1.list_namespaced_secret(
+        namespace, label_selector=get_default_label_selector(name=name)).items
+
+
+def provision_secrets(cluster_object, replicas, secrets=None):
+    # Creates the missing credentials of a cluster and returns whether all
+    # of them exist. secrets are the ones the cluster already has, e.g. from
+    # the informer, without them they are listed.
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    if secrets is None:
+        try:
+            secrets = list_cluster_secrets(name, namespace)
+        except client.rest.ApiException as e:
+            logging.exception(e)
+            return False
+    existing = dict((secret.metadata.name, secret) for secret in secrets)
+
+    def is_missing(name_suffix):
+        return '{}{}'.format(name, name_suffix) not in existing
+
+    # Everything is built at once, only the certificates have to wait for
+    # the CA that signs them
+    futures = {}
+    if is_missing('-admin-credentials'):
+        futures['-admin-credentials'] = _secret_executor.submit(
+            lambda: {'username': 'root', 'password': get_random_password()})
+    if is_missing('-monitoring-credentials'):
+        futures['-monitoring-credentials'] = _secret_executor.submit(
+            lambda: {'username': 'monitoring',
+                     'password': get_random_password()})
+
+    key_algorithm = get_key_algorithm(cluster_object)
+    ca_secret = existing.get('{}-ca'.format(name))
+    if ca_secret is None:
+        cert_pem, key_pem = get_certificate_authority(
+            name, namespace, key_algorithm=key_algorithm)
+        ca_pem = cert_pem.encode('utf-8')
+        ca_key_pem = key_pem.encode('utf-8')
+    else:
+        ca_pem = b64decode(ca_secret.data['ca.pem'])
+        ca_key_pem = b64decode(ca_secret.data['ca-key.pem'])
+
+    if is_missing('-client-certificate'):
+        futures['-client-certificate'] = _secret_executor.submit(
+            lambda: {'mongod.pem': get_client_certificate(
+                         name, namespace, ca_pem, ca_key_pem,
+                         key_algorithm=key_algorithm),
+                     'ca.pem': ca_pem.decode('utf-8')})
+    if is_missing('-member-certificates'):
+        futures['-member-certificates'] = _secret_executor.submit(
+            get_member_certificates_secret_data,
+            cluster_object, ca_pem, ca_key_pem, replicas)
+
+    # Certificates signed by a CA that didn't make it would be useless
+    if ca_secret is None and not create_secret(
+            cluster_object, '-ca',
+            {'ca.pem': cert_pem, 'ca-key.pem': key_pem}):
+        return False
+
+    created = [
+        _secret_executor.submit(
+            create_secret, cluster_object, name_suffix, future.result())
+        for name_suffix, future in sorted(futures.items())]
+    return all(future.result() for future in created)
+
+
 def read_secret(name, namespace):
-    v1 = client.CoreV1Api()
+    v1 = core_api()
     try:
         secret = v1.read_namespaced_secret(name, namespace)
     except client.rest.ApiException as e:
@@ -254,7 +367,7 @@ def read_secret(name, namespace):
 
 
 def delete_secret(name, namespace, delete_options=None):
-    v1 = client.CoreV1Api()
+    v1 = core_api()
     if not delete_options:
         delete_options = client.V1DeleteOptions()
     try:
@@ -267,10 +380,27 @@ def delete_secret(name, namespace, delete_options=None):
         return True
 
 
+def delete_pod(name, namespace):
+    v1 = core_api()
+    try:
+        v1.delete_namespaced_pod(name, namespace, client.V1DeleteOptions())
+    except client.rest.ApiException as e:
+        if e.status == 404:
+            # Pod is gone already
+            logging.debug('pod/{} in ns/{} does not exist'.format(
+                name, namespace))
+            return True
+        logging.exception(e)
+        return False
+    else:
+        logging.info('deleted pod/{} from ns/{}'.format(name, namespace))
+        return True
+
+
 def create_service(cluster_object):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-    v1 = client.CoreV1Api()
+    v1 = core_api()
     body = get_service_object(cluster_object)
     try:
         service = v1.create_namespaced_service(namespace, body)
@@ -290,7 +420,7 @@ def create_service(cluster_object):
 def update_service(cluster_object):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-    v1 = client.CoreV1Api()
+    v1 = core_api()
     body = get_service_object(cluster_object)
     try:
         service = v1.patch_namespaced_service(name, namespace, body)
@@ -303,7 +433,7 @@ def update_service(cluster_object):
 
 
 def delete_service(name, namespace):
-    v1 = client.CoreV1Api()
+    v1 = core_api()
     try:
         v1.delete_namespaced_service(name, namespace)
     except client.rest.ApiException as e:
@@ -314,11 +444,11 @@ def delete_service(name, namespace):
         return True
 
 
-def create_statefulset(cluster_object):
+def create_statefulset(cluster_object, replicas=None):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-    appsv1beta1api = client.AppsV1beta1Api()
-    body = get_statefulset_object(cluster_object)
+    appsv1beta1api = apps_api()
+    body = get_statefulset_object(cluster_object, replicas)
     try:
         statefulset = appsv1beta1api.create_namespaced_stateful_set(
             namespace, body)
@@ -335,11 +465,15 @@ def create_statefulset(cluster_object):
         return statefulset
 
 
-def update_statefulset(cluster_object):
+def update_statefulset(cluster_object, replicas=None,
+                       keep_volume_claim_templates=False):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-    appsv1beta1api = client.AppsV1beta1Api()
-    body = get_statefulset_object(cluster_object)
+    appsv1beta1api = apps_api()
+    body = get_statefulset_object(cluster_object, replicas)
+    if keep_volume_claim_templates:
+        # Left out of the patch, the existing claims stay as they are
+        body.spec.volume_claim_templates = None
     try:
         statefulset = appsv1beta1api.patch_namespaced_stateful_set(
             name, namespace, body)
@@ -351,13 +485,28 @@ def update_statefulset(cluster_object):
         return statefulset
 
 
+def orphan_statefulset(cluster_object, volume_claim_templates):
+    # Deletes the statefulset but not its pods, so it can be created again
+    # with other volume claim templates. The new statefulset adopts the
+    # running pods, they only get the new volumes when they are deleted.
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    logging.warning(
+        'replacing statefulset/{} in ns/{} to add or remove the volumes {}, '
+        'its pods keep running. Delete them one at a time, primary last, to '
+        'move the members onto the new volumes, each member resyncs from the '
+        'others.'.format(name, namespace, ', '.join(volume_claim_templates)))
+    delete_options = client.V1DeleteOptions(propagation_policy='Orphan')
+    return delete_statefulset(name, namespace, delete_options)
+
+
 def delete_statefulset(name, namespace, delete_options=None):
-    apps_api = client.AppsV1beta1Api()
+    apps_v1beta1_api = apps_api()
     if not delete_options:
         delete_options = client.V1DeleteOptions(
             propagation_policy='Background')
     try:
-        apps_api.delete_namespaced_stateful_set(
+        apps_v1beta1_api.delete_namespaced_stateful_set(
             name, namespace, delete_options)
     except client.rest.ApiException as e:
         if e.status == 404:
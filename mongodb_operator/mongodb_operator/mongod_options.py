@@ -0,0 +1,172 @@
+import re
+
+
+GIB = 1024 ** 3
+MIB = 1024 ** 2
+
+QUANTITY_SUFFIXES = {
+    'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3, 'Ti': 1024 ** 4,
+    'Pi': 1024 ** 5, 'Ei': 1024 ** 6,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12,
+    'P': 10 ** 15, 'E': 10 ** 18,
+    'm': 10 ** -3, '': 1}
+QUANTITY_RE = re.compile(
+    r'^(?P<number>[0-9]+(\.[0-9]*)?|\.[0-9]+)'
+    r'(?P<suffix>Ki|Mi|Gi|Ti|Pi|Ei|k|M|G|T|P|E|m|)$')
+EXPONENT_RE = re.compile(
+    r'^(?P<number>[0-9.]+)[eE](?P<exponent>[+-]?[0-9]+)$')
+
+# mongod refuses smaller caches
+MIN_WIREDTIGER_CACHE_SIZE_GB = 0.25
+# mongod's default for index builds, less if the container has little memory
+MAX_INDEX_BUILD_MEMORY_MB = 500
+MIN_INDEX_BUILD_MEMORY_MB = 100
+
+NETWORK_COMPRESSORS = ('snappy', 'zlib')
+BLOCK_COMPRESSORS = ('none', 'snappy', 'zlib')
+# The operator bootstraps replica sets through the localhost exception
+RESERVED_PARAMETERS = ('enableLocalhostAuthBypass',)
+
+
+def parse_memory_quantity(quantity):
+    # Returns the number of bytes of a kubernetes memory quantity, e.g. 64Mi
+    if isinstance(quantity, (int, float)):
+        return quantity
+
+    quantity = str(quantity).strip()
+    match = EXPONENT_RE.match(quantity)
+    if match:
+        return float(match.group('number')) * 10 ** int(
+            match.group('exponent'))
+
+    match = QUANTITY_RE.match(quantity)
+    if not match:
+        raise ValueError('invalid memory quantity: {}'.format(quantity))
+    return float(match.group('number')) * \
+        QUANTITY_SUFFIXES[match.group('suffix')]
+
+
+def get_wiredtiger_cache_size_gb(cluster_object):
+    # Like mongod's own default, half of the memory minus 1 GiB, but from the
+    # container limit instead of the RAM of the host
+    mongodb = cluster_object.get('spec', {}).get('mongodb', {})
+    if mongodb.get('wiredtiger_cache_size_gb') is not None:
+        return max(float(mongodb['wiredtiger_cache_size_gb']),
+                   MIN_WIREDTIGER_CACHE_SIZE_GB)
+
+    limit = parse_memory_quantity(mongodb.get('mongodb_limit_memory', '64Mi'))
+    cache_size_gb = 0.5 * (limit - GIB) / GIB
+    return round(max(cache_size_gb, MIN_WIREDTIGER_CACHE_SIZE_GB), 2)
+
+
+def get_max_index_build_memory_mb(cluster_object):
+    # Index builds get a tenth of the container limit at most
+    mongodb = cluster_object.get('spec', {}).get('mongodb', {})
+    if mongodb.get('max_index_build_memory_mb') is not None:
+        return int(mongodb['max_index_build_memory_mb'])
+
+    limit = parse_memory_quantity(mongodb.get('mongodb_limit_memory', '64Mi'))
+    return int(min(MAX_INDEX_BUILD_MEMORY_MB,
+                   max(limit / 10 / MIB, MIN_INDEX_BUILD_MEMORY_MB)))
+
+
+def get_memory_args(cluster_object):
+    return [
+        '--wiredTigerCacheSizeGB',
+        str(get_wiredtiger_cache_size_gb(cluster_object))]
+
+
+def get_positive_int(tuning, key):
+    value = tuning[key]
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(
+            'tuning.{} must be a positive integer, not {!r}'.format(
+                key, value))
+    return value
+
+
+def format_parameter_value(key, value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float, str)):
+        return str(value)
+    raise ValueError(
+        'tuning.set_parameter.{} must be a string, number or boolean, '
+        'not {!r}'.format(key, value))
+
+
+def get_tuning_args(cluster_object):
+    # Validates spec.mongodb.tuning and turns it into mongod options, raises
+    # ValueError for anything mongod would not start with
+    mongodb = cluster_object.get('spec', {}).get('mongodb', {})
+    tuning = mongodb.get('tuning') or {}
+    if not isinstance(tuning, dict):
+        raise ValueError('tuning must be an object')
+
+    unknown = set(tuning) - set([
+        'oplog_size_mb', 'network_compressors', 'wiredtiger_block_compressor',
+        'max_incoming_connections', 'slowms', 'set_parameter'])
+    if unknown:
+        raise ValueError('unknown tuning options: {}'.format(
+            ', '.join(sorted(unknown))))
+
+    args = []
+    if 'oplog_size_mb' in tuning:
+        # Only applies when the oplog is created on a new member
+        args += ['--oplogSize', str(get_positive_int(tuning, 'oplog_size_mb'))]
+
+    if 'network_compressors' in tuning:
+        compressors = tuning['network_compressors']
+        if isinstance(compressors, str):
+            compressors = [compressors]
+        if not all(c in NETWORK_COMPRESSORS for c in compressors):
+            raise ValueError(
+                'tuning.network_compressors must be a list of {}'.format(
+                    ', '.join(NETWORK_COMPRESSORS)))
+        args += ['--networkMessageCompressors',
+                 ','.join(compressors) if compressors else 'disabled']
+
+    if 'wiredtiger_block_compressor' in tuning:
+        compressor = tuning['wiredtiger_block_compressor']
+        if compressor not in BLOCK_COMPRESSORS:
+            raise ValueError(
+                'tuning.wiredtiger_block_compressor must be one of {}'.format(
+                    ', '.join(BLOCK_COMPRESSORS)))
+        args += ['--wiredTigerCollectionBlockCompressor', compressor]
+
+    if 'max_incoming_connections' in tuning:
+        args += ['--maxConns', str(
+            get_positive_int(tuning, 'max_incoming_connections'))]
+
+    if 'slowms' in tuning:
+        args += ['--slowms', str(get_positive_int(tuning, 'slowms'))]
+
+    return args
+
+
+def get_set_parameters(cluster_object):
+    mongodb = cluster_object.get('spec', {}).get('mongodb', {})
+    set_parameter = (mongodb.get('tuning') or {}).get('set_parameter') or {}
+    if not isinstance(set_parameter, dict):
+        raise ValueError('tuning.set_parameter must be an object')
+
+    # Parameters from the spec win over the ones the operator derives
+    parameters = {
+        'maxIndexBuildMemoryUsageMegabytes':
+            get_max_index_build_memory_mb(cluster_object)}
+    parameters.update(set_parameter)
+
+    args = []
+    for key, value in sorted(parameters.items()):
+        if not key or '=' in key or key in RESERVED_PARAMETERS:
+            raise ValueError(
+                'invalid tuning.set_parameter name: {!r}'.format(key))
+        args += ['--setParameter', '{}={}'.format(
+            key, format_parameter_value(key, value))]
+    return args
+
+
+def get_mongod_args(cluster_object):
+    return (get_memory_args(cluster_object) +
+            get_tuning_args(cluster_object) +
+            get_set_parameters(cluster_object))
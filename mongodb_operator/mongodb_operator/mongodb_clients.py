@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+from base64 import b64decode
+from tempfile import NamedTemporaryFile
+
+from pymongo import MongoClient
+
+from .informers import SECRET_INFORMER
+from .kubernetes_helpers import read_secret
+
+
+MONGODB_PORT = 27017
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def get_cluster_secret(name, namespace, suffix):
+    secret_name = '{}{}'.format(name, suffix)
+    return SECRET_INFORMER.get(namespace, secret_name) or \
+        read_secret(secret_name, namespace)
+
+
+def write_temporary_file(data):
+    with NamedTemporaryFile('wb', suffix='.pem', delete=False) as pem_file:
+        pem_file.write(data)
+    return pem_file.name
+
+
+class ClusterClient(object):
+    # One pooled driver connection to a cluster, authenticated as the admin
+    # user over TLS with the operator's client certificate. The driver needs
+    # the certificates as files, they live as long as the client.
+
+    def __init__(self, host, certificate_secret, admin_secret):
+        self.host = host
+        self.versions = (
+            certificate_secret.metadata.resource_version,
+            admin_secret.metadata.resource_version)
+
+        self._files = [
+            write_temporary_file(
+                b64decode(certificate_secret.data['mongod.pem'])),
+            write_temporary_file(
+                b64decode(certificate_secret.data['ca.pem']))]
+
+        self.client = MongoClient(
+            host=host,
+            port=MONGODB_PORT,
+            directConnection=True,
+            tls=True,
+            tlsCertificateKeyFile=self._files[0],
+            tlsCAFile=self._files[1],
+            username=b64decode(
+                admin_secret.data['username']).decode('utf-8'),
+            password=b64decode(
+                admin_secret.data['password']).decode('utf-8'),
+            authSource='admin',
+            maxPoolSize=4,
+            connectTimeoutMS=5000,
+            serverSelectionTimeoutMS=5000,
+            connect=False)
+
+    def close(self):
+        self.client.close()
+        for path in self._files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_mongo_client(cluster_object, host):
+    # Returns the cached client for the cluster, a new one if the host or
+    # the secrets changed, or None if the secrets don't exist yet
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    certificate_secret = get_cluster_secret(
+        name, namespace, '-client-certificate')
+    admin_secret = get_cluster_secret(
+        name, namespace, '-admin-credentials')
+    if not certificate_secret or not admin_secret:
+        return None
+
+    versions = (
+        certificate_secret.metadata.resource_version,
+        admin_secret.metadata.resource_version)
+
+    with _lock:
+        cluster_client = _clients.get((namespace, name))
+        if cluster_client and cluster_client.host == host and \
+           cluster_client.versions == versions:
+            return cluster_client.client
+
+        if cluster_client:
+            cluster_client.close()
+
+        logging.debug('connecting to {} in ns/{}'.format(name, namespace))
+        cluster_client = ClusterClient(host, certificate_secret, admin_secret)
+        _clients[(namespace, name)] = cluster_client
+        return cluster_client.client
+
+
+def close_mongo_client(namespace, name):
+    with _lock:
+        cluster_client = _clients.pop((namespace, name), None)
+
+    if cluster_client:
+        cluster_client.close()
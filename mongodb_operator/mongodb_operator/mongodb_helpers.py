@@ -1,34 +1,51 @@
 import logging
 import json
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 
-from kubernetes.client.apis import core_v1_api
+from kubernetes.client.rest import ApiException
 from kubernetes.stream import stream
+from pymongo.errors import AutoReconnect, PyMongoError
 
-from .kubernetes_helpers import read_secret
+from .informers import STATEFULSET_INFORMER
+from .kubernetes_clients import exec_api
+from .kubernetes_helpers import read_secret, set_mongodb_status
+from .mongodb_clients import get_mongo_client
+from .replicaset_status import (ReplicaSetStatus, REPLICASET_STATUS,
+                                REPLICASET_PROBES, PHASE_INITIALIZED,
+                                PHASE_USERS_CREATED, get_phase,
+                                parse_shell_json, NODE_NOT_FOUND, NOT_MASTER,
+                                PRIMARY, SECONDARY, ARBITER)
 
 
 DNS_SUFFIX = 'svc.cluster.local'
 
+# Shared by all reconcile workers to probe replica set members in parallel.
+# The threads are kept around, so their exec api clients can be reused.
+_probe_executor = ThreadPoolExecutor(max_workers=8)
+
+# A replica set can have at most seven voting members
+MAX_VOTING_MEMBERS = 7
+
 
 def get_member_hostname(member_id, cluster_name, namespace, dns_suffix):
     return '{}-{}.{}.{}.{}'.format(
         cluster_name, member_id, cluster_name, namespace, dns_suffix)
 
 
-def check_if_replicaset_needs_setup(cluster_object, dns_suffix=DNS_SUFFIX):
-    core_api = core_v1_api.CoreV1Api()
-    name = cluster_object['metadata']['name']
-    namespace = cluster_object['metadata']['namespace']
-
-    pod_name = '{}-0'.format(name)
+def exec_mongo(name, namespace, member_id, script):
+    # Runs script in the mongo shell of the member and returns the JSON
+    # document it prints
+    core_api = exec_api()
+    pod_name = '{}-{}'.format(name, member_id)
     exec_cmd = [
         'mongo',
         'localhost:27017/admin',
+        '--quiet',
         '--ssl',
         '--sslCAFile', '/etc/ssl/mongod/ca.pem',
-        '--sslPEMKeyFile', '/etc/ssl/mongod/mongod.pem',
-        '--eval', 'rs.status()']
+        '--sslPEMKeyFile', '/etc/ssl/mongod/{}.pem'.format(pod_name),
+        '--eval', script]
     exec_resp = stream(core_api.connect_get_namespaced_pod_exec,
         pod_name,
         namespace,
@@ -39,25 +56,244 @@ def check_if_replicaset_needs_setup(cluster_object, dns_suffix=DNS_SUFFIX):
         stdout=True,
         tty=False)
 
+    return parse_shell_json(exec_resp)
+
+
+def get_host(member_name):
+    # Member names in the replica set status are <host>:<port>
+    return member_name.rsplit(':', 1)[0]
+
+
+def get_replicaset_status(cluster_object, dns_suffix=DNS_SUFFIX):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    # Talk to the last known primary, reconfigurations have to go there
+    host = get_member_hostname(0, name, namespace, dns_suffix)
+    last_status = REPLICASET_STATUS.get(namespace, name)
+    if last_status is not None and last_status.primary is not None:
+        host = get_host(last_status.primary.name)
+
+    mongo_client = get_mongo_client(cluster_object, host)
+    if mongo_client is None:
+        return None
+
+    try:
+        document = mongo_client.admin.command('replSetGetStatus')
+    except PyMongoError as e:
+        # Until the replica set is initialized and the users are created the
+        # admin user can't authenticate, the exec fallback handles that
+        logging.debug('unable to get replicaset status of {} in ns/{}: {}'
+                      .format(name, namespace, e))
+        return None
+    else:
+        return ReplicaSetStatus.from_document(document)
+
+
+def exec_replicaset_status(cluster_object):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    try:
+        document = exec_mongo(
+            name, namespace, 0, 'JSON.stringify(rs.status())')
+    except ValueError as e:
+        logging.error('error getting replicaset status of {} in ns/{}\n{}'
+                      .format(name, namespace, e))
+        return None
+    else:
+        return ReplicaSetStatus.from_document(document)
+
+
+def get_replicas(cluster_object):
+    try:
+        return cluster_object['spec']['mongodb']['replicas']
+    except KeyError:
+        return 3
+
+
+def get_statefulset_replicas(cluster_object):
+    # Members are removed from the replica set first, until then their pods
+    # have to stay around
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    replicas = get_replicas(cluster_object)
+
+    status = REPLICASET_STATUS.get(namespace, name)
+    if status is not None and status.ok:
+        return max(replicas, len(status.members))
+
+    # Without a status we can't tell which members were removed already, so
+    # the statefulset must not shrink
+    statefulset = STATEFULSET_INFORMER.get(namespace, name)
+    if statefulset is not None and statefulset.spec.replicas is not None:
+        return max(replicas, statefulset.spec.replicas)
+    return replicas
+
+
+def set_phase(cluster_object, phase):
+    if get_phase(cluster_object) == phase:
+        return True
+    return bool(set_mongodb_status(cluster_object, {'phase': phase}))
+
+
+def check_if_replicaset_needs_setup(cluster_object, dns_suffix=DNS_SUFFIX):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    # Settled replica sets are only probed on a slow schedule that backs off
+    # further while they stay healthy, through the driver and never exec
+    if get_phase(cluster_object) == PHASE_USERS_CREATED:
+        # Unless the number of members has to change
+        replicas = get_replicas(cluster_object)
+        last_status = REPLICASET_STATUS.get(namespace, name)
+        if not REPLICASET_PROBES.is_due(namespace, name) and \
+           last_status is not None and \
+           len(last_status.members) == replicas:
+            return last_status
+
+        status = get_replicaset_status(cluster_object, dns_suffix)
+        REPLICASET_PROBES.probed(
+            namespace, name,
+            status is not None and status.is_healthy(replicas))
+        if status is not None:
+            REPLICASET_STATUS.set(namespace, name, status)
+            if status.ok and scale_replicaset(
+                    cluster_object, status, dns_suffix):
+                # Get the new members for the statefulset size
+                status = get_replicaset_status(cluster_object, dns_suffix)
+                if status is not None:
+                    REPLICASET_STATUS.set(namespace, name, status)
+            return status
+    else:
+        # Authenticating as the admin user only works once the replica set
+        # was initialized and the users created
+        status = get_replicaset_status(cluster_object, dns_suffix)
+        if status is not None:
+            REPLICASET_STATUS.set(namespace, name, status)
+            set_phase(cluster_object, PHASE_USERS_CREATED)
+            return status
+
+    status = exec_replicaset_status(cluster_object)
+    if status is None:
+        REPLICASET_STATUS.invalidate(namespace, name)
+        return None
+
+    REPLICASET_STATUS.set(namespace, name, status)
+
     # If the replica set is not initialized yet, we initialize it
-    if '"ok" : 0' in exec_resp and \
-       '"codeName" : "NotYetInitialized"' in exec_resp:
-        initiate_replicaset(cluster_object, dns_suffix=dns_suffix)
+    if not status.initialized:
+        if initiate_replicaset(cluster_object, dns_suffix=dns_suffix):
+            set_phase(cluster_object, PHASE_INITIALIZED)
 
     # If we can get the replica set status without authenticating as the
     # admin user first, we have to create the users
-    if '"ok" : 1' in exec_resp:
-        create_users(cluster_object)
+    elif status.ok:
+        set_phase(cluster_object, PHASE_INITIALIZED)
+        if create_users(cluster_object, status):
+            set_phase(cluster_object, PHASE_USERS_CREATED)
 
+    # Users exist already, the client secrets just didn't work for the driver
+    elif status.unauthorized:
+        set_phase(cluster_object, PHASE_USERS_CREATED)
 
-def initiate_replicaset(cluster_object, dns_suffix=DNS_SUFFIX):
-    core_api = core_v1_api.CoreV1Api()
+    return status
+
+
+def reconfigure_replicaset(mongo_client, config):
+    config['version'] += 1
+    mongo_client.admin.command('replSetReconfig', config)
+
+
+def scale_replicaset(cluster_object, status, dns_suffix=DNS_SUFFIX):
+    # Changes at most one member per call and returns whether it did. New
+    # members join without votes and priority and are only promoted once
+    # their initial sync finished, removed members leave the replica set
+    # before the statefulset shrinks.
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
+    replicas = get_replicas(cluster_object)
+
+    if status.primary is None:
+        return False
+
+    mongo_client = get_mongo_client(
+        cluster_object, get_host(status.primary.name))
+    if mongo_client is None:
+        return False
+
     try:
-        replicas = cluster_object['spec']['mongodb']['replicas']
-    except KeyError:
-        replicas = 3
+        config = mongo_client.admin.command('replSetGetConfig')['config']
+        members = {get_member_id(m['host'], name): m
+                   for m in config['members']}
+        states = {get_member_id(m.name, name): m.state
+                  for m in status.members}
+
+        # Remove the member with the highest id first
+        removed = sorted(
+            i for i in members if i is not None and i >= replicas)
+        if removed:
+            member_id = removed[-1]
+            if member_id == get_member_id(status.primary.name, name):
+                logging.info('stepping down {}-{} in ns/{} to remove it'
+                             .format(name, member_id, namespace))
+                try:
+                    mongo_client.admin.command('replSetStepDown', 60)
+                except AutoReconnect:
+                    # The primary closes all connections when it steps down
+                    pass
+                return False
+
+            config['members'].remove(members[member_id])
+            reconfigure_replicaset(mongo_client, config)
+            logging.info('removed {}-{} from replicaset {} in ns/{}'.format(
+                name, member_id, name, namespace))
+            return True
+
+        # Promote members that finished their initial sync
+        votes = sum(1 for m in config['members'] if m.get('votes', 1))
+        for member_id, member in sorted(members.items()):
+            if member.get('votes', 1) or states.get(member_id) != SECONDARY:
+                continue
+            if votes >= MAX_VOTING_MEMBERS:
+                # Additional members stay non-voting secondaries
+                break
+
+            member['votes'] = 1
+            member['priority'] = 1
+            reconfigure_replicaset(mongo_client, config)
+            logging.info('promoted {}-{} in replicaset {} in ns/{}'.format(
+                name, member_id, name, namespace))
+            return True
+
+        # Add the next member once all others are up and in sync
+        missing = [i for i in range(replicas) if i not in members]
+        if not missing or any(
+                state not in (PRIMARY, SECONDARY, ARBITER)
+                for state in states.values()):
+            return False
+
+        member_id = missing[0]
+        config['members'].append({
+            '_id': member_id,
+            'host': get_member_hostname(
+                member_id, name, namespace, dns_suffix),
+            'priority': 0,
+            'votes': 0})
+        reconfigure_replicaset(mongo_client, config)
+        logging.info('added {}-{} to replicaset {} in ns/{}'.format(
+            name, member_id, name, namespace))
+        return True
+    except PyMongoError as e:
+        logging.error('error scaling replicaset {} in ns/{}: {}'.format(
+            name, namespace, e))
+        return False
+
+
+def initiate_replicaset(cluster_object, dns_suffix=DNS_SUFFIX):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    replicas = get_replicas(cluster_object)
 
     _rs_config = {
         '_id': name,
@@ -72,45 +308,75 @@ def initiate_replicaset(cluster_object, dns_suffix=DNS_SUFFIX):
             '_id': _id,
             'host': _member_hostname})
 
-    pod_name = '{}-0'.format(name)
-    exec_cmd = [
-        'mongo',
-        'localhost:27017/admin',
-        '--ssl',
-        '--sslCAFile', '/etc/ssl/mongod/ca.pem',
-        '--sslPEMKeyFile', '/etc/ssl/mongod/mongod.pem',
-        '--eval', 'rs.initiate({})'.format(json.dumps(_rs_config))]
-    exec_resp = stream(core_api.connect_get_namespaced_pod_exec,
-        pod_name,
-        namespace,
-        command=exec_cmd,
-        container='mongod',
-        stderr=True,
-        stdin=False,
-        stdout=True,
-        tty=False)
+    try:
+        result = exec_mongo(
+            name, namespace, 0,
+            'JSON.stringify(rs.initiate({}))'.format(json.dumps(_rs_config)))
+    except ValueError as e:
+        logging.error('error initializing replicaset {} in ns/{}\n{}'.format(
+            name, namespace, e))
+        return False
 
-    if '{ "ok" : 1 }' in exec_resp:
+    if result.get('ok'):
         logging.info('initialized replicaset {} in ns/{}'.format(
             name, namespace))
-    elif '"ok" : 0' in exec_resp and \
-         '"codeName" : "NodeNotFound"' in exec_resp:
+        REPLICASET_STATUS.invalidate(namespace, name)
+        return True
+    elif result.get('code') == NODE_NOT_FOUND:
         logging.info('waiting for {} {} replicaset members in ns/{}'.format(
             replicas, name, namespace))
-        logging.debug(exec_resp)
+        logging.debug(result)
     else:
         logging.error('error initializing replicaset {} in ns/{}\n{}'.format(
-            name, namespace, exec_resp))
+            name, namespace, result))
+    return False
+
 
+def get_member_id(host, cluster_name):
+    # Member hosts look like <name>-<id>.<name>.<namespace>.<suffix>:<port>
+    pod_name = host.split('.', 1)[0].split(':', 1)[0]
+    prefix = '{}-'.format(cluster_name)
+    member_id = pod_name[len(prefix):]
+    if pod_name.startswith(prefix) and member_id.isdigit():
+        return int(member_id)
+    return None
+
+
+def is_master(name, namespace, member_id):
+    try:
+        return exec_mongo(
+            name, namespace, member_id, 'JSON.stringify(db.isMaster())')
+    except (ApiException, ValueError) as e:
+        logging.debug('unable to reach {}-{} in ns/{}: {}'.format(
+            name, member_id, namespace, e))
+        return None
+
+
+def find_primary(name, namespace, replicas):
+    # Every member knows the primary, usually asking member 0 is enough
+    result = is_master(name, namespace, 0)
+    if result and result.get('primary'):
+        return get_member_id(result['primary'], name)
+
+    # Otherwise ask all other members at once, so finding the primary does
+    # not take longer the more members there are
+    member_ids = list(range(1, replicas))
+    results = _probe_executor.map(
+        lambda member_id: is_master(name, namespace, member_id), member_ids)
+    for member_id, result in zip(member_ids, results):
+        if not result:
+            continue
+        if result.get('ismaster'):
+            return member_id
+        if result.get('primary'):
+            return get_member_id(result['primary'], name)
+    return None
 
-def create_users(cluster_object):
-    core_api = core_v1_api.CoreV1Api()
+
+def create_users(cluster_object, status=None):
     name = cluster_object['metadata']['name']
     namespace = cluster_object['metadata']['namespace']
-    try:
-        replicas = cluster_object['spec']['mongodb']['replicas']
-    except KeyError:
-        replicas = 3
+    replicas = get_replicas(cluster_object)
 
     admin_credentials = read_secret(
         '{}-admin-credentials'.format(name), namespace)
@@ -127,59 +393,52 @@ def create_users(cluster_object):
         monitoring_credentials.data['password']).decode('utf-8')
 
     mongo_command = '''
-        admin = db.getSiblingDB("admin")
-        admin.createUser(
-          {{
-            user: "{}",
-            pwd: "{}",
-            roles: [ {{ role: "root", db: "admin" }} ]
-          }}
-        )
-        admin.auth(
-          "{}",
-          "{}"
-        )
-        admin.createUser(
-          {{
-            user: "{}",
-            pwd: "{}",
+        var admin = db.getSiblingDB("admin");
+        var result = admin.runCommand({{
+          createUser: {},
+          pwd: {},
+          roles: [ {{ role: "root", db: "admin" }} ]
+        }});
+        if (result.ok) {{
+          admin.auth({}, {});
+          result = admin.runCommand({{
+            createUser: {},
+            pwd: {},
             roles: [ {{ role: "clusterMonitor", db: "admin" }} ]
-          }}
-        )
+          }});
+        }}
+        print(JSON.stringify(result));
     '''.format(
-        admin_username, admin_password,
-        admin_username, admin_password,
-        monitoring_username, monitoring_password)
-
-    for i in range(replicas):
-        pod_name = '{}-{}'.format(name, i)
-        exec_cmd = [
-            'mongo',
-            'localhost:27017/admin',
-            '--ssl',
-            '--sslCAFile', '/etc/ssl/mongod/ca.pem',
-            '--sslPEMKeyFile', '/etc/ssl/mongod/mongod.pem',
-            '--eval', '{}'.format(mongo_command)]
-        exec_resp = stream(core_api.connect_get_namespaced_pod_exec,
-            pod_name,
-            namespace,
-            command=exec_cmd,
-            container='mongod',
-            stderr=True,
-            stdin=False,
-            stdout=True,
-            tty=False)
-
-        if 'Successfully added user: {' in exec_resp:
-            logging.info('created users for {} in ns/{}'.format(
-                name, namespace))
-            return True
-        elif "Error: couldn't add user: not master :" in exec_resp:
-            # most of the time member-0 is elected master
-            # if it is not we get this error and need to
-            # loop through members until we find the master
-            continue
-        else:
-            logging.error('error creating users for {} in ns/{}\n{}'.format(
-                name, namespace, exec_resp))
+        json.dumps(admin_username), json.dumps(admin_password),
+        json.dumps(admin_username), json.dumps(admin_password),
+        json.dumps(monitoring_username), json.dumps(monitoring_password))
+
+    primary = None
+    if status is not None and status.primary is not None:
+        primary = get_member_id(status.primary.name, name)
+    if primary is None:
+        primary = find_primary(name, namespace, replicas)
+    if primary is None:
+        logging.info('waiting for a primary in {} in ns/{}'.format(
+            name, namespace))
         return False
+
+    try:
+        result = exec_mongo(name, namespace, primary, mongo_command)
+    except ValueError as e:
+        logging.error('error creating users for {} in ns/{}\n{}'.format(
+            name, namespace, e))
+        return False
+
+    if result.get('ok'):
+        logging.info('created users for {} in ns/{}'.format(
+            name, namespace))
+        return True
+    elif result.get('code') == NOT_MASTER:
+        # The primary stepped down since we asked, try again next time
+        logging.info('{}-{} in ns/{} is no longer primary'.format(
+            name, primary, namespace))
+    else:
+        logging.error('error creating users for {} in ns/{}\n{}'.format(
+            name, namespace, result))
+    return False
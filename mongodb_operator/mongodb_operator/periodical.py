@@ -1,27 +1,52 @@
 import logging
-from time import sleep
-
-from kubernetes import client
-
-from .kubernetes_resources import get_default_label_selector
-from .kubernetes_helpers import (list_cluster_mongodb_object,
-                                 get_namespaced_mongodb_object,
-                                 create_service, update_service,
+from time import sleep, monotonic
+
+from .certificate_rotation import rotate_certificates
+from .informers import (MONGODB_INFORMER, SERVICE_INFORMER,
+                        STATEFULSET_INFORMER, SECRET_INFORMER,
+                        informers_synced)
+from .kubernetes_resources import (get_service_object, get_statefulset_object,
+                                   get_desired_state_hash, is_desired_state,
+                                   compare_volume_claim_templates,
+                                   is_owned_by_mongodb)
+from .kubernetes_helpers import (create_service, update_service,
                                  delete_service, create_statefulset,
-                                 update_statefulset, delete_statefulset,
-                                 delete_secret)
-from .mongodb_helpers import check_if_replicaset_needs_setup
-
-
-def periodical_check(shutting_down, sleep_seconds):
+                                 update_statefulset, orphan_statefulset,
+                                 delete_statefulset,
+                                 delete_secret,
+                                 create_member_certificates_secret,
+                                 update_member_certificates_secret)
+from .mongodb_helpers import (check_if_replicaset_needs_setup,
+                              get_statefulset_replicas)
+from .rate_limiter import log_api_calls
+from .state_cache import VERSION_CACHE
+from .workqueue import WORK_QUEUE, log_worker_utilisation
+
+
+def periodical_check(shutting_down, sleep_seconds, gc_interval_seconds=0):
     logging.info('thread started')
+    last_gc = None
     while not shutting_down.isSet():
         try:
-            # First make sure all expected resources exist
+            # First queue all clusters to make sure expected resources exist
             check_existing()
 
-            # Then garbage collect resources from deleted clusters
-            collect_garbage()
+            # Owner references make kubernetes delete the children of deleted
+            # clusters, a full scan is only a rare backstop
+            if int(gc_interval_seconds) > 0 and (
+                    last_gc is None or
+                    monotonic() - last_gc >= int(gc_interval_seconds)):
+                collect_garbage()
+                last_gc = monotonic()
+
+            # Report how busy the reconcile workers were since the last check
+            log_worker_utilisation()
+
+            # Report which api calls the operator made since the last check
+            log_api_calls()
+
+            # Evict stale entries from the version cache and snapshot it
+            maintain_version_cache()
         except Exception as e:
             # Last resort: catch all exceptions to keep the thread alive
             logging.exception(e)
@@ -31,152 +56,185 @@ def periodical_check(shutting_down, sleep_seconds):
         logging.info('thread stopped')
 
 
-VERSION_CACHE = {}
+def get_version(resource, desired=None):
+    # With the desired object the version also changes when the MongoDB
+    # object does, not only when the resource itself was changed
+    version = resource.metadata.resource_version
+    if desired is None:
+        return version
+    return '{}/{}'.format(version, get_desired_state_hash(desired))
 
 
-def is_version_cached(resource):
+def is_version_cached(resource, desired=None):
     uid = resource.metadata.uid
-    version = resource.metadata.resource_version
+    version = get_version(resource, desired)
 
-    if uid in VERSION_CACHE and VERSION_CACHE[uid] == version:
-        return True
+    return VERSION_CACHE.is_cached(uid, version)
 
-    return False
 
-
-def cache_version(resource):
+def cache_version(resource, desired=None):
     uid = resource.metadata.uid
-    version = resource.metadata.resource_version
+    version = get_version(resource, desired)
 
-    VERSION_CACHE[uid] = version
+    VERSION_CACHE.set(uid, version)
+
+
+def maintain_version_cache():
+    if informers_synced():
+        # Evict versions of services and statefulsets that are gone
+        live_uids = set(
+            resource.metadata.uid
+            for informer in [SERVICE_INFORMER, STATEFULSET_INFORMER]
+            for resource in informer.list())
+        VERSION_CACHE.prune(live_uids)
+
+    VERSION_CACHE.snapshot()
+
+    logging.info(
+        'version cache: {entries} entries, {hits} hits, {misses} misses, '
+        '{evictions} evictions'.format(**VERSION_CACHE.stats()))
 
 
 def check_existing():
-    try:
-        cluster_list = list_cluster_mongodb_object()
-    except client.rest.ApiException as e:
-        # If for any reason, k8s api gives us an error here, there is
-        # nothing for us to do but retry later
-        logging.exception(e)
+    if not informers_synced():
+        # Without a complete cache we can't tell what is missing
+        logging.debug('informers not synced yet, skipping check')
         return False
 
-    core_api = client.CoreV1Api()
-    apps_api = client.AppsV1beta2Api()
-    for cluster_object in cluster_list['items']:
-        name = cluster_object['metadata']['name']
-        namespace = cluster_object['metadata']['namespace']
-
-        # Check service exists
-        try:
-            service = core_api.read_namespaced_service(name, namespace)
-        except client.rest.ApiException as e:
-            if e.status == 404:
-                # Create missing service
-                created_service = create_service(cluster_object)
-                if created_service:
-                    # Store latest version in cache
-                    cache_version(created_service)
-            else:
-                logging.exception(e)
+    # Queue every cluster, the reconcile workers take it from there. Failed
+    # clusters are retried with their backoff instead.
+    for namespace, name in MONGODB_INFORMER.keys():
+        WORK_QUEUE.resync((namespace, name))
+
+
+def check_cluster(cluster_object):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+    success = True
+
+    # Check service exists
+    desired_service = get_service_object(cluster_object)
+    service = SERVICE_INFORMER.get(namespace, name)
+    if service is None:
+        # Create missing service
+        created_service = create_service(cluster_object)
+        if created_service:
+            # Store latest version in cache
+            cache_version(created_service, desired_service)
         else:
-            if not is_version_cached(service):
-                # Update since we don't know if it's configured correctly
-                updated_service = update_service(cluster_object)
-                if updated_service:
-                    # Store latest version in cache
-                    cache_version(updated_service)
-
-        # Check statefulset exists
-        try:
-            statefulset = apps_api.read_namespaced_stateful_set(
-                name, namespace)
-        except client.rest.ApiException as e:
-            if e.status == 404:
-                # Create missing statefulset
-                created_statefulset = create_statefulset(cluster_object)
-                if created_statefulset:
-                    # Store latest version in cache
-                    cache_version(created_statefulset)
+            success = False
+    elif not is_version_cached(service, desired_service):
+        if is_desired_state(service, desired_service):
+            # Configured correctly, nothing to patch
+            cache_version(service, desired_service)
+        else:
+            # Update since the desired state changed
+            updated_service = update_service(cluster_object)
+            if updated_service:
+                # Store latest version in cache
+                cache_version(updated_service, desired_service)
             else:
-                logging.exception(e)
+                success = False
+
+    # Check statefulset exists, members are removed from the replica set
+    # before the statefulset shrinks
+    replicas = get_statefulset_replicas(cluster_object)
+
+    # Every member needs its certificate before the statefulset starts its
+    # pod
+    certificates_secret = SECRET_INFORMER.get(
+        namespace, '{}-member-certificates'.format(name))
+    if certificates_secret is None:
+        if not create_member_certificates_secret(cluster_object, replicas):
+            success = False
+    elif not update_member_certificates_secret(
+            cluster_object, certificates_secret, replicas):
+        success = False
+
+    desired_statefulset = get_statefulset_object(cluster_object, replicas)
+    statefulset = STATEFULSET_INFORMER.get(namespace, name)
+    if statefulset is None:
+        # Create missing statefulset
+        created_statefulset = create_statefulset(cluster_object, replicas)
+        if created_statefulset:
+            # Store latest version in cache
+            cache_version(created_statefulset, desired_statefulset)
         else:
-            if not is_version_cached(statefulset):
-                # Update since we don't know if it's configured correctly
-                updated_statefulset = update_statefulset(cluster_object)
+            success = False
+    elif statefulset.metadata.deletion_timestamp is not None:
+        # Being replaced, it is created again once it is gone
+        logging.debug('waiting for statefulset/{} in ns/{} to be deleted'
+                      .format(name, namespace))
+        success = False
+    elif not is_version_cached(statefulset, desired_statefulset):
+        if is_desired_state(statefulset, desired_statefulset):
+            # Configured correctly, nothing to patch
+            cache_version(statefulset, desired_statefulset)
+        else:
+            added_or_removed, changed = compare_volume_claim_templates(
+                statefulset, desired_statefulset)
+            if added_or_removed:
+                # E.g. storage was added, only a new statefulset can have
+                # other volume claim templates
+                orphan_statefulset(cluster_object, added_or_removed)
+                success = False
+            else:
+                if changed:
+                    # Existing claims are neither resized nor moved. The
+                    # patch sets the desired state hash, so this is only
+                    # logged once per change.
+                    logging.error(
+                        'unable to change the volumes {} of statefulset/{} '
+                        'in ns/{}, their size and storage class are fixed '
+                        'once created'.format(
+                            ', '.join(changed), name, namespace))
+                # Update since the desired state changed
+                updated_statefulset = update_statefulset(
+                    cluster_object, replicas,
+                    keep_volume_claim_templates=bool(changed))
                 if updated_statefulset:
                     # Store latest version in cache
-                    cache_version(updated_statefulset)
+                    cache_version(updated_statefulset, desired_statefulset)
+                else:
+                    success = False
 
-        # Check replica set status
-        check_if_replicaset_needs_setup(cluster_object)
+    # Check replica set status
+    check_if_replicaset_needs_setup(cluster_object)
+
+    # Renew certificates before they expire, one member at a time
+    rotate_certificates(cluster_object)
+
+    return success
+
+
+def find_orphans(informer, cluster_keys):
+    # Everything labelled for a cluster that is not in cluster_keys, except
+    # what the kubernetes garbage collector deletes through owner references
+    orphans = []
+    for namespace, cluster in informer.cluster_keys() - cluster_keys:
+        for resource in informer.by_cluster(namespace, cluster):
+            if not is_owned_by_mongodb(resource):
+                orphans.append(resource)
+    return orphans
 
 
 def collect_garbage():
-    core_api = client.CoreV1Api()
-    apps_api = client.AppsV1beta2Api()
-    label_selector = get_default_label_selector()
-
-    # Find all services that match our labels
-    try:
-        service_list = core_api.list_service_for_all_namespaces(
-            label_selector=label_selector)
-    except client.rest.ApiException as e:
-        logging.exception(e)
-    else:
-        # Check if service belongs to an existing cluster
-        for service in service_list.items:
-            name = service.metadata.name
-            namespace = service.metadata.namespace
-
-            try:
-                get_namespaced_mongodb_object(name, namespace)
-            except client.rest.ApiException as e:
-                if e.status == 404:
-                    # Delete service
-                    delete_service(name, namespace)
-                else:
-                    logging.exception(e)
-
-    # Find all statefulsets that match our labels
-    try:
-        statefulset_list = apps_api.list_stateful_set_for_all_namespaces(
-            label_selector=label_selector)
-    except client.rest.ApiException as e:
-        logging.exception(e)
-    else:
-        # Check if statefulsets belongs to an existing cluster
-        for statefulset in statefulset_list.items:
-            name = statefulset.metadata.name
-            namespace = statefulset.metadata.namespace
-
-            try:
-                get_namespaced_mongodb_object(name, namespace)
-            except client.rest.ApiException as e:
-                if e.status == 404:
-                    # Gracefully delete statefulsets and pods
-                    delete_statefulset(name, namespace)
-                else:
-                    logging.exception(e)
-
-    # Find all secrets that match our labels
-    try:
-        secret_list = core_api.list_secret_for_all_namespaces(
-            label_selector=label_selector)
-    except client.rest.ApiException as e:
-        logging.exception(e)
-    else:
-        # Check if secrets belongs to an existing cluster
-        for secret in secret_list.items:
-            cluster_name = secret.metadata.labels['cluster']
-            secret_name = secret.metadata.name
-            namespace = secret.metadata.namespace
-
-            try:
-                get_namespaced_mongodb_object(
-                    cluster_name, namespace)
-            except client.rest.ApiException as e:
-                if e.status == 404:
-                    # Delete service
-                    delete_secret(secret_name, namespace)
-                else:
-                    logging.exception(e)
+    if not informers_synced():
+        # An incomplete cache would make every resource look orphaned
+        logging.debug('informers not synced yet, skipping garbage collection')
+        return False
+
+    cluster_keys = MONGODB_INFORMER.keys()
+
+    # Delete services of deleted clusters
+    for service in find_orphans(SERVICE_INFORMER, cluster_keys):
+        delete_service(service.metadata.name, service.metadata.namespace)
+
+    # Gracefully delete statefulsets and pods of deleted clusters
+    for statefulset in find_orphans(STATEFULSET_INFORMER, cluster_keys):
+        delete_statefulset(
+            statefulset.metadata.name, statefulset.metadata.namespace)
+
+    # Delete secrets of deleted clusters
+    for secret in find_orphans(SECRET_INFORMER, cluster_keys):
+        delete_secret(secret.metadata.name, secret.metadata.namespace)
@@ -0,0 +1,145 @@
+import logging
+import threading
+from time import monotonic, sleep
+
+from kubernetes import client
+
+
+# Allows on average qps calls per second and bursts of up to burst calls.
+# A qps of 0 disables the limit.
+class TokenBucket(object):
+
+    def __init__(self, qps=0, burst=1):
+        self._lock = threading.Lock()
+        self.configure(qps, burst)
+
+    def configure(self, qps, burst):
+        with self._lock:
+            self.qps = float(qps)
+            self.burst = max(int(burst), 1)
+            self._tokens = float(self.burst)
+            self._last = monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.qps)
+        self._last = now
+
+    def reserve(self):
+        # Take a token and return how many seconds to wait until it is valid
+        with self._lock:
+            if self.qps <= 0:
+                return 0
+
+            self._refill(monotonic())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.qps
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class ApiCallStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._since = monotonic()
+
+    def record(self, verb, resource, seconds, throttled_seconds=0):
+        with self._lock:
+            count, total, throttled = self._calls.get(
+                (verb, resource), (0, 0, 0))
+            self._calls[(verb, resource)] = (
+                count + 1, total + seconds, throttled + throttled_seconds)
+
+    def collect(self):
+        # Return calls, total latency and time spent waiting for the rate
+        # limiter per (verb, resource) since the last collect and the length
+        # of that window
+        with self._lock:
+            now = monotonic()
+            calls = self._calls
+            window = now - self._since
+            self._calls = {}
+            self._since = now
+        return calls, window
+
+
+def get_verb(method, path_params, query_params):
+    if method == 'GET':
+        if dict(query_params or []).get('watch'):
+            return 'watch'
+        return 'get' if 'name' in (path_params or {}) else 'list'
+
+    return {
+        'POST': 'create',
+        'PUT': 'update',
+        'PATCH': 'patch',
+        'DELETE': 'delete'}.get(method, method.lower())
+
+
+def get_resource(resource_path, path_params):
+    # Resource paths are templates like /api/v1/namespaces/{namespace}/pods/
+    # {name}/exec, which makes the resource pods/exec
+    path_params = path_params or {}
+    segments = [s for s in resource_path.split('/') if s]
+    if '{plural}' in segments:
+        segments[segments.index('{plural}')] = path_params.get(
+            'plural', '{plural}')
+
+    if '{name}' in segments:
+        name_index = segments.index('{name}')
+        return '/'.join(
+            segments[name_index - 1:name_index] + segments[name_index + 1:])
+    return segments[-1] if segments else resource_path
+
+
+RATE_LIMITER = TokenBucket()
+API_CALL_STATS = ApiCallStats()
+
+
+# Every request made through this api client first waits for the rate limiter
+# and is then accounted for per verb and resource
+class RateLimitedApiClient(client.ApiClient):
+
+    def __init__(self, *args, **kwargs):
+        self.rate_limiter = kwargs.pop('rate_limiter', RATE_LIMITER)
+        self.api_call_stats = kwargs.pop('api_call_stats', API_CALL_STATS)
+        super(RateLimitedApiClient, self).__init__(*args, **kwargs)
+
+    def call_api(self, resource_path, method, path_params=None,
+                 query_params=None, *args, **kwargs):
+        verb = get_verb(method, path_params, query_params)
+        resource = get_resource(resource_path, path_params)
+
+        throttled = self.rate_limiter.acquire()
+        start = monotonic()
+        try:
+            return super(RateLimitedApiClient, self).call_api(
+                resource_path, method, path_params, query_params,
+                *args, **kwargs)
+        finally:
+            self.api_call_stats.record(
+                verb, resource, monotonic() - start, throttled)
+
+
+def log_api_calls(api_call_stats=API_CALL_STATS):
+    calls, window = api_call_stats.collect()
+    if not calls:
+        return
+
+    summary = ', '.join(
+        '{} {} {}x {:.0f}ms avg{}'.format(
+            verb, resource, count, total / count * 1000,
+            ' ({:.1f}s throttled)'.format(throttled) if throttled else '')
+        for (verb, resource), (count, total, throttled) in sorted(
+            calls.items(), key=lambda item: -item[1][0]))
+    total_calls = sum(count for count, _, _ in calls.values())
+    logging.info('api calls: {:.1f}/s, {}'.format(
+        total_calls / max(window, 1e-9), summary))
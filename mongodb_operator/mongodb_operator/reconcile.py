@@ -0,0 +1,88 @@
+import logging
+import threading
+from time import monotonic
+
+from .informers import MONGODB_INFORMER, SECRET_INFORMER, informers_synced
+from .events import add, delete
+from .kubernetes_helpers import add_finalizer, remove_finalizer
+from .periodical import check_cluster
+from .workqueue import WORK_QUEUE, WORKER_STATS
+
+
+CLUSTER_SECRET_SUFFIXES = [
+    '-ca',
+    '-client-certificate',
+    '-admin-credentials',
+    '-monitoring-credentials']
+
+
+def has_missing_secrets(cluster_object):
+    name = cluster_object['metadata']['name']
+    namespace = cluster_object['metadata']['namespace']
+
+    existing = set(
+        secret.metadata.name
+        for secret in SECRET_INFORMER.by_cluster(namespace, name))
+    expected = set(
+        '{}{}'.format(name, suffix) for suffix in CLUSTER_SECRET_SUFFIXES)
+    return not expected.issubset(existing)
+
+
+def reconcile(key):
+    if not informers_synced():
+        # Retry once the caches are complete
+        return False
+
+    namespace, name = key
+    cluster_object = MONGODB_INFORMER.get(namespace, name)
+    if cluster_object is None:
+        # The cluster is gone, remove what kubernetes won't clean up for us
+        delete({'metadata': {'name': name, 'namespace': namespace}})
+        return True
+
+    if cluster_object['metadata'].get('deletionTimestamp'):
+        # The cluster is being deleted. This is the place for cleanup that
+        # has to happen before kubernetes cascades the delete to the children.
+        delete(cluster_object)
+        return bool(remove_finalizer(cluster_object))
+
+    if not add_finalizer(cluster_object):
+        # Retry, we must not create children without the finalizer in place
+        return False
+
+    if has_missing_secrets(cluster_object):
+        # New cluster, provision credentials, service and statefulset
+        return add(cluster_object)
+
+    return check_cluster(cluster_object)
+
+
+def reconcile_worker(shutting_down, queue=WORK_QUEUE,
+                     worker_stats=WORKER_STATS):
+    logging.info('thread started')
+    worker = threading.current_thread().name
+    worker_stats.register(worker)
+    while not shutting_down.isSet():
+        key = queue.get(timeout=1)
+        if key is None:
+            continue
+
+        started = monotonic()
+        try:
+            success = reconcile(key)
+        except Exception as e:
+            # Last resort: catch all exceptions to keep the thread alive
+            logging.exception(e)
+            success = False
+
+        if success:
+            queue.forget(key)
+        else:
+            delay = queue.add_rate_limited(key)
+            logging.debug('retrying mongodb/{} in ns/{} in {}s'.format(
+                key[1], key[0], delay))
+        # The queue makes sure no other worker has the same key until done
+        queue.done(key)
+        worker_stats.record(worker, monotonic() - started)
+    else:
+        logging.info('thread stopped')
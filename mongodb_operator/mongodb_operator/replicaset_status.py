@@ -0,0 +1,231 @@
+import json
+import threading
+from time import monotonic
+
+
+# Member states as reported by replSetGetStatus
+STARTUP = 0
+PRIMARY = 1
+SECONDARY = 2
+RECOVERING = 3
+STARTUP2 = 5
+UNKNOWN = 6
+ARBITER = 7
+DOWN = 8
+ROLLBACK = 9
+REMOVED = 10
+
+# Bootstrap phases recorded in the status of the MongoDB object
+PHASE_INITIALIZED = 'Initialized'
+PHASE_USERS_CREATED = 'UsersCreated'
+
+# Error codes we act on
+UNAUTHORIZED = 13
+NOT_YET_INITIALIZED = 94
+NODE_NOT_FOUND = 74
+NOT_MASTER = 10107
+
+
+def get_phase(cluster_object):
+    return (cluster_object.get('status') or {}).get('phase')
+
+
+def parse_shell_json(output):
+    # The mongo shell is run with --quiet and prints the result as JSON on
+    # the last line, anything before it is warnings or stderr
+    for line in reversed(output.strip().splitlines()):
+        line = line.strip()
+        if line.startswith('{'):
+            try:
+                return json.loads(line)
+            except ValueError:
+                continue
+    raise ValueError('no JSON document in mongo shell output: {}'.format(
+        output))
+
+
+def parse_optime(optime):
+    # Optimes are {ts: Timestamp, t: term}. The driver returns bson
+    # Timestamps, JSON.stringify in the shell turns them into {t: .., i: ..}
+    if not isinstance(optime, dict):
+        return None
+
+    ts = optime.get('ts')
+    if hasattr(ts, 'time'):
+        return (ts.time, ts.inc)
+    if isinstance(ts, dict):
+        return (ts.get('t'), ts.get('i'))
+    return None
+
+
+class ReplicaSetMember(object):
+
+    def __init__(self, member_id, name, state, state_str=None, health=None,
+                 optime=None, config_version=None, is_self=False):
+        self.member_id = member_id
+        self.name = name
+        self.state = state
+        self.state_str = state_str
+        self.health = health
+        self.optime = optime
+        self.config_version = config_version
+        self.is_self = is_self
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(
+            member_id=document.get('_id'),
+            name=document.get('name'),
+            state=document.get('state'),
+            state_str=document.get('stateStr'),
+            health=document.get('health'),
+            optime=parse_optime(document.get('optime')),
+            config_version=document.get('configVersion'),
+            is_self=bool(document.get('self')))
+
+    @property
+    def is_primary(self):
+        return self.state == PRIMARY
+
+    @property
+    def is_secondary(self):
+        return self.state == SECONDARY
+
+    def __repr__(self):
+        return '<ReplicaSetMember {} {}>'.format(self.name, self.state_str)
+
+
+class ReplicaSetStatus(object):
+
+    def __init__(self, ok, set_name=None, members=None, code=None,
+                 code_name=None, errmsg=None):
+        self.ok = ok
+        self.set_name = set_name
+        self.members = members or []
+        self.code = code
+        self.code_name = code_name
+        self.errmsg = errmsg
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(
+            ok=bool(document.get('ok')),
+            set_name=document.get('set'),
+            members=[ReplicaSetMember.from_document(m)
+                     for m in document.get('members', [])],
+            code=document.get('code'),
+            code_name=document.get('codeName'),
+            errmsg=document.get('errmsg'))
+
+    @property
+    def initialized(self):
+        return self.ok or self.code != NOT_YET_INITIALIZED
+
+    @property
+    def unauthorized(self):
+        return self.code == UNAUTHORIZED
+
+    @property
+    def primary(self):
+        for member in self.members:
+            if member.is_primary:
+                return member
+        return None
+
+    @property
+    def config_version(self):
+        for member in self.members:
+            if member.is_self:
+                return member.config_version
+        return None
+
+    def is_healthy(self, replicas):
+        # All expected members are up and one of them is primary
+        if not self.ok or self.primary is None:
+            return False
+        if len(self.members) != replicas:
+            return False
+        return all(m.health == 1 and m.state in (PRIMARY, SECONDARY, ARBITER)
+                   for m in self.members)
+
+    def member(self, name):
+        for member in self.members:
+            if member.name == name:
+                return member
+        return None
+
+    def __repr__(self):
+        if not self.ok:
+            return '<ReplicaSetStatus {} {}>'.format(
+                self.code, self.code_name)
+        return '<ReplicaSetStatus {} {}>'.format(
+            self.set_name, self.members)
+
+
+# Keeps the last known status per cluster, so reconcile steps and metrics
+# don't have to ask the replica set again
+class ReplicaSetStatusCache(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statuses = {}
+
+    def set(self, namespace, name, status):
+        with self._lock:
+            self._statuses[(namespace, name)] = (status, monotonic())
+
+    def get(self, namespace, name, max_age=None):
+        with self._lock:
+            status, updated = self._statuses.get(
+                (namespace, name), (None, None))
+        if status is None:
+            return None
+        if max_age is not None and monotonic() - updated > max_age:
+            return None
+        return status
+
+    def invalidate(self, namespace, name):
+        with self._lock:
+            self._statuses.pop((namespace, name), None)
+
+    def items(self):
+        with self._lock:
+            return [(key, status)
+                    for key, (status, _) in self._statuses.items()]
+
+
+# Decides when to probe replica sets that finished their bootstrap. Every
+# healthy probe doubles the interval up to max_interval, anything else resets
+# it to base_interval.
+class ProbeSchedule(object):
+
+    def __init__(self, base_interval=60, max_interval=3600):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+
+        self._lock = threading.Lock()
+        self._probes = {}
+
+    def is_due(self, namespace, name):
+        with self._lock:
+            next_probe, _ = self._probes.get((namespace, name), (None, None))
+        return next_probe is None or monotonic() >= next_probe
+
+    def probed(self, namespace, name, healthy):
+        with self._lock:
+            _, interval = self._probes.get((namespace, name), (None, None))
+            if healthy and interval is not None:
+                interval = min(interval * 2, self.max_interval)
+            else:
+                interval = self.base_interval
+            self._probes[(namespace, name)] = (
+                monotonic() + interval, interval)
+        return interval
+
+    def forget(self, namespace, name):
+        with self._lock:
+            self._probes.pop((namespace, name), None)
+
+
+REPLICASET_STATUS = ReplicaSetStatusCache()
+REPLICASET_PROBES = ProbeSchedule()
@@ -0,0 +1,184 @@
+import logging
+import json
+import os
+import threading
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+
+from kubernetes import client
+
+from .kubernetes_clients import core_api
+
+
+SNAPSHOT_KEY = 'versions.json'
+# ConfigMaps are limited to 1MiB, leave room for the metadata
+MAX_SNAPSHOT_BYTES = 900 * 1024
+
+
+# Remembers the last resource version the operator reconciled per uid. The
+# number of entries is capped, the least recently used ones are evicted first.
+# The cache can be snapshot to a local file or a ConfigMap, so a restarted
+# operator does not have to start cold. A snapshot only keeps as many of the
+# most recently used entries as fit into max_snapshot_bytes.
+class ReconcileStateCache(object):
+
+    def __init__(self, max_entries=10000,
+                 max_snapshot_bytes=MAX_SNAPSHOT_BYTES):
+        self.max_entries = max_entries
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.snapshot_file = None
+        self.snapshot_configmap = None
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Changes so far and how many of them made it into a snapshot
+        self._changes = 0
+        self._saved_changes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def is_cached(self, uid, version):
+        with self._lock:
+            if uid in self._entries and self._entries[uid] == version:
+                self._entries.move_to_end(uid)
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            return False
+
+    def set(self, uid, version):
+        with self._lock:
+            self._entries[uid] = version
+            self._entries.move_to_end(uid)
+            self._changes += 1
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def prune(self, live_uids):
+        # Forget about resources that no longer exist
+        with self._lock:
+            for uid in list(self._entries.keys()):
+                if uid not in live_uids:
+                    del self._entries[uid]
+                    self._changes += 1
+                    self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def dump(self):
+        with self._lock:
+            entries = list(self._entries.items())
+
+        # Drop the least recently used entries that don't fit, the ones kept
+        # stay in their order
+        size = 2
+        kept = 0
+        for entry in reversed(entries):
+            size += len(json.dumps(entry)) + 2
+            if size > self.max_snapshot_bytes:
+                break
+            kept += 1
+        if kept < len(entries):
+            logging.debug('state cache snapshot keeps {} of {} entries'.format(
+                kept, len(entries)))
+        return json.dumps(entries[len(entries) - kept:])
+
+    def load(self, snapshot):
+        entries = json.loads(snapshot)
+        with self._lock:
+            self._entries = OrderedDict(
+                (uid, version) for uid, version in entries)
+            self._evict()
+
+    def save_file(self, path, snapshot=None):
+        # Write to a temporary file first, so a crash never leaves a
+        # truncated snapshot behind
+        directory = os.path.dirname(os.path.abspath(path))
+        with NamedTemporaryFile(
+                'w', dir=directory, delete=False) as snapshot_file:
+            snapshot_file.write(snapshot or self.dump())
+        os.rename(snapshot_file.name, path)
+
+    def load_file(self, path):
+        try:
+            with open(path) as snapshot_file:
+                self.load(snapshot_file.read())
+        except FileNotFoundError:
+            logging.debug('no state cache snapshot at {}'.format(path))
+            return False
+        else:
+            return True
+
+    def save_configmap(self, namespace, name, snapshot=None):
+        v1 = core_api()
+        body = client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(name=name, namespace=namespace),
+            data={SNAPSHOT_KEY: snapshot or self.dump()})
+        try:
+            v1.replace_namespaced_config_map(name, namespace, body)
+        except client.rest.ApiException as e:
+            if e.status == 404:
+                v1.create_namespaced_config_map(namespace, body)
+            else:
+                raise
+
+    def load_configmap(self, namespace, name):
+        v1 = core_api()
+        try:
+            configmap = v1.read_namespaced_config_map(name, namespace)
+        except client.rest.ApiException as e:
+            if e.status == 404:
+                logging.debug('no state cache snapshot in cm/{} in ns/{}'
+                              .format(name, namespace))
+                return False
+            raise
+        else:
+            self.load((configmap.data or {}).get(SNAPSHOT_KEY, '[]'))
+            return True
+
+    def snapshot(self):
+        if not self.snapshot_file and not self.snapshot_configmap:
+            # Nowhere to save it, don't serialise the cache for nothing
+            return False
+
+        with self._lock:
+            changes = self._changes
+            if changes == self._saved_changes:
+                return False
+
+        snapshot = self.dump()
+        if self.snapshot_file:
+            self.save_file(self.snapshot_file, snapshot)
+        if self.snapshot_configmap:
+            self.save_configmap(*self.snapshot_configmap, snapshot=snapshot)
+
+        # Changes made while saving go into the next snapshot
+        with self._lock:
+            self._saved_changes = changes
+        return True
+
+    def restore(self):
+        if self.snapshot_configmap:
+            return self.load_configmap(*self.snapshot_configmap)
+        if self.snapshot_file:
+            return self.load_file(self.snapshot_file)
+        return False
+
+
+VERSION_CACHE = ReconcileStateCache()
@@ -0,0 +1,176 @@
+import heapq
+import logging
+import threading
+from collections import deque
+from itertools import count
+from time import monotonic
+
+
+# A work queue of keys, usually (namespace, name) tuples. A key that is added
+# again while it is still waiting is only queued once. A key that is added
+# while it is being processed is queued again once processing is done, so no
+# key is ever handed out twice at the same time. Failed keys can be requeued
+# with a per key exponential backoff.
+class WorkQueue(object):
+
+    def __init__(self, base_delay=1, max_delay=300):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._dirty = set()
+        self._processing = set()
+        self._failures = {}
+        self._delayed = []
+        self._sequence = count()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+    def add(self, key):
+        with self._cond:
+            self._add(key)
+
+    def _add(self, key):
+        if key in self._dirty:
+            # Already waiting, collapse into the pending work item
+            return
+
+        self._dirty.add(key)
+        if key in self._processing:
+            # Will be queued again once the current run is done
+            return
+
+        self._queue.append(key)
+        self._cond.notify()
+
+    def add_after(self, key, delay):
+        if delay <= 0:
+            self.add(key)
+            return
+
+        with self._cond:
+            heapq.heappush(
+                self._delayed,
+                (monotonic() + delay, next(self._sequence), key))
+            # Wake up a waiting get so it can recalculate its timeout
+            self._cond.notify()
+
+    def add_rate_limited(self, key):
+        with self._cond:
+            failures = self._failures.get(key, 0)
+            self._failures[key] = failures + 1
+        delay = min(self.base_delay * 2 ** failures, self.max_delay)
+        self.add_after(key, delay)
+        return delay
+
+    def resync(self, key):
+        # Adds the key unless it failed and its requeue is still backing off,
+        # so periodic resyncs don't retry failing keys more often
+        with self._cond:
+            if self._failures.get(key):
+                return False
+            self._add(key)
+            return True
+
+    def forget(self, key):
+        with self._cond:
+            self._failures.pop(key, None)
+
+    def num_requeues(self, key):
+        with self._cond:
+            return self._failures.get(key, 0)
+
+    def _promote_delayed(self):
+        now = monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            ready_at, sequence, key = heapq.heappop(self._delayed)
+            self._add(key)
+
+        if self._delayed:
+            return self._delayed[0][0] - now
+        return None
+
+    def get(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic() + timeout
+
+        with self._cond:
+            while True:
+                next_delayed = self._promote_delayed()
+                if self._queue:
+                    key = self._queue.popleft()
+                    self._processing.add(key)
+                    self._dirty.discard(key)
+                    return key
+
+                wait = next_delayed
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                    if wait is None or remaining < wait:
+                        wait = remaining
+                self._cond.wait(wait)
+
+    def done(self, key):
+        with self._cond:
+            self._processing.discard(key)
+            if key in self._dirty:
+                self._queue.append(key)
+                self._cond.notify()
+
+
+# Tracks how much of its time each worker spends processing keys
+class WorkerStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._busy = {}
+        self._processed = {}
+        self._since = monotonic()
+
+    def register(self, worker):
+        with self._lock:
+            self._busy.setdefault(worker, 0)
+            self._processed.setdefault(worker, 0)
+
+    def record(self, worker, busy_seconds):
+        with self._lock:
+            self._busy[worker] = self._busy.get(worker, 0) + busy_seconds
+            self._processed[worker] = self._processed.get(worker, 0) + 1
+
+    def collect(self):
+        # Return utilisation and processed keys per worker since the last
+        # collect and start a new window
+        with self._lock:
+            now = monotonic()
+            window = max(now - self._since, 1e-9)
+            stats = {}
+            for worker in self._busy:
+                stats[worker] = (
+                    min(self._busy[worker] / window, 1.0),
+                    self._processed[worker])
+                self._busy[worker] = 0
+                self._processed[worker] = 0
+            self._since = now
+        return stats
+
+
+WORK_QUEUE = WorkQueue()
+WORKER_STATS = WorkerStats()
+
+
+def log_worker_utilisation(queue=WORK_QUEUE, worker_stats=WORKER_STATS):
+    stats = worker_stats.collect()
+    if not stats:
+        return
+
+    utilisation = ', '.join(
+        '{} {:.0%} ({} keys)'.format(worker, busy, processed)
+        for worker, (busy, processed) in sorted(stats.items()))
+    logging.info('worker utilisation: {}, queue depth {}'.format(
+        utilisation, len(queue)))
@@ -0,0 +1,280 @@
+from base64 import b64encode
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from kubernetes import client
+
+from ..mongodb_operator.certificate_rotation import (CertificateExpiryIndex,
+                                                     CertificateRotations,
+                                                     IndexedCertificate,
+                                                     rotate_certificates)
+from ..mongodb_operator.certificates import (get_certificate_authority,
+                                             get_member_certificate)
+from ..mongodb_operator.replicaset_status import (ReplicaSetStatus,
+                                                  ReplicaSetMember, PRIMARY,
+                                                  SECONDARY)
+
+
+CLUSTER_OBJECT = {'metadata': {'name': 'testname123',
+                               'namespace': 'testnamespace456'},
+                  'spec': {'mongodb': {'replicas': 3}}}
+NOW = datetime(2030, 1, 1)
+
+
+def get_secret(name, data, resource_version='1'):
+    return client.V1Secret(
+        metadata=client.V1ObjectMeta(
+            name=name,
+            namespace='testnamespace456',
+            labels={'cluster': 'testname123'},
+            resource_version=resource_version),
+        data=dict((key, b64encode(value.encode('utf-8')).decode('utf-8'))
+                  for key, value in data.items()))
+
+
+def get_certificates():
+    ca_pem, ca_key_pem = get_certificate_authority(
+        'testname123', 'testnamespace456', key_algorithm='ecdsa-p256')
+    member_pem = get_member_certificate(
+        'testname123', 'testnamespace456', 'testname123-0',
+        ca_pem.encode('utf-8'), ca_key_pem.encode('utf-8'),
+        key_algorithm='ecdsa-p256')
+    return ca_pem, member_pem
+
+
+def get_expiring(kind, key, secret='testname123-member-certificates',
+                 not_valid_after=NOW):
+    return IndexedCertificate(not_valid_after, 'testnamespace456',
+                              'testname123', kind, secret, key)
+
+
+def get_status(states):
+    return ReplicaSetStatus(ok=True, members=[
+        ReplicaSetMember(
+            i, 'testname123-{}.testname123.testnamespace456:27017'.format(i),
+            state, health=1)
+        for i, state in enumerate(states)])
+
+
+class TestCertificateExpiryIndex():
+    def test_indexes_cluster_certificates(self):
+        ca_pem, member_pem = get_certificates()
+        index = CertificateExpiryIndex()
+
+        index.update(get_secret('testname123-ca', {'ca.pem': ca_pem}))
+        index.update(get_secret('testname123-member-certificates', {
+            'ca.pem': ca_pem, 'testname123-0.pem': member_pem}))
+        index.update(get_secret('testname123-admin-credentials', {
+            'username': 'admin', 'password': 'secret'}))
+
+        deadline = datetime.utcnow() + timedelta(days=7400)
+        # The CA outlives the certificates it signs
+        assert [(c.kind, c.key) for c in index.expiring(deadline)] == [
+            ('member', 'testname123-0.pem'), ('ca', 'ca.pem')]
+        assert index.expiring(datetime.utcnow()) == []
+        assert index.expiring(
+            deadline, 'testnamespace456', 'othercluster') == []
+
+    @patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+           'get_pem_not_valid_after', return_value=NOW)
+    def test_parses_changed_secrets_only(self, mock_get_pem_not_valid_after):
+        index = CertificateExpiryIndex()
+        secret = get_secret('testname123-ca', {'ca.pem': 'pem'})
+
+        assert index.update(secret) is True
+        assert index.update(secret) is False
+        assert mock_get_pem_not_valid_after.call_count == 1
+
+        assert index.update(get_secret(
+            'testname123-ca', {'ca.pem': 'pem'}, resource_version='2'))
+        assert len(index) == 1
+
+    @patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+           'get_pem_not_valid_after', return_value=NOW)
+    def test_deleted_secret(self, mock_get_pem_not_valid_after):
+        index = CertificateExpiryIndex()
+        secret = get_secret('testname123-ca', {'ca.pem': 'pem'})
+
+        index.handle_event({'type': 'ADDED', 'object': secret})
+        assert len(index) == 1
+        index.handle_event({'type': 'DELETED', 'object': secret})
+        assert len(index) == 0
+
+
+class TestCertificateRotations():
+    def test_limit(self):
+        rotations = CertificateRotations(limit=1)
+
+        assert rotations.acquire('ns', 'a') is True
+        assert rotations.acquire('ns', 'a') is True
+        assert rotations.acquire('ns', 'b') is False
+        rotations.release('ns', 'a')
+        assert rotations.acquire('ns', 'b') is True
+
+    def test_settling(self):
+        rotations = CertificateRotations(settle_seconds=60)
+        rotations.acquire('ns', 'a')
+
+        assert rotations.is_settling('ns', 'a') is False
+        rotations.restarted('ns', 'a')
+        assert rotations.is_settling('ns', 'a') is True
+
+
+@patch('mongodb_operator.mongodb_operator.certificate_rotation.delete_pod',
+       return_value=True)
+@patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+       'update_member_certificates_secret')
+@patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+       'get_replicaset_status')
+@patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+       'CERTIFICATE_EXPIRY')
+class TestRotateCertificates():
+    @patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+           'renew_client_certificate_secret')
+    def test_nothing_expiring(self, mock_renew_client, mock_expiry,
+                              mock_get_status, mock_update_secret,
+                              mock_delete_pod):
+        mock_expiry.expiring.return_value = []
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', CertificateRotations()):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        assert mock_renew_client.called is False
+        assert mock_get_status.called is False
+
+    @patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+           'renew_client_certificate_secret')
+    def test_client_and_ca(self, mock_renew_client, mock_expiry,
+                           mock_get_status, mock_update_secret,
+                           mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('client', 'mongod.pem',
+                         'testname123-client-certificate'),
+            get_expiring('ca', 'ca.pem', 'testname123-ca',
+                         NOW + timedelta(days=10))]
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', CertificateRotations()):
+            assert rotate_certificates(CLUSTER_OBJECT) is True
+
+        mock_renew_client.assert_called_once_with(CLUSTER_OBJECT)
+        # The CA is only reported, no member is restarted
+        assert mock_delete_pod.called is False
+
+    @patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+           'SECRET_INFORMER')
+    def test_secondary_first(self, mock_secret_informer, mock_expiry,
+                             mock_get_status, mock_update_secret,
+                             mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('member', 'testname123-0.pem'),
+            get_expiring('member', 'testname123-2.pem')]
+        mock_get_status.return_value = get_status(
+            [PRIMARY, SECONDARY, SECONDARY])
+
+        rotations = CertificateRotations()
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', rotations):
+            assert rotate_certificates(CLUSTER_OBJECT) is True
+            # Wait for the restarted member before the next one
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        assert mock_update_secret.call_args[1] == {
+            'renew': ['testname123-2']}
+        mock_delete_pod.assert_called_once_with(
+            'testname123-2', 'testnamespace456')
+
+    @patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+           'get_mongo_client')
+    def test_primary_steps_down(self, mock_get_mongo_client, mock_expiry,
+                                mock_get_status, mock_update_secret,
+                                mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('member', 'testname123-0.pem')]
+        mock_get_status.return_value = get_status(
+            [PRIMARY, SECONDARY, SECONDARY])
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', CertificateRotations()):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        mock_get_mongo_client.return_value.admin.command \
+            .assert_called_once_with('replSetStepDown', 60)
+        assert mock_update_secret.called is False
+        assert mock_delete_pod.called is False
+
+    def test_unhealthy(self, mock_expiry, mock_get_status,
+                       mock_update_secret, mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('member', 'testname123-1.pem')]
+        mock_get_status.return_value = get_status([PRIMARY, SECONDARY])
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', CertificateRotations()):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        assert mock_delete_pod.called is False
+
+    def test_unhealthy_cluster_releases_slot(self, mock_expiry,
+                                             mock_get_status,
+                                             mock_update_secret,
+                                             mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('member', 'testname123-1.pem')]
+        mock_get_status.return_value = None
+        rotations = CertificateRotations(limit=1)
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', rotations):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        assert rotations.active() == set()
+        assert rotations.acquire('othernamespace', 'othercluster') is True
+
+    def test_restarting_cluster_keeps_slot(self, mock_expiry,
+                                           mock_get_status,
+                                           mock_update_secret,
+                                           mock_delete_pod):
+        # The restarted member is still rejoining the replica set
+        mock_expiry.expiring.return_value = [
+            get_expiring('member', 'testname123-1.pem')]
+        mock_get_status.return_value = get_status([PRIMARY, SECONDARY])
+        rotations = CertificateRotations(limit=1, settle_seconds=0)
+        rotations.acquire('testnamespace456', 'testname123')
+        rotations.restarted('testnamespace456', 'testname123')
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', rotations):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        assert rotations.active() == set([('testnamespace456', 'testname123')])
+
+    def test_certificates_expiring_with_ca(self, mock_expiry,
+                                           mock_get_status,
+                                           mock_update_secret,
+                                           mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('ca', 'ca.pem', 'testname123-ca'),
+            get_expiring('member', 'testname123-1.pem')]
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', CertificateRotations()):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        # A renewed certificate would expire with the CA again
+        assert mock_get_status.called is False
+        assert mock_delete_pod.called is False
+
+    def test_rotation_limit(self, mock_expiry, mock_get_status,
+                            mock_update_secret, mock_delete_pod):
+        mock_expiry.expiring.return_value = [
+            get_expiring('member', 'testname123-1.pem')]
+        rotations = CertificateRotations(limit=1)
+        rotations.acquire('othernamespace', 'othercluster')
+
+        with patch('mongodb_operator.mongodb_operator.certificate_rotation.'
+                   'CERTIFICATE_ROTATIONS', rotations):
+            assert rotate_certificates(CLUSTER_OBJECT) is False
+
+        assert mock_get_status.called is False
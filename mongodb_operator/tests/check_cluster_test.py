@@ -0,0 +1,163 @@
+from datetime import datetime
+from unittest.mock import patch
+
+from ..mongodb_operator.kubernetes_resources import (get_service_object,
+                                                     get_statefulset_object)
+from ..mongodb_operator.periodical import check_cluster
+from ..mongodb_operator.state_cache import ReconcileStateCache
+from .helpers import get_cluster_object
+
+
+def get_existing(resource, uid, resource_version='1'):
+    # What the informers return for a resource the operator created
+    resource.metadata.uid = uid
+    resource.metadata.resource_version = resource_version
+    return resource
+
+
+@patch('mongodb_operator.mongodb_operator.periodical.rotate_certificates')
+@patch('mongodb_operator.mongodb_operator.periodical.'
+       'check_if_replicaset_needs_setup')
+@patch('mongodb_operator.mongodb_operator.periodical.'
+       'update_member_certificates_secret', return_value=True)
+@patch('mongodb_operator.mongodb_operator.periodical.SECRET_INFORMER')
+@patch('mongodb_operator.mongodb_operator.periodical.'
+       'get_statefulset_replicas', return_value=3)
+@patch('mongodb_operator.mongodb_operator.periodical.VERSION_CACHE',
+       new_callable=ReconcileStateCache)
+@patch('mongodb_operator.mongodb_operator.periodical.SERVICE_INFORMER')
+@patch('mongodb_operator.mongodb_operator.periodical.STATEFULSET_INFORMER')
+@patch('mongodb_operator.mongodb_operator.periodical.create_statefulset')
+@patch('mongodb_operator.mongodb_operator.periodical.orphan_statefulset',
+       return_value=True)
+@patch('mongodb_operator.mongodb_operator.periodical.update_statefulset')
+class TestCheckClusterStatefulset():
+    def test_storage_added(self, mock_update, mock_orphan, mock_create,
+                           mock_statefulset_informer, mock_service_informer,
+                           *args):
+        cluster_object = get_cluster_object()
+        mock_service_informer.get.return_value = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        mock_statefulset_informer.get.return_value = get_existing(
+            get_statefulset_object(cluster_object), 'statefulset-uid')
+
+        cluster_object['spec']['mongodb']['storage'] = {'size': '10Gi'}
+        assert check_cluster(cluster_object) is False
+
+        mock_orphan.assert_called_once_with(cluster_object, ['mongo-data'])
+        # Created again once the old statefulset is gone
+        assert mock_create.called is False
+        assert mock_update.called is False
+
+    def test_waits_for_replaced_statefulset(self, mock_update, mock_orphan,
+                                            mock_create,
+                                            mock_statefulset_informer,
+                                            mock_service_informer, *args):
+        cluster_object = get_cluster_object(storage={'size': '10Gi'})
+        mock_service_informer.get.return_value = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        statefulset = get_existing(
+            get_statefulset_object(get_cluster_object()), 'statefulset-uid')
+        statefulset.metadata.deletion_timestamp = datetime(2030, 1, 1)
+        mock_statefulset_informer.get.return_value = statefulset
+
+        assert check_cluster(cluster_object) is False
+
+        assert mock_orphan.called is False
+        assert mock_create.called is False
+        assert mock_update.called is False
+
+    def test_replaced_statefulset_created(self, mock_update, mock_orphan,
+                                          mock_create,
+                                          mock_statefulset_informer,
+                                          mock_service_informer, *args):
+        cluster_object = get_cluster_object(storage={'size': '10Gi'})
+        mock_service_informer.get.return_value = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        mock_statefulset_informer.get.return_value = None
+        mock_create.return_value = get_existing(
+            get_statefulset_object(cluster_object), 'statefulset-uid-2')
+
+        assert check_cluster(cluster_object) is True
+
+        mock_create.assert_called_once_with(cluster_object, 3)
+
+    @patch('mongodb_operator.mongodb_operator.periodical.logging')
+    def test_storage_resized(self, mock_logging, mock_update, mock_orphan,
+                             mock_create, mock_statefulset_informer,
+                             mock_service_informer, *args):
+        cluster_object = get_cluster_object(storage={'size': '10Gi'})
+        mock_service_informer.get.return_value = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        mock_statefulset_informer.get.return_value = get_existing(
+            get_statefulset_object(cluster_object), 'statefulset-uid')
+
+        cluster_object['spec']['mongodb']['storage']['size'] = '20Gi'
+        cluster_object['spec']['mongodb']['mongodb_limit_memory'] = '1Gi'
+        assert check_cluster(cluster_object) is True
+
+        # The rest of the statefulset is still patched
+        mock_update.assert_called_once_with(
+            cluster_object, 3, keep_volume_claim_templates=True)
+        assert mock_logging.error.called is True
+        assert mock_orphan.called is False
+
+    def test_patchable_change(self, mock_update, mock_orphan, mock_create,
+                              mock_statefulset_informer,
+                              mock_service_informer, *args):
+        cluster_object = get_cluster_object()
+        mock_service_informer.get.return_value = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        mock_statefulset_informer.get.return_value = get_existing(
+            get_statefulset_object(cluster_object), 'statefulset-uid')
+
+        cluster_object['spec']['mongodb']['mongodb_limit_memory'] = '1Gi'
+        assert check_cluster(cluster_object) is True
+
+        mock_update.assert_called_once_with(
+            cluster_object, 3, keep_volume_claim_templates=False)
+        assert mock_orphan.called is False
+
+    @patch('mongodb_operator.mongodb_operator.periodical.update_service')
+    def test_desired_state_not_patched(
+            self, mock_update_service, mock_update, mock_orphan, mock_create,
+            mock_statefulset_informer, mock_service_informer,
+            mock_version_cache, *args):
+        cluster_object = get_cluster_object()
+        service = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        statefulset = get_existing(
+            get_statefulset_object(cluster_object), 'statefulset-uid')
+        mock_service_informer.get.return_value = service
+        mock_statefulset_informer.get.return_value = statefulset
+
+        assert check_cluster(cluster_object) is True
+
+        assert mock_update_service.called is False
+        assert mock_update.called is False
+        assert mock_orphan.called is False
+        # The next check skips the comparison
+        assert len(mock_version_cache) == 2
+        assert check_cluster(cluster_object) is True
+        assert mock_version_cache.stats()['hits'] == 2
+
+    @patch('mongodb_operator.mongodb_operator.periodical.update_service')
+    def test_missing_hash_updated(
+            self, mock_update_service, mock_update, mock_orphan, mock_create,
+            mock_statefulset_informer, mock_service_informer, *args):
+        # E.g. created by an operator version without hash annotations
+        cluster_object = get_cluster_object()
+        service = get_existing(
+            get_service_object(cluster_object), 'service-uid')
+        service.metadata.annotations = None
+        statefulset = get_existing(
+            get_statefulset_object(cluster_object), 'statefulset-uid')
+        statefulset.metadata.annotations = None
+        mock_service_informer.get.return_value = service
+        mock_statefulset_informer.get.return_value = statefulset
+
+        assert check_cluster(cluster_object) is True
+
+        mock_update_service.assert_called_once_with(cluster_object)
+        mock_update.assert_called_once_with(
+            cluster_object, 3, keep_volume_claim_templates=False)
@@ -0,0 +1,8 @@
+def get_cluster_object(**mongodb):
+    # A MongoDB object as the informer returns it, spec.mongodb holds the
+    # given options on top of three replicas
+    cluster_object = {'metadata': {'name': 'testname123',
+                                   'namespace': 'testnamespace456'},
+                      'spec': {'mongodb': {'replicas': 3}}}
+    cluster_object['spec']['mongodb'].update(mongodb)
+    return cluster_object
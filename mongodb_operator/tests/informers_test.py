@@ -0,0 +1,180 @@
+from unittest.mock import MagicMock, call
+
+from kubernetes import client
+
+from ..mongodb_operator.informers import Informer
+
+
+def get_cluster_object(name, namespace='testnamespace456'):
+    return {'metadata': {'name': name, 'namespace': namespace}}
+
+
+def get_secret(name, cluster, namespace='testnamespace456'):
+    return client.V1Secret(metadata=client.V1ObjectMeta(
+        name=name, namespace=namespace, labels={'cluster': cluster}))
+
+
+def get_informer(list_result):
+    list_func = MagicMock(return_value=list_result)
+    return Informer('testkind', lambda api_client: list_func), list_func
+
+
+class TestInformerRelist():
+    def test_relist_stores_custom_objects(self):
+        informer, list_func = get_informer({
+            'metadata': {'resourceVersion': '12'},
+            'items': [get_cluster_object('testname123')]})
+
+        informer.relist()
+
+        list_func.assert_called_once_with()
+        assert informer.has_synced() is True
+        assert informer.get('testnamespace456', 'testname123') == \
+            get_cluster_object('testname123')
+        assert informer.get('testnamespace456', 'missing') is None
+
+    def test_relist_indexes_by_cluster_label(self):
+        informer, list_func = get_informer(client.V1SecretList(
+            metadata=client.V1ListMeta(resource_version='12'),
+            items=[get_secret('testname123-ca', 'testname123'),
+                   get_secret('testname123-admin', 'testname123'),
+                   get_secret('other-ca', 'other')]))
+
+        informer.relist()
+
+        names = sorted(
+            s.metadata.name
+            for s in informer.by_cluster('testnamespace456', 'testname123'))
+        assert names == ['testname123-admin', 'testname123-ca']
+        assert informer.by_cluster('testnamespace456', 'missing') == []
+
+    def test_relist_dispatches_deleted(self):
+        informer, list_func = get_informer({
+            'metadata': {'resourceVersion': '12'},
+            'items': [get_cluster_object('testname123')]})
+        informer.relist()
+
+        handler = MagicMock()
+        informer.add_handler(handler)
+        list_func.return_value = {
+            'metadata': {'resourceVersion': '13'}, 'items': []}
+        informer.relist()
+
+        handler.assert_called_once_with({
+            'type': 'DELETED', 'object': get_cluster_object('testname123')})
+        assert informer.keys() == set()
+
+
+class TestInformerHandleEvent():
+    def test_added_and_deleted(self):
+        informer, list_func = get_informer(None)
+        handler = MagicMock()
+        informer.add_handler(handler)
+        secret = get_secret('testname123-ca', 'testname123')
+
+        informer.handle_event({'type': 'ADDED', 'object': secret})
+        assert informer.get('testnamespace456', 'testname123-ca') is secret
+        assert informer.by_cluster(
+            'testnamespace456', 'testname123') == [secret]
+
+        informer.handle_event({'type': 'DELETED', 'object': secret})
+        assert informer.get('testnamespace456', 'testname123-ca') is None
+        assert informer.by_cluster('testnamespace456', 'testname123') == []
+        assert handler.call_count == 2
+
+    def test_malformed_event(self):
+        informer, list_func = get_informer(None)
+        handler = MagicMock()
+        informer.add_handler(handler)
+
+        informer.handle_event({})
+
+        assert handler.called is False
+
+    def test_failing_handler(self):
+        informer, list_func = get_informer(None)
+        informer.add_handler(MagicMock(side_effect=Exception()))
+        cluster_object = get_cluster_object('testname123')
+
+        informer.handle_event({'type': 'ADDED', 'object': cluster_object})
+
+        assert informer.get('testnamespace456', 'testname123') is \
+            cluster_object
+
+
+class TestInformerResume():
+    def get_cluster_object(self, resource_version):
+        cluster_object = get_cluster_object('testname123')
+        cluster_object['metadata']['resourceVersion'] = resource_version
+        return cluster_object
+
+    def test_relist_only_dispatches_changes(self):
+        informer, list_func = get_informer({
+            'metadata': {'resourceVersion': '12'},
+            'items': [self.get_cluster_object('10')]})
+        informer.relist()
+        handler = MagicMock()
+        informer.add_handler(handler)
+
+        informer.relist()
+        assert handler.called is False
+
+        list_func.return_value = {
+            'metadata': {'resourceVersion': '14'},
+            'items': [self.get_cluster_object('13')]}
+        informer.relist()
+        handler.assert_called_once_with({
+            'type': 'MODIFIED', 'object': self.get_cluster_object('13')})
+
+    def test_event_moves_resource_version(self):
+        informer, list_func = get_informer(None)
+
+        informer.handle_event({
+            'type': 'ADDED', 'object': self.get_cluster_object('15')})
+
+        assert informer._resource_version == '15'
+
+    def test_bookmark_moves_resource_version(self):
+        informer, list_func = get_informer(None)
+        handler = MagicMock()
+        informer.add_handler(handler)
+        bookmark = {'metadata': {'resourceVersion': '20'}}
+
+        informer.handle_event({
+            'type': 'BOOKMARK', 'object': bookmark, 'raw_object': bookmark})
+
+        assert informer._resource_version == '20'
+        assert handler.called is False
+
+    def test_gone_forces_relist(self):
+        informer, list_func = get_informer(None)
+        informer._resource_version = '15'
+        status = {'kind': 'Status', 'code': 410, 'reason': 'Gone'}
+
+        informer.handle_event({
+            'type': 'ERROR', 'object': status, 'raw_object': status})
+
+        assert informer._resource_version is None
+
+
+class TestInformerPagination():
+    def test_relist_follows_continue(self):
+        first_page = client.V1SecretList(
+            metadata=client.V1ListMeta(resource_version='12', _continue='a'),
+            items=[get_secret('testname123-ca', 'testname123')])
+        last_page = client.V1SecretList(
+            metadata=client.V1ListMeta(resource_version='12'),
+            items=[get_secret('other-ca', 'other')])
+        list_func = MagicMock(side_effect=[first_page, last_page])
+        informer = Informer(
+            'secrets', lambda api_client: list_func, page_size=1, label_selector='a=b')
+
+        informer.relist()
+
+        assert list_func.call_args_list == [
+            call(limit=1, label_selector='a=b'),
+            call(limit=1, label_selector='a=b', _continue='a')]
+        assert informer.cluster_keys() == set([
+            ('testnamespace456', 'testname123'),
+            ('testnamespace456', 'other')])
+        assert informer._resource_version == '12'
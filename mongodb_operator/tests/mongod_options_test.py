@@ -0,0 +1,101 @@
+import pytest
+
+from ..mongodb_operator.mongod_options import (parse_memory_quantity,
+                                               get_wiredtiger_cache_size_gb,
+                                               get_max_index_build_memory_mb,
+                                               get_mongod_args,
+                                               get_tuning_args)
+from .helpers import get_cluster_object
+
+
+class TestParseMemoryQuantity():
+    def test_binary_suffixes(self):
+        assert parse_memory_quantity('64Mi') == 64 * 1024 ** 2
+        assert parse_memory_quantity('1.5Gi') == 1.5 * 1024 ** 3
+
+    def test_decimal_suffixes(self):
+        assert parse_memory_quantity('128M') == 128 * 10 ** 6
+        assert parse_memory_quantity('2G') == 2 * 10 ** 9
+
+    def test_plain_and_exponent(self):
+        assert parse_memory_quantity('1024') == 1024
+        assert parse_memory_quantity(1024) == 1024
+        assert parse_memory_quantity('1e9') == 10 ** 9
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            parse_memory_quantity('64MB')
+
+
+class TestWiredTigerCacheSize():
+    def test_from_limit(self):
+        assert get_wiredtiger_cache_size_gb(
+            get_cluster_object(mongodb_limit_memory='8Gi')) == 3.5
+
+    def test_minimum(self):
+        assert get_wiredtiger_cache_size_gb(
+            get_cluster_object(mongodb_limit_memory='128Mi')) == 0.25
+        assert get_wiredtiger_cache_size_gb(get_cluster_object()) == 0.25
+
+    def test_override(self):
+        assert get_wiredtiger_cache_size_gb(get_cluster_object(
+            mongodb_limit_memory='8Gi', wiredtiger_cache_size_gb=2)) == 2
+
+
+class TestMemoryArgs():
+    def test_index_build_memory(self):
+        assert get_max_index_build_memory_mb(
+            get_cluster_object(mongodb_limit_memory='2Gi')) == 204
+        assert get_max_index_build_memory_mb(
+            get_cluster_object(mongodb_limit_memory='16Gi')) == 500
+        assert get_max_index_build_memory_mb(
+            get_cluster_object(mongodb_limit_memory='128Mi')) == 100
+
+    def test_args(self):
+        assert get_mongod_args(
+            get_cluster_object(mongodb_limit_memory='4Gi')) == [
+                '--wiredTigerCacheSizeGB', '1.5',
+                '--setParameter', 'maxIndexBuildMemoryUsageMegabytes=409']
+
+
+class TestTuningArgs():
+    def test_no_tuning(self):
+        assert get_tuning_args(get_cluster_object()) == []
+
+    def test_all_options(self):
+        assert get_tuning_args(get_cluster_object(tuning={
+            'oplog_size_mb': 10240,
+            'network_compressors': ['snappy', 'zlib'],
+            'wiredtiger_block_compressor': 'zlib',
+            'max_incoming_connections': 2000,
+            'slowms': 50})) == [
+                '--oplogSize', '10240',
+                '--networkMessageCompressors', 'snappy,zlib',
+                '--wiredTigerCollectionBlockCompressor', 'zlib',
+                '--maxConns', '2000',
+                '--slowms', '50']
+
+    def test_set_parameter_overrides_derived(self):
+        args = get_mongod_args(get_cluster_object(tuning={'set_parameter': {
+            'maxIndexBuildMemoryUsageMegabytes': 1000,
+            'cursorTimeoutMillis': 60000,
+            'notablescan': False}}))
+
+        assert args[2:] == [
+            '--setParameter', 'cursorTimeoutMillis=60000',
+            '--setParameter', 'maxIndexBuildMemoryUsageMegabytes=1000',
+            '--setParameter', 'notablescan=false']
+
+    @pytest.mark.parametrize('tuning', [
+        {'oplog_size_mb': 0},
+        {'oplog_size_mb': '1024'},
+        {'network_compressors': ['zstd']},
+        {'wiredtiger_block_compressor': 'lz4'},
+        {'slowms': True},
+        {'unknown': 1},
+        {'set_parameter': {'a=b': 1}},
+        {'set_parameter': {'a': [1]}},
+        {'set_parameter': {'enableLocalhostAuthBypass': False}}])
+    def test_invalid(self, tuning):
+        with pytest.raises(ValueError):
+            get_mongod_args(get_cluster_object(tuning=tuning))
@@ -0,0 +1,67 @@
+import os
+from base64 import b64encode
+from unittest.mock import patch
+
+from kubernetes import client
+
+from ..mongodb_operator.mongodb_clients import (get_mongo_client,
+                                                close_mongo_client)
+
+
+CLUSTER_OBJECT = {'metadata': {'name': 'testname123',
+                               'namespace': 'testnamespace456'}}
+HOST = 'testname123-0.testname123.testnamespace456.svc.cluster.local'
+
+
+def encode(data):
+    return b64encode(data.encode('utf-8')).decode('utf-8')
+
+
+def get_secret(suffix, resource_version='1'):
+    return client.V1Secret(
+        metadata=client.V1ObjectMeta(
+            name='testname123{}'.format(suffix),
+            resource_version=resource_version),
+        data={'mongod.pem': encode('cert'), 'ca.pem': encode('ca'),
+              'username': encode('root'), 'password': encode('secret')})
+
+
+@patch('mongodb_operator.mongodb_operator.mongodb_clients.MongoClient')
+@patch('mongodb_operator.mongodb_operator.mongodb_clients.get_cluster_secret')
+class TestGetMongoClient():
+    def test_client_is_reused(self, mock_get_secret, mock_mongo_client):
+        mock_get_secret.side_effect = lambda n, ns, suffix: get_secret(suffix)
+
+        first = get_mongo_client(CLUSTER_OBJECT, HOST)
+        second = get_mongo_client(CLUSTER_OBJECT, HOST)
+
+        assert first is second
+        assert mock_mongo_client.call_count == 1
+        kwargs = mock_mongo_client.call_args[1]
+        assert kwargs['username'] == 'root'
+        assert kwargs['password'] == 'secret'
+        assert kwargs['tls'] is True
+        with open(kwargs['tlsCertificateKeyFile']) as pem_file:
+            assert pem_file.read() == 'cert'
+
+        close_mongo_client('testnamespace456', 'testname123')
+        assert os.path.exists(kwargs['tlsCertificateKeyFile']) is False
+
+    def test_new_client_on_rotated_secret(self, mock_get_secret,
+                                          mock_mongo_client):
+        mock_get_secret.side_effect = lambda n, ns, suffix: get_secret(suffix)
+        get_mongo_client(CLUSTER_OBJECT, HOST)
+
+        mock_get_secret.side_effect = \
+            lambda n, ns, suffix: get_secret(suffix, '2')
+        get_mongo_client(CLUSTER_OBJECT, HOST)
+
+        assert mock_mongo_client.call_count == 2
+        assert mock_mongo_client.return_value.close.call_count == 1
+        close_mongo_client('testnamespace456', 'testname123')
+
+    def test_missing_secrets(self, mock_get_secret, mock_mongo_client):
+        mock_get_secret.return_value = None
+
+        assert get_mongo_client(CLUSTER_OBJECT, HOST) is None
+        assert mock_mongo_client.called is False
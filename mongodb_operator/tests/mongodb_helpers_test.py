@@ -0,0 +1,291 @@
+from unittest.mock import patch
+
+from pymongo.errors import AutoReconnect
+
+from ..mongodb_operator.mongodb_helpers import (
+    check_if_replicaset_needs_setup, find_primary, get_member_id,
+    get_statefulset_replicas, scale_replicaset)
+from ..mongodb_operator.kubernetes_resources import get_statefulset_object
+from ..mongodb_operator.replicaset_status import (ReplicaSetStatus,
+                                                  ReplicaSetMember, PRIMARY,
+                                                  SECONDARY, STARTUP2)
+
+
+def get_cluster_object(phase=None):
+    cluster_object = {'metadata': {'name': 'testname123',
+                                   'namespace': 'testnamespace456'},
+                      'spec': {'mongodb': {'replicas': 3}}}
+    if phase:
+        cluster_object['status'] = {'phase': phase}
+    return cluster_object
+
+
+def get_host(member_id):
+    return 'testname123-{}.testname123.testnamespace456.svc.cluster.local' \
+        .format(member_id)
+
+
+def get_status(states):
+    return ReplicaSetStatus(ok=True, members=[
+        ReplicaSetMember(i, '{}:27017'.format(get_host(i)), state)
+        for i, state in enumerate(states)])
+
+
+def get_config(members):
+    return {'config': {'_id': 'testname123', 'version': 3, 'members': [
+        dict({'_id': i, 'host': '{}:27017'.format(get_host(i))}, **member)
+        for i, member in enumerate(members)]}}
+
+
+def get_statefulset(replicas):
+    return get_statefulset_object(get_cluster_object(), replicas)
+
+
+class TestGetStatefulsetReplicas():
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'STATEFULSET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_STATUS')
+    def test_members_not_removed_yet(self, mock_status, mock_informer):
+        mock_status.get.return_value = get_status([PRIMARY, SECONDARY,
+                                                   SECONDARY])
+        cluster_object = get_cluster_object()
+        cluster_object['spec']['mongodb']['replicas'] = 1
+
+        assert get_statefulset_replicas(cluster_object) == 3
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'STATEFULSET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_STATUS')
+    def test_members_removed(self, mock_status, mock_informer):
+        mock_status.get.return_value = get_status([PRIMARY])
+        mock_informer.get.return_value = get_statefulset(3)
+        cluster_object = get_cluster_object()
+        cluster_object['spec']['mongodb']['replicas'] = 1
+
+        assert get_statefulset_replicas(cluster_object) == 1
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'STATEFULSET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_STATUS')
+    def test_status_unknown_during_scale_down(self, mock_status,
+                                              mock_informer):
+        # E.g. after a restart of the operator the statefulset keeps its size
+        mock_status.get.return_value = None
+        mock_informer.get.return_value = get_statefulset(3)
+        cluster_object = get_cluster_object()
+        cluster_object['spec']['mongodb']['replicas'] = 1
+
+        assert get_statefulset_replicas(cluster_object) == 3
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'STATEFULSET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_STATUS')
+    def test_status_unknown_during_scale_up(self, mock_status,
+                                            mock_informer):
+        mock_status.get.return_value = None
+        mock_informer.get.return_value = get_statefulset(3)
+        cluster_object = get_cluster_object()
+        cluster_object['spec']['mongodb']['replicas'] = 5
+
+        assert get_statefulset_replicas(cluster_object) == 5
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'STATEFULSET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_STATUS')
+    def test_new_cluster(self, mock_status, mock_informer):
+        mock_status.get.return_value = None
+        mock_informer.get.return_value = None
+
+        assert get_statefulset_replicas(get_cluster_object()) == 3
+
+
+class TestCheckIfReplicasetNeedsSetup():
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'exec_replicaset_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'get_replicaset_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_STATUS')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_PROBES')
+    def test_settled_cluster_not_due(self, mock_probes, mock_status,
+                                     mock_get_status, mock_exec_status):
+        mock_probes.is_due.return_value = False
+        mock_status.get.return_value = get_status([PRIMARY, SECONDARY,
+                                                   SECONDARY])
+
+        check_if_replicaset_needs_setup(get_cluster_object('UsersCreated'))
+
+        assert mock_get_status.called is False
+        assert mock_exec_status.called is False
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'exec_replicaset_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'get_replicaset_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'REPLICASET_PROBES')
+    def test_settled_cluster_probed_through_driver(
+            self, mock_probes, mock_get_status, mock_exec_status):
+        mock_probes.is_due.return_value = True
+        mock_get_status.return_value = ReplicaSetStatus(ok=True)
+
+        check_if_replicaset_needs_setup(get_cluster_object('UsersCreated'))
+
+        mock_probes.probed.assert_called_once_with(
+            'testnamespace456', 'testname123', False)
+        assert mock_exec_status.called is False
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'set_mongodb_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'initiate_replicaset', return_value=True)
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'exec_replicaset_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'get_replicaset_status', return_value=None)
+    def test_new_cluster_initialized(self, mock_get_status, mock_exec_status,
+                                     mock_initiate, mock_set_status):
+        cluster_object = get_cluster_object()
+        mock_exec_status.return_value = ReplicaSetStatus.from_document({
+            'ok': 0, 'code': 94, 'codeName': 'NotYetInitialized'})
+
+        check_if_replicaset_needs_setup(cluster_object)
+
+        assert mock_initiate.called is True
+        mock_set_status.assert_called_once_with(
+            cluster_object, {'phase': 'Initialized'})
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'set_mongodb_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'create_users', return_value=True)
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'exec_replicaset_status')
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.'
+           'get_replicaset_status', return_value=None)
+    def test_initialized_cluster_users_created(
+            self, mock_get_status, mock_exec_status, mock_create_users,
+            mock_set_status):
+        cluster_object = get_cluster_object('Initialized')
+        mock_exec_status.return_value = ReplicaSetStatus(ok=True)
+
+        check_if_replicaset_needs_setup(cluster_object)
+
+        assert mock_create_users.called is True
+        mock_set_status.assert_called_once_with(
+            cluster_object, {'phase': 'UsersCreated'})
+
+
+class TestFindPrimary():
+    def test_get_member_id(self):
+        assert get_member_id(
+            'testname123-2.testname123.testnamespace456.svc.cluster.local:'
+            '27017', 'testname123') == 2
+        assert get_member_id('other-2:27017', 'testname123') is None
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.is_master')
+    def test_member_0_knows_primary(self, mock_is_master):
+        mock_is_master.return_value = {
+            'ismaster': False,
+            'primary': 'testname123-4.testname123.testnamespace456:27017'}
+
+        assert find_primary('testname123', 'testnamespace456', 7) == 4
+        mock_is_master.assert_called_once_with(
+            'testname123', 'testnamespace456', 0)
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.is_master')
+    def test_other_members_probed(self, mock_is_master):
+        def is_master(name, namespace, member_id):
+            if member_id == 0:
+                return None
+            return {'ismaster': member_id == 5}
+        mock_is_master.side_effect = is_master
+
+        assert find_primary('testname123', 'testnamespace456', 7) == 5
+        assert mock_is_master.call_count == 7
+
+
+@patch('mongodb_operator.mongodb_operator.mongodb_helpers.get_mongo_client')
+class TestScaleReplicaset():
+    def get_cluster_object(self, replicas):
+        cluster_object = get_cluster_object('UsersCreated')
+        cluster_object['spec']['mongodb']['replicas'] = replicas
+        return cluster_object
+
+    def get_reconfig(self, mock_get_mongo_client):
+        command = mock_get_mongo_client.return_value.admin.command
+        assert command.call_args[0][0] == 'replSetReconfig'
+        return command.call_args[0][1]
+
+    def test_add_non_voting_member(self, mock_get_mongo_client):
+        mock_get_mongo_client.return_value.admin.command.return_value = \
+            get_config([{}, {}, {}])
+
+        assert scale_replicaset(
+            self.get_cluster_object(5),
+            get_status([PRIMARY, SECONDARY, SECONDARY])) is True
+
+        config = self.get_reconfig(mock_get_mongo_client)
+        assert config['version'] == 4
+        assert config['members'][-1] == {
+            '_id': 3, 'host': get_host(3), 'priority': 0, 'votes': 0}
+
+    def test_wait_for_initial_sync(self, mock_get_mongo_client):
+        mock_get_mongo_client.return_value.admin.command.return_value = \
+            get_config([{}, {}, {}, {'votes': 0, 'priority': 0}])
+
+        assert scale_replicaset(
+            self.get_cluster_object(5),
+            get_status([PRIMARY, SECONDARY, SECONDARY, STARTUP2])) is False
+
+    def test_promote_synced_member(self, mock_get_mongo_client):
+        mock_get_mongo_client.return_value.admin.command.return_value = \
+            get_config([{}, {}, {}, {'votes': 0, 'priority': 0}])
+
+        assert scale_replicaset(
+            self.get_cluster_object(5),
+            get_status([PRIMARY, SECONDARY, SECONDARY, SECONDARY])) is True
+
+        config = self.get_reconfig(mock_get_mongo_client)
+        assert config['members'][3]['votes'] == 1
+        assert config['members'][3]['priority'] == 1
+
+    def test_remove_highest_member(self, mock_get_mongo_client):
+        mock_get_mongo_client.return_value.admin.command.return_value = \
+            get_config([{}, {}, {}, {}, {}])
+
+        assert scale_replicaset(
+            self.get_cluster_object(3),
+            get_status([PRIMARY] + [SECONDARY] * 4)) is True
+
+        config = self.get_reconfig(mock_get_mongo_client)
+        assert [m['_id'] for m in config['members']] == [0, 1, 2, 3]
+
+    def test_step_down_removed_primary(self, mock_get_mongo_client):
+        mock_get_mongo_client.return_value.admin.command.return_value = \
+            get_config([{}, {}, {}, {}])
+
+        assert scale_replicaset(
+            self.get_cluster_object(3),
+            get_status([SECONDARY] * 3 + [PRIMARY])) is False
+
+        mock_get_mongo_client.return_value.admin.command.assert_called_with(
+            'replSetStepDown', 60)
+
+    @patch('mongodb_operator.mongodb_operator.mongodb_helpers.logging')
+    def test_step_down_closes_connections(self, mock_logging,
+                                          mock_get_mongo_client):
+        mock_get_mongo_client.return_value.admin.command.side_effect = [
+            get_config([{}, {}, {}, {}]), AutoReconnect('connection closed')]
+
+        assert scale_replicaset(
+            self.get_cluster_object(3),
+            get_status([SECONDARY] * 3 + [PRIMARY])) is False
+
+        assert mock_logging.error.called is False
@@ -0,0 +1,147 @@
+from base64 import b64encode
+from unittest.mock import patch
+
+from kubernetes import client
+
+from ..mongodb_operator.kubernetes_helpers import (
+    create_member_certificates_secret, get_wordlist, provision_secrets)
+
+
+CLUSTER_OBJECT = {'metadata': {'name': 'testname123',
+                               'namespace': 'testnamespace456'},
+                  'spec': {'mongodb': {'replicas': 3}}}
+WORDS = ['correct', 'horse', 'battery', 'staple']
+
+
+def get_secret(name_suffix, data=None):
+    return client.V1Secret(
+        metadata=client.V1ObjectMeta(
+            name='testname123{}'.format(name_suffix),
+            namespace='testnamespace456'),
+        data=dict((key, b64encode(value).decode('utf-8'))
+                  for key, value in (data or {}).items()))
+
+
+def get_created(mock_create_secret):
+    return [call[0][1] for call in mock_create_secret.call_args_list]
+
+
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.'
+       'generate_wordlist', return_value=WORDS)
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.'
+       'get_member_certificates', return_value={})
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.'
+       'get_client_certificate', return_value='client-cert')
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.'
+       'get_certificate_authority', return_value=('ca-cert', 'ca-key'))
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.create_secret',
+       return_value=True)
+class TestProvisionSecrets():
+    def teardown_method(self, method):
+        # Don't leave the mocked wordlist behind for other tests
+        get_wordlist.cache_clear()
+
+    def test_creates_missing_secrets_only(self, mock_create_secret,
+                                          mock_get_ca, mock_get_client,
+                                          mock_get_members, *args):
+        secrets = [
+            get_secret('-admin-credentials'),
+            get_secret('-ca', {'ca.pem': b'ca-cert',
+                               'ca-key.pem': b'ca-key'}),
+            get_secret('-member-certificates')]
+
+        assert provision_secrets(CLUSTER_OBJECT, 3, secrets) is True
+
+        assert get_created(mock_create_secret) == [
+            '-client-certificate', '-monitoring-credentials']
+        # Signed by the existing CA
+        assert mock_get_ca.called is False
+        mock_get_client.assert_called_once_with(
+            'testname123', 'testnamespace456', b'ca-cert', b'ca-key',
+            key_algorithm='rsa-2048')
+        assert mock_get_members.called is False
+
+    def test_nothing_missing(self, mock_create_secret, mock_get_ca, *args):
+        secrets = [get_secret(name_suffix, {'ca.pem': b'ca-cert',
+                                            'ca-key.pem': b'ca-key'})
+                   for name_suffix in ['-admin-credentials',
+                                       '-monitoring-credentials', '-ca',
+                                       '-client-certificate',
+                                       '-member-certificates']]
+
+        assert provision_secrets(CLUSTER_OBJECT, 3, secrets) is True
+
+        assert mock_create_secret.called is False
+        assert mock_get_ca.called is False
+
+    def test_ca_created_first(self, mock_create_secret, mock_get_ca,
+                              mock_get_client, mock_get_members, *args):
+        assert provision_secrets(CLUSTER_OBJECT, 3, []) is True
+
+        created = get_created(mock_create_secret)
+        assert created[0] == '-ca'
+        assert sorted(created[1:]) == [
+            '-admin-credentials', '-client-certificate',
+            '-member-certificates', '-monitoring-credentials']
+        assert mock_create_secret.call_args_list[0][0][2] == {
+            'ca.pem': 'ca-cert', 'ca-key.pem': 'ca-key'}
+        assert mock_get_members.call_args[0][1:] == (
+            b'ca-cert', b'ca-key',
+            ['testname123-0', 'testname123-1', 'testname123-2'])
+
+    def test_ca_failure(self, mock_create_secret, *args):
+        mock_create_secret.return_value = False
+
+        assert provision_secrets(CLUSTER_OBJECT, 3, []) is False
+
+        # The certificates it signed are useless without it
+        assert get_created(mock_create_secret) == ['-ca']
+
+    def test_failed_secret(self, mock_create_secret, *args):
+        mock_create_secret.side_effect = \
+            lambda cluster_object, name_suffix, string_data: \
+            name_suffix != '-monitoring-credentials'
+
+        assert provision_secrets(CLUSTER_OBJECT, 3, []) is False
+        assert len(get_created(mock_create_secret)) == 5
+
+    def test_wordlist_loaded_once(self, mock_create_secret, mock_get_ca,
+                                  mock_get_client, mock_get_members,
+                                  mock_generate_wordlist):
+        get_wordlist.cache_clear()
+
+        assert provision_secrets(CLUSTER_OBJECT, 3, []) is True
+        assert provision_secrets(CLUSTER_OBJECT, 3, []) is True
+
+        assert mock_generate_wordlist.call_count == 1
+        for call in mock_create_secret.call_args_list:
+            if call[0][1] == '-admin-credentials':
+                password = call[0][2]['password']
+        assert set(password.split('-')) <= set(WORDS)
+
+
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.'
+       'get_member_certificates', return_value={'testname123-0.pem': 'pem'})
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.read_secret')
+@patch('mongodb_operator.mongodb_operator.kubernetes_helpers.create_secret',
+       return_value=True)
+class TestCreateMemberCertificatesSecret():
+    def test_signed_by_existing_ca(self, mock_create_secret,
+                                   mock_read_secret, mock_get_members):
+        mock_read_secret.return_value = get_secret(
+            '-ca', {'ca.pem': b'ca-cert', 'ca-key.pem': b'ca-key'})
+
+        assert create_member_certificates_secret(CLUSTER_OBJECT, 1) is True
+
+        mock_get_members.assert_called_once_with(
+            CLUSTER_OBJECT, b'ca-cert', b'ca-key', ['testname123-0'])
+        mock_create_secret.assert_called_once_with(
+            CLUSTER_OBJECT, '-member-certificates',
+            {'testname123-0.pem': 'pem', 'ca.pem': 'ca-cert'})
+
+    def test_missing_ca(self, mock_create_secret, mock_read_secret,
+                        mock_get_members):
+        mock_read_secret.return_value = False
+
+        assert create_member_certificates_secret(CLUSTER_OBJECT, 1) is False
+        assert mock_create_secret.called is False
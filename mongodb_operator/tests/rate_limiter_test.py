@@ -0,0 +1,66 @@
+from unittest.mock import patch
+
+from ..mongodb_operator.rate_limiter import (TokenBucket, ApiCallStats,
+                                             get_verb, get_resource)
+
+
+class TestTokenBucket():
+    @patch('mongodb_operator.mongodb_operator.rate_limiter.monotonic')
+    def test_burst_then_throttle(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        bucket = TokenBucket(qps=2, burst=3)
+
+        assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+        assert bucket.reserve() == 0.5
+        assert bucket.reserve() == 1.0
+
+    @patch('mongodb_operator.mongodb_operator.rate_limiter.monotonic')
+    def test_refill_caps_at_burst(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        bucket = TokenBucket(qps=2, burst=2)
+        bucket.reserve()
+        bucket.reserve()
+
+        mock_monotonic.return_value = 200
+        assert [bucket.reserve() for _ in range(2)] == [0, 0]
+        assert bucket.reserve() == 0.5
+
+    def test_disabled(self):
+        bucket = TokenBucket(qps=0)
+
+        assert all(bucket.reserve() == 0 for _ in range(100))
+
+
+class TestApiCallStats():
+    @patch('mongodb_operator.mongodb_operator.rate_limiter.monotonic')
+    def test_collect_resets_window(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        api_call_stats = ApiCallStats()
+        api_call_stats.record('get', 'secrets', 0.1)
+        api_call_stats.record('get', 'secrets', 0.3, 1)
+
+        mock_monotonic.return_value = 10
+        assert api_call_stats.collect() == (
+            {('get', 'secrets'): (2, 0.4, 1)}, 10)
+        assert api_call_stats.collect() == ({}, 0)
+
+
+class TestApiCallNames():
+    def test_verbs(self):
+        assert get_verb('GET', {'name': 'a'}, []) == 'get'
+        assert get_verb('GET', {}, [('limit', 500)]) == 'list'
+        assert get_verb('GET', {}, [('watch', True)]) == 'watch'
+        assert get_verb('POST', {}, []) == 'create'
+        assert get_verb('PUT', {'name': 'a'}, []) == 'update'
+
+    def test_resources(self):
+        assert get_resource(
+            '/api/v1/namespaces/{namespace}/secrets/{name}',
+            {'namespace': 'a', 'name': 'b'}) == 'secrets'
+        assert get_resource('/api/v1/secrets', {}) == 'secrets'
+        assert get_resource(
+            '/api/v1/namespaces/{namespace}/pods/{name}/exec',
+            {'namespace': 'a', 'name': 'b'}) == 'pods/exec'
+        assert get_resource(
+            '/apis/{group}/{version}/namespaces/{namespace}/{plural}/{name}',
+            {'plural': 'mongodbs', 'name': 'b'}) == 'mongodbs'
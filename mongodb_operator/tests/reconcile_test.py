@@ -0,0 +1,129 @@
+from unittest.mock import patch
+from copy import deepcopy
+
+from kubernetes import client
+
+from ..mongodb_operator.reconcile import reconcile
+
+
+CLUSTER_OBJECT = {'metadata': {'name': 'testname123',
+                               'namespace': 'testnamespace456'}}
+KEY = ('testnamespace456', 'testname123')
+
+
+def get_secrets(name, suffixes):
+    return [client.V1Secret(metadata=client.V1ObjectMeta(
+        name='{}{}'.format(name, suffix))) for suffix in suffixes]
+
+
+class TestReconcile():
+    @patch('mongodb_operator.mongodb_operator.reconcile.check_cluster')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=False)
+    def test_not_synced(self, mock_informers_synced, mock_check_cluster):
+        assert reconcile(KEY) is False
+        assert mock_check_cluster.called is False
+
+    @patch('mongodb_operator.mongodb_operator.reconcile.delete')
+    @patch('mongodb_operator.mongodb_operator.reconcile.MONGODB_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=True)
+    def test_deleted_cluster(self, mock_informers_synced, mock_informer,
+                             mock_delete):
+        mock_informer.get.return_value = None
+
+        assert reconcile(KEY) is True
+        mock_delete.assert_called_once_with(CLUSTER_OBJECT)
+
+    @patch('mongodb_operator.mongodb_operator.reconcile.check_cluster')
+    @patch('mongodb_operator.mongodb_operator.reconcile.add',
+           return_value=True)
+    @patch('mongodb_operator.mongodb_operator.reconcile.add_finalizer',
+           return_value=CLUSTER_OBJECT)
+    @patch('mongodb_operator.mongodb_operator.reconcile.SECRET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.MONGODB_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=True)
+    def test_new_cluster(self, mock_informers_synced, mock_informer,
+                         mock_secret_informer, mock_add_finalizer, mock_add,
+                         mock_check_cluster):
+        mock_informer.get.return_value = CLUSTER_OBJECT
+        mock_secret_informer.by_cluster.return_value = get_secrets(
+            'testname123', ['-ca'])
+
+        assert reconcile(KEY) is True
+        mock_add.assert_called_once_with(CLUSTER_OBJECT)
+        assert mock_check_cluster.called is False
+
+    @patch('mongodb_operator.mongodb_operator.reconcile.check_cluster')
+    @patch('mongodb_operator.mongodb_operator.reconcile.add',
+           return_value=False)
+    @patch('mongodb_operator.mongodb_operator.reconcile.add_finalizer',
+           return_value=CLUSTER_OBJECT)
+    @patch('mongodb_operator.mongodb_operator.reconcile.SECRET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.MONGODB_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=True)
+    def test_new_cluster_failed(self, mock_informers_synced, mock_informer,
+                                mock_secret_informer, mock_add_finalizer,
+                                mock_add, mock_check_cluster):
+        mock_informer.get.return_value = CLUSTER_OBJECT
+        mock_secret_informer.by_cluster.return_value = []
+
+        # Retried with backoff instead of waiting for the periodic check
+        assert reconcile(KEY) is False
+        assert mock_check_cluster.called is False
+
+    @patch('mongodb_operator.mongodb_operator.reconcile.check_cluster',
+           return_value=False)
+    @patch('mongodb_operator.mongodb_operator.reconcile.add')
+    @patch('mongodb_operator.mongodb_operator.reconcile.add_finalizer',
+           return_value=CLUSTER_OBJECT)
+    @patch('mongodb_operator.mongodb_operator.reconcile.SECRET_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.MONGODB_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=True)
+    def test_existing_cluster(self, mock_informers_synced, mock_informer,
+                              mock_secret_informer, mock_add_finalizer,
+                              mock_add, mock_check_cluster):
+        mock_informer.get.return_value = CLUSTER_OBJECT
+        mock_secret_informer.by_cluster.return_value = get_secrets(
+            'testname123', ['-ca', '-client-certificate',
+                            '-admin-credentials', '-monitoring-credentials'])
+
+        assert reconcile(KEY) is False
+        assert mock_add.called is False
+        mock_check_cluster.assert_called_once_with(CLUSTER_OBJECT)
+
+    @patch('mongodb_operator.mongodb_operator.reconcile.check_cluster')
+    @patch('mongodb_operator.mongodb_operator.reconcile.add_finalizer',
+           return_value=False)
+    @patch('mongodb_operator.mongodb_operator.reconcile.MONGODB_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=True)
+    def test_finalizer_failed(self, mock_informers_synced, mock_informer,
+                              mock_add_finalizer, mock_check_cluster):
+        mock_informer.get.return_value = CLUSTER_OBJECT
+
+        assert reconcile(KEY) is False
+        assert mock_check_cluster.called is False
+
+    @patch('mongodb_operator.mongodb_operator.reconcile.check_cluster')
+    @patch('mongodb_operator.mongodb_operator.reconcile.remove_finalizer')
+    @patch('mongodb_operator.mongodb_operator.reconcile.delete')
+    @patch('mongodb_operator.mongodb_operator.reconcile.MONGODB_INFORMER')
+    @patch('mongodb_operator.mongodb_operator.reconcile.informers_synced',
+           return_value=True)
+    def test_deleting_cluster(self, mock_informers_synced, mock_informer,
+                              mock_delete, mock_remove_finalizer,
+                              mock_check_cluster):
+        cluster_object = deepcopy(CLUSTER_OBJECT)
+        cluster_object['metadata']['deletionTimestamp'] = \
+            '2018-05-01T12:00:00Z'
+        mock_informer.get.return_value = cluster_object
+        mock_remove_finalizer.return_value = cluster_object
+
+        assert reconcile(KEY) is True
+        mock_delete.assert_called_once_with(cluster_object)
+        mock_remove_finalizer.assert_called_once_with(cluster_object)
+        assert mock_check_cluster.called is False
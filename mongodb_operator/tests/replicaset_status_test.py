@@ -0,0 +1,97 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from ..mongodb_operator.replicaset_status import (ReplicaSetStatus,
+                                                  ReplicaSetStatusCache,
+                                                  ProbeSchedule,
+                                                  parse_shell_json, PRIMARY,
+                                                  SECONDARY)
+
+
+STATUS_DOCUMENT = {
+    'set': 'testname123',
+    'ok': 1,
+    'members': [
+        {'_id': 0, 'name': 'testname123-0:27017', 'state': 1,
+         'stateStr': 'PRIMARY', 'health': 1,
+         'optime': {'ts': {'t': 1525176000, 'i': 1}, 't': 1},
+         'configVersion': 2, 'self': True},
+        {'_id': 1, 'name': 'testname123-1:27017', 'state': 2,
+         'stateStr': 'SECONDARY', 'health': 1,
+         'optime': {'ts': {'t': 1525175990, 'i': 3}, 't': 1},
+         'configVersion': 2}]}
+STATUS_OUTPUT = '2018-05-01T12:00:00.000+0000 W NETWORK  warning\n{}\n'.format(
+    json.dumps(STATUS_DOCUMENT))
+
+
+class TestParseShellJSON():
+    def test_last_json_line(self):
+        document = parse_shell_json('warning\n{"ok":0,"code":94}\n')
+
+        assert document == {'ok': 0, 'code': 94}
+
+    def test_no_json(self):
+        with pytest.raises(ValueError):
+            parse_shell_json('Error: couldn\'t connect to server')
+
+
+class TestReplicaSetStatus():
+    def test_members(self):
+        status = ReplicaSetStatus.from_document(
+            parse_shell_json(STATUS_OUTPUT))
+
+        assert status.ok is True
+        assert status.initialized is True
+        assert status.set_name == 'testname123'
+        assert [m.state for m in status.members] == [PRIMARY, SECONDARY]
+        assert status.primary.name == 'testname123-0:27017'
+        assert status.config_version == 2
+        assert status.member('testname123-1:27017').optime == \
+            (1525175990, 3)
+
+    def test_not_yet_initialized(self):
+        status = ReplicaSetStatus.from_document({
+            'ok': 0, 'code': 94, 'codeName': 'NotYetInitialized'})
+
+        assert status.initialized is False
+        assert status.primary is None
+
+    def test_unauthorized(self):
+        status = ReplicaSetStatus.from_document({
+            'ok': 0, 'code': 13, 'codeName': 'Unauthorized'})
+
+        assert status.initialized is True
+        assert status.unauthorized is True
+
+
+class TestReplicaSetStatusCache():
+    def test_set_get_invalidate(self):
+        cache = ReplicaSetStatusCache()
+        status = ReplicaSetStatus(ok=True)
+
+        cache.set('testnamespace456', 'testname123', status)
+        assert cache.get('testnamespace456', 'testname123') is status
+        assert cache.get('testnamespace456', 'testname123', max_age=-1) is \
+            None
+
+        cache.invalidate('testnamespace456', 'testname123')
+        assert cache.get('testnamespace456', 'testname123') is None
+
+
+class TestProbeSchedule():
+    @patch('mongodb_operator.mongodb_operator.replicaset_status.monotonic')
+    def test_backoff_while_healthy(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        schedule = ProbeSchedule(base_interval=60, max_interval=200)
+
+        assert schedule.is_due('testnamespace456', 'testname123') is True
+        assert schedule.probed('testnamespace456', 'testname123', True) == 60
+        assert schedule.is_due('testnamespace456', 'testname123') is False
+        assert schedule.probed('testnamespace456', 'testname123', True) == 120
+        assert schedule.probed('testnamespace456', 'testname123', True) == 200
+
+        assert schedule.probed('testnamespace456', 'testname123', False) == 60
+        mock_monotonic.return_value = 160
+        assert schedule.is_due('testnamespace456', 'testname123') is True
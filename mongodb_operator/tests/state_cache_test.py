@@ -0,0 +1,101 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import pytest
+
+from ..mongodb_operator.state_cache import ReconcileStateCache
+
+
+class TestReconcileStateCache():
+    def test_hit_and_miss(self):
+        cache = ReconcileStateCache()
+        cache.set('uid-1', '10')
+
+        assert cache.is_cached('uid-1', '10') is True
+        assert cache.is_cached('uid-1', '11') is False
+        assert cache.is_cached('uid-2', '10') is False
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 2
+
+    def test_evicts_least_recently_used(self):
+        cache = ReconcileStateCache(max_entries=2)
+        cache.set('uid-1', '10')
+        cache.set('uid-2', '20')
+        cache.is_cached('uid-1', '10')
+        cache.set('uid-3', '30')
+
+        assert len(cache) == 2
+        assert cache.is_cached('uid-1', '10') is True
+        assert cache.is_cached('uid-2', '20') is False
+        assert cache.stats()['evictions'] == 1
+
+    def test_prune(self):
+        cache = ReconcileStateCache()
+        cache.set('uid-1', '10')
+        cache.set('uid-2', '20')
+
+        cache.prune(set(['uid-2']))
+
+        assert cache.is_cached('uid-1', '10') is False
+        assert cache.is_cached('uid-2', '20') is True
+
+    def test_file_snapshot(self):
+        cache = ReconcileStateCache()
+        cache.set('uid-1', '10')
+
+        with TemporaryDirectory() as directory:
+            cache.snapshot_file = os.path.join(directory, 'state.json')
+            assert cache.snapshot() is True
+            # Nothing changed since the last snapshot
+            assert cache.snapshot() is False
+
+            restored = ReconcileStateCache()
+            restored.snapshot_file = cache.snapshot_file
+            assert restored.restore() is True
+
+        assert restored.is_cached('uid-1', '10') is True
+
+    @patch('mongodb_operator.mongodb_operator.state_cache.'
+           'ReconcileStateCache.dump')
+    def test_no_snapshot_target(self, mock_dump):
+        cache = ReconcileStateCache()
+        cache.set('uid-1', '10')
+
+        assert cache.snapshot() is False
+        assert mock_dump.called is False
+
+    def test_missing_file_snapshot(self):
+        cache = ReconcileStateCache()
+
+        with TemporaryDirectory() as directory:
+            assert cache.load_file(
+                os.path.join(directory, 'state.json')) is False
+
+    def test_failed_snapshot_retried(self):
+        cache = ReconcileStateCache()
+        cache.set('uid-1', '10')
+
+        with TemporaryDirectory() as directory:
+            cache.snapshot_file = os.path.join(
+                directory, 'missing', 'state.json')
+            with pytest.raises(OSError):
+                cache.snapshot()
+
+            cache.snapshot_file = os.path.join(directory, 'state.json')
+            assert cache.snapshot() is True
+
+    def test_snapshot_size_bounded(self):
+        cache = ReconcileStateCache(max_snapshot_bytes=200)
+        for i in range(100):
+            cache.set('uid-{}'.format(i), '{}/{}'.format(i, 'a' * 64))
+
+        snapshot = cache.dump()
+        assert len(snapshot) <= 200
+
+        restored = ReconcileStateCache()
+        restored.load(snapshot)
+        assert 0 < len(restored) < 100
+        # The most recently used entries are kept
+        assert restored.is_cached('uid-99', '99/' + 'a' * 64) is True
+        assert restored.is_cached('uid-0', '0/' + 'a' * 64) is False
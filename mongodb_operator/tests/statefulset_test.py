@@ -0,0 +1,145 @@
+from copy import deepcopy
+
+import pytest
+
+from ..mongodb_operator.kubernetes_resources import (
+    DESIRED_STATE_HASH_ANNOTATION, get_desired_state_hash,
+    compare_volume_claim_templates, get_statefulset_object,
+    is_desired_state)
+from .helpers import get_cluster_object
+
+
+def get_mongod_container(statefulset):
+    return statefulset.spec.template.spec.containers[0]
+
+
+def get_volume_mounts(statefulset):
+    return dict((volume_mount.name, volume_mount.mount_path)
+                for volume_mount in
+                get_mongod_container(statefulset).volume_mounts)
+
+
+def get_volumes(statefulset):
+    return dict((volume.name, volume)
+                for volume in statefulset.spec.template.spec.volumes)
+
+
+class TestVolumeClaimTemplates():
+    def test_empty_dir_without_storage(self):
+        statefulset = get_statefulset_object(get_cluster_object())
+
+        assert statefulset.spec.volume_claim_templates is None
+        assert get_volumes(statefulset)['mongo-data'].empty_dir is not None
+
+    def test_claim_template_with_storage(self):
+        statefulset = get_statefulset_object(get_cluster_object(
+            storage={'size': '10Gi', 'storage_class': 'ssd'}))
+
+        assert 'mongo-data' not in get_volumes(statefulset)
+        template, = statefulset.spec.volume_claim_templates
+        assert template.metadata.name == 'mongo-data'
+        assert template.spec.storage_class_name == 'ssd'
+        assert template.spec.resources.requests == {'storage': '10Gi'}
+
+    def test_storage_added(self):
+        current = get_statefulset_object(get_cluster_object())
+        desired = get_statefulset_object(get_cluster_object(
+            storage={'size': '10Gi'}))
+
+        assert compare_volume_claim_templates(current, desired) == (
+            ['mongo-data'], [])
+        assert compare_volume_claim_templates(desired, current) == (
+            ['mongo-data'], [])
+
+    def test_storage_resized(self):
+        current = get_statefulset_object(get_cluster_object(
+            storage={'size': '10Gi'}))
+        desired = get_statefulset_object(get_cluster_object(
+            storage={'size': '20Gi'}))
+
+        assert compare_volume_claim_templates(current, desired) == (
+            [], ['mongo-data'])
+
+    def test_unchanged(self):
+        assert compare_volume_claim_templates(
+            get_statefulset_object(get_cluster_object()),
+            get_statefulset_object(get_cluster_object())) == ([], [])
+
+        desired = get_statefulset_object(get_cluster_object(
+            storage={'size': '10Gi'}))
+        current = deepcopy(desired)
+        # Set by the apiserver
+        current.spec.volume_claim_templates[0].spec.storage_class_name = \
+            'standard'
+        # Anything outside the volume claim templates can be patched
+        current.spec.replicas = 5
+
+        assert compare_volume_claim_templates(current, desired) == ([], [])
+
+
+class TestJournalAndLogStorage():
+    def test_defaults(self):
+        statefulset = get_statefulset_object(get_cluster_object())
+
+        assert get_volume_mounts(statefulset) == {
+            'mongo-tls': '/etc/ssl/mongod', 'mongo-data': '/data/db'}
+        assert '--logpath' not in get_mongod_container(statefulset).command
+
+    def test_journal_storage(self):
+        statefulset = get_statefulset_object(get_cluster_object(
+            storage={'size': '10Gi'},
+            journal_storage={'size': '1Gi', 'storage_class': 'fast'}))
+
+        # mongod keeps the journal in dbPath/journal
+        assert get_volume_mounts(statefulset)['mongo-journal'] == \
+            '/data/db/journal'
+        assert [template.metadata.name for template in
+                statefulset.spec.volume_claim_templates] == [
+            'mongo-data', 'mongo-journal']
+        assert statefulset.spec.volume_claim_templates[1].spec \
+            .storage_class_name == 'fast'
+
+    def test_journal_storage_requires_storage(self):
+        with pytest.raises(ValueError):
+            get_statefulset_object(get_cluster_object(
+                journal_storage={'size': '1Gi'}))
+
+    def test_log_storage(self):
+        statefulset = get_statefulset_object(get_cluster_object(
+            log_storage={'size': '1Gi'}))
+
+        assert get_volume_mounts(statefulset)['mongo-logs'] == \
+            '/var/log/mongodb'
+        command = get_mongod_container(statefulset).command
+        assert command[-3:] == [
+            '--logpath', '/var/log/mongodb/mongod.log', '--logappend']
+        # Logs don't need the data on a persistent volume
+        assert get_volumes(statefulset)['mongo-data'].empty_dir is not None
+        template, = statefulset.spec.volume_claim_templates
+        assert template.metadata.name == 'mongo-logs'
+
+
+class TestDesiredStateHash():
+    def test_ignores_hash_annotation(self):
+        statefulset = get_statefulset_object(get_cluster_object())
+        desired_state_hash = \
+            statefulset.metadata.annotations[DESIRED_STATE_HASH_ANNOTATION]
+
+        assert get_desired_state_hash(statefulset) == desired_state_hash
+        statefulset.metadata.annotations[DESIRED_STATE_HASH_ANNOTATION] = \
+            'outdated'
+        assert get_desired_state_hash(statefulset) == desired_state_hash
+
+    def test_changes_with_spec(self):
+        assert get_desired_state_hash(
+            get_statefulset_object(get_cluster_object())) != \
+            get_desired_state_hash(get_statefulset_object(
+                get_cluster_object(mongodb_limit_memory='1Gi')))
+
+    def test_is_desired_state(self):
+        desired = get_statefulset_object(get_cluster_object())
+        current = deepcopy(desired)
+
+        assert is_desired_state(current, desired) is True
+        current.metadata.annotations = None
+        assert is_desired_state(current, desired) is False
@@ -0,0 +1,109 @@
+from unittest.mock import patch
+
+from ..mongodb_operator.workqueue import WorkQueue, WorkerStats
+
+
+class TestWorkQueue():
+    def test_get_returns_added_key(self):
+        queue = WorkQueue()
+        queue.add(('testnamespace456', 'testname123'))
+
+        assert queue.get(timeout=0) == ('testnamespace456', 'testname123')
+        assert queue.get(timeout=0) is None
+
+    def test_pending_keys_collapse(self):
+        queue = WorkQueue()
+        queue.add(('testnamespace456', 'testname123'))
+        queue.add(('testnamespace456', 'testname123'))
+        queue.add(('testnamespace456', 'other'))
+
+        assert len(queue) == 2
+
+    def test_key_not_handed_out_while_processing(self):
+        queue = WorkQueue()
+        key = ('testnamespace456', 'testname123')
+        queue.add(key)
+        assert queue.get(timeout=0) == key
+
+        # Added again while processing, must wait until done
+        queue.add(key)
+        assert queue.get(timeout=0) is None
+
+        queue.done(key)
+        assert queue.get(timeout=0) == key
+
+    def test_done_without_readd(self):
+        queue = WorkQueue()
+        key = ('testnamespace456', 'testname123')
+        queue.add(key)
+        queue.get(timeout=0)
+        queue.done(key)
+
+        assert len(queue) == 0
+
+    def test_rate_limited_backoff(self):
+        queue = WorkQueue(base_delay=1, max_delay=5)
+        key = ('testnamespace456', 'testname123')
+
+        assert queue.add_rate_limited(key) == 1
+        assert queue.add_rate_limited(key) == 2
+        assert queue.add_rate_limited(key) == 4
+        assert queue.add_rate_limited(key) == 5
+        assert queue.num_requeues(key) == 4
+
+        queue.forget(key)
+        assert queue.num_requeues(key) == 0
+        assert queue.add_rate_limited(key) == 1
+
+    def test_resync_skips_backing_off_keys(self):
+        queue = WorkQueue(base_delay=60)
+        key = ('testnamespace456', 'testname123')
+        queue.add_rate_limited(key)
+
+        assert queue.resync(key) is False
+        assert queue.resync(('testnamespace456', 'other')) is True
+        assert queue.get(timeout=0) == ('testnamespace456', 'other')
+
+        queue.forget(key)
+        assert queue.resync(key) is True
+
+    @patch('mongodb_operator.mongodb_operator.workqueue.monotonic')
+    def test_delayed_key_becomes_ready(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        queue = WorkQueue()
+        key = ('testnamespace456', 'testname123')
+        queue.add_after(key, 10)
+
+        assert queue.get(timeout=0) is None
+
+        mock_monotonic.return_value = 110
+        assert queue.get(timeout=0) == key
+
+
+class TestWorkerStats():
+    @patch('mongodb_operator.mongodb_operator.workqueue.monotonic')
+    def test_collect_utilisation(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        worker_stats = WorkerStats()
+        worker_stats.register('Reconciler-0')
+        worker_stats.register('Reconciler-1')
+        worker_stats.record('Reconciler-0', 2)
+        worker_stats.record('Reconciler-0', 3)
+
+        mock_monotonic.return_value = 10
+        stats = worker_stats.collect()
+
+        assert stats == {'Reconciler-0': (0.5, 2), 'Reconciler-1': (0, 0)}
+
+    @patch('mongodb_operator.mongodb_operator.workqueue.monotonic')
+    def test_collect_resets_window(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        worker_stats = WorkerStats()
+        worker_stats.record('Reconciler-0', 5)
+        mock_monotonic.return_value = 10
+        worker_stats.collect()
+
+        mock_monotonic.return_value = 20
+        stats = worker_stats.collect()
+
+        assert stats == {'Reconciler-0': (0, 0)}